@@ -249,6 +249,322 @@ class Augmenter(object):
         return random.choice(candidates)
 
 
+# labels of the words seen by TokenAugmenter
+WORD, HEADER, SPECIAL = 0, 1, 2
+
+
+class TokenAugmenter(object):
+    """Data augmentation operator working on token ID's.
+
+    Applies the del, swap, drop_col, append_col, drop_token and ins operators
+    (and their RandAugment combination 'all') of Augmenter directly to
+    encoded pairs, so the augmented pair does not need to be serialized and
+    tokenized again. The ops act on words, i.e., runs of subword tokens
+    detected from the tokenizer's vocabulary (Ġ/▁ prefixes or ## suffixes).
+    Header words (COL, VAL) and special tokens are located once per batch
+    with numpy and never dropped; the ops then rewrite the word indices of
+    the whole batch at once, which are gathered back into token ID's.
+
+    Args:
+        tokenizer (Tokenizer): the tokenizer that encoded the pairs
+        max_len (int, optional): the max sequence length (ins never exceeds it)
+    """
+    ops = ['del', 'swap', 'drop_len', 'drop_sym', 'drop_same',
+           'drop_token', 'ins', 'append_col', 'drop_col']
+    supported = ['del', 'swap', 'drop_token', 'ins', 'append_col', 'drop_col']
+
+    def __init__(self, tokenizer, max_len=None):
+        self.max_len = max_len
+        vocab = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+        vocab = [token if token is not None else '' for token in vocab]
+        if any(token.startswith('##') for token in vocab):
+            cont = [token.startswith('##') for token in vocab]
+        elif any(token.startswith('Ġ') for token in vocab):
+            cont = [not token.startswith('Ġ') for token in vocab]
+        elif any(token.startswith('▁') for token in vocab):
+            cont = [not token.startswith('▁') for token in vocab]
+        else:
+            cont = [False] * len(vocab)
+        self.cont = np.array(cont, dtype=bool)
+        self.special = np.zeros(len(vocab), dtype=bool)
+        self.special[tokenizer.all_special_ids] = True
+        self.cont[self.special] = False
+
+        # the segment boundaries (<s>, </s>, [CLS], [SEP], ...)
+        boundary_ids = [tokenizer.cls_token_id, tokenizer.sep_token_id,
+                        tokenizer.bos_token_id, tokenizer.eos_token_id]
+        self.boundary = np.zeros(len(vocab), dtype=bool)
+        self.boundary[[i for i in boundary_ids if i is not None]] = True
+
+        def encode(text):
+            return tuple(tokenizer.encode(text, add_special_tokens=False))
+        self.col_ids = {encode('COL'), encode(' COL')}
+        self.val_ids = {encode('VAL'), encode(' VAL')}
+        self.symbols = [encode(' ' + symbol) for symbol in '-*.,#&']
+
+    @classmethod
+    def supports(cls, op):
+        """Check if the operator op can be applied in token space."""
+        if op == 'all':
+            return True
+        for name in cls.ops:
+            if name in op:
+                return name in cls.supported
+        return False
+
+    def _match(self, flat, word_start, patterns):
+        """Mark the words of flat spelled by one of the token patterns."""
+        n = len(flat)
+        found = np.zeros(n, dtype=bool)
+        next_start = np.append(word_start[1:], True)
+        for pattern in patterns:
+            length = len(pattern)
+            if length == 0 or length > n:
+                continue
+            windows = np.lib.stride_tricks.sliding_window_view(flat, length)
+            hit = (windows == np.asarray(pattern)).all(axis=1) & word_start[:n-length+1]
+            # the word must end with the pattern
+            hit &= next_start[length-1:]
+            found[:n-length+1] |= hit
+        return found
+
+    def augment_batch(self, sequences, op='all'):
+        """Augment a batch of encoded pairs.
+
+        Args:
+            sequences (list of list of int): the token ID's of the pairs
+            op (str, optional): a string encoding of the operator to be applied
+
+        Returns:
+            list of list of int: the augmented token ID's
+        """
+        lens = np.array([len(seq) for seq in sequences], dtype=np.int64)
+        if lens.sum() == 0:
+            return [list(seq) for seq in sequences]
+        flat = np.concatenate([np.asarray(seq, dtype=np.int64) for seq in sequences])
+        seq_start = np.zeros(len(flat), dtype=bool)
+        seq_start[np.cumsum(lens)[:-1][lens[1:] > 0]] = True
+        seq_start[0] = True
+
+        # split the tokens into words
+        special = self.special[flat]
+        after_special = np.append(False, special[:-1])
+        word_start = ~self.cont[flat] | special | after_special | seq_start
+        firsts = np.flatnonzero(word_start)
+        word_len = np.diff(np.append(firsts, len(flat)))
+        word_seq = np.repeat(np.arange(len(sequences)), lens)[firsts]
+        labels = np.full(len(firsts), WORD, dtype=np.int8)
+        is_col = self._match(flat, word_start, self.col_ids)[firsts]
+        is_val = self._match(flat, word_start, self.val_ids)[firsts]
+        labels[is_col | is_val] = HEADER
+        labels[special[firsts]] = SPECIAL
+        boundary = self.boundary[flat][firsts]
+        order = np.arange(len(firsts))
+
+        # the symbols inserted by ins are extra words
+        sym_first = len(flat) + np.cumsum([0] + [len(s) for s in self.symbols[:-1]])
+        sym_words = len(firsts) + np.arange(len(self.symbols))
+        table = np.concatenate([flat] + [np.asarray(s, dtype=np.int64) for s in self.symbols])
+        firsts = np.append(firsts, sym_first)
+        word_len = np.append(word_len, [len(s) for s in self.symbols])
+        labels = np.append(labels, np.full(len(self.symbols), WORD, dtype=np.int8))
+        is_col = np.append(is_col, np.zeros(len(self.symbols), dtype=bool))
+        is_val = np.append(is_val, np.zeros(len(self.symbols), dtype=bool))
+        boundary = np.append(boundary, np.zeros(len(self.symbols), dtype=bool))
+        words = (firsts, word_len, labels, is_col, is_val, boundary, sym_words)
+
+        # the ops rewrite the word indices of all the pairs at once; the
+        # numpy generator is seeded from random, which the workers seed
+        rng = np.random.default_rng(random.getrandbits(32))
+        everyone = np.ones(len(sequences), dtype=bool)
+        order, seq = self.flip(order, word_seq, words, everyone, rng)
+        if op == 'all':
+            # RandAugment: https://arxiv.org/pdf/1909.13719.pdf
+            sub_ops = ['del', 'swap', 'drop_col', 'append_col']
+            for _ in range(3):
+                choice = rng.integers(len(sub_ops), size=len(sequences))
+                for i, sub_op in enumerate(sub_ops):
+                    order, seq = self.augment(order, seq, words, choice == i, rng,
+                                              op=sub_op)
+        else:
+            order, seq = self.augment(order, seq, words, everyone, rng, op=op)
+
+        # gather the tokens of the remaining words
+        lengths = word_len[order]
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        tokens = table[np.repeat(firsts[order], lengths) + offsets]
+        bounds = np.searchsorted(np.repeat(seq, lengths), np.arange(len(sequences) + 1))
+        return [tokens[bounds[i]:bounds[i+1]].tolist() for i in range(len(sequences))]
+
+    @staticmethod
+    def _choose(mask, seq, active, rng):
+        """Pick a position of mask in every active pair, uniformly.
+
+        Returns:
+            np.ndarray: the position picked in every pair (-1 if none)
+        """
+        candidates = np.flatnonzero(mask & active[seq])
+        counts = np.bincount(seq[candidates], minlength=len(active))
+        pick = np.cumsum(counts) - counts + (rng.random(len(active)) * counts).astype(np.int64)
+        chosen = np.full(len(active), -1, dtype=np.int64)
+        chosen[counts > 0] = candidates[pick[counts > 0]]
+        return chosen
+
+    @staticmethod
+    def _spans(n, starts, lengths):
+        """Mark the positions of the spans [start, start + length)."""
+        delta = np.zeros(n + 1, dtype=np.int64)
+        np.add.at(delta, starts, 1)
+        np.add.at(delta, starts + lengths, -1)
+        return np.cumsum(delta[:-1]) > 0
+
+    @staticmethod
+    def _next(mask, positions, limit):
+        """Return the first position of mask at or after each of positions,
+        or limit if there is none before it."""
+        stops = np.append(np.flatnonzero(mask), len(mask))
+        return np.minimum(stops[np.searchsorted(stops, positions)], limit)
+
+    def flip(self, order, seq, words, active, rng):
+        """Swap the two entries of the active pairs with 50% chance."""
+        n, batch = len(order), len(active)
+        bounds = np.searchsorted(seq, np.arange(batch + 1))
+        boundary = words[5][order]
+        # <s> left </s> (</s>) right </s>: the runs between boundaries
+        first = np.append(True, (seq[1:] != seq[:-1]) | boundary[:-1])
+        run_start = ~boundary & first
+        runs = np.cumsum(run_start)
+        runs -= np.append(0, runs)[bounds[seq]]
+        flipped = active & (rng.integers(2, size=batch) == 0) & \
+                  (np.bincount(seq[run_start], minlength=batch) == 2) & \
+                  (np.bincount(seq[boundary], minlength=batch) >= 3)
+
+        # pre, run 2, middle, run 1, post
+        block = np.select([runs == 0, (runs == 1) & ~boundary, runs == 1, ~boundary],
+                          [0, 3, 2, 1], 4)
+        block[~flipped[seq]] = 0
+        perm = np.lexsort((np.arange(n), block, seq))
+        return order[perm], seq[perm]
+
+    def augment(self, order, seq, words, active, rng, op='del'):
+        """Apply an operator to the words of the active pairs.
+
+        Args:
+            order (np.ndarray): the word indices of all the pairs, in order
+            seq (np.ndarray): the pair of every word index (sorted)
+            words (tuple): the word table built by augment_batch
+            active (np.ndarray): the pairs to augment (bool)
+            rng (Generator): the numpy random generator
+            op (str, optional): a string encoding of the operator to be applied
+
+        Returns:
+            np.ndarray: the word indices of the augmented pairs
+            np.ndarray: their pairs
+        """
+        n, batch = len(order), len(active)
+        bounds = np.searchsorted(seq, np.arange(batch + 1))
+        labels = words[2][order]
+        positions = np.arange(n)
+        if 'del' in op or 'swap' in op:
+            if 'del' in op:
+                span_len = rng.integers(1, 3, size=batch)
+            else:
+                span_len = rng.integers(2, 5, size=batch)
+            # spans of span_len plain words
+            run = self._next(labels != WORD, positions, bounds[seq + 1]) - positions
+            pos = self._choose(run >= span_len[seq], seq, active, rng)
+            todo = pos >= 0
+            inside = self._spans(n, pos[todo], span_len[todo])
+            if 'del' in op:
+                return order[~inside], seq[~inside]
+            # shuffle every span with random sort keys within it
+            key = positions.astype(np.float64)
+            owner = seq[inside]
+            key[inside] = pos[owner] + rng.random(len(owner)) * span_len[owner]
+            perm = np.argsort(key, kind='stable')
+            return order[perm], seq[perm]
+        elif 'drop_token' in op:
+            drop = (rng.random(n) < 0.2) & (labels == WORD) & active[seq]
+            return order[~drop], seq[~drop]
+        elif 'ins' in op:
+            return self.insert(order, seq, words, active, rng)
+        elif 'append_col' in op or 'drop_col' in op:
+            is_col, boundary = words[3][order], words[5][order]
+            # an attribute starts at a COL word and ends before the next COL
+            # word or segment boundary
+            starts = np.flatnonzero(is_col)
+            ends = np.full(n, -1, dtype=np.int64)
+            ends[starts] = self._next(is_col | boundary, starts + 1, bounds[seq[starts] + 1])
+            if 'drop_col' in op:
+                idx = self._choose(is_col & (ends - positions <= 8), seq, active, rng)
+                todo = idx >= 0
+                inside = self._spans(n, idx[todo], ends[idx[todo]] - idx[todo])
+                return order[~inside], seq[~inside]
+
+            # only the attributes of the first entry, as in Augmenter
+            first_col = self._next(is_col, bounds[:-1], bounds[1:])
+            first_end = self._next(boundary, first_col, bounds[1:])
+            candidates = is_col & (ends <= first_end[seq])
+            idx1 = self._choose(candidates, seq, active, rng)
+            others = candidates.copy()
+            others[idx1[idx1 >= 0]] = False
+            idx2 = self._choose(others, seq, active, rng)
+            todo = np.flatnonzero(idx2 >= 0)
+            start1, end1, end2 = idx1[todo], ends[idx1[todo]], ends[idx2[todo]]
+            vals = self._next(words[4][order], start1, end1)
+            val1 = np.where(vals < end1, vals + 1, start1)
+
+            # drop attribute 1, its values move right after attribute 2
+            anchor = positions.astype(np.float64)
+            header = self._spans(n, start1, val1 - start1)
+            values = self._spans(n, val1, end1 - val1)
+            anchor[values] = (end2 - 0.5)[np.searchsorted(todo, seq[values])]
+            keep = np.flatnonzero(~header)
+            perm = keep[np.lexsort((positions[keep], anchor[keep]))]
+            return order[perm], seq[perm]
+        return order, seq
+
+    def insert(self, order, seq, words, active, rng):
+        """Insert a symbol before a random plain word of the active pairs.
+
+        With max_len, the entry holding the symbol is truncated from its end
+        back to max_len tokens; the pairs where this would drop a header or
+        a special token are left unchanged.
+        """
+        n, batch = len(order), len(active)
+        labels = words[2][order]
+        pos = self._choose(labels == WORD, seq, active, rng)
+        todo = pos >= 0
+        symbols = words[6][rng.integers(len(self.symbols), size=batch)]
+        key = np.append(np.arange(n), pos[todo] - 0.5)
+        perm = np.argsort(key, kind='stable')
+        order = np.append(order, symbols[todo])[perm]
+        seq = np.append(seq, np.flatnonzero(todo))[perm]
+        if self.max_len is None:
+            return order, seq
+
+        word_len = words[1][order]
+        excess = np.bincount(seq, weights=word_len, minlength=batch).astype(np.int64) - self.max_len
+        over = todo & (excess > 0)
+        if not over.any():
+            return order, seq
+        n = len(order)
+        bounds = np.searchsorted(seq, np.arange(batch + 1))
+        sym_pos = pos + np.cumsum(todo) - 1
+        end = self._next(words[5][order], sym_pos + 1, bounds[1:])
+
+        # drop the words from the end of the entry until the pair fits
+        droppable = over[seq] & (np.arange(n) < end[seq])
+        droppable[sym_pos[over]] = False
+        lengths = np.append(0, np.cumsum(np.where(droppable, word_len, 0)))
+        after = lengths[end[seq]] - lengths[1:]
+        dropped = droppable & (after < excess[seq])
+        bad = np.bincount(seq[dropped & (words[2][order] != WORD)], minlength=batch) > 0
+        bad |= over & (lengths[end] - lengths[bounds[:-1]] < excess)
+        dropped &= ~bad[seq]
+        dropped[sym_pos[bad]] = True
+        return order[~dropped], seq[~dropped]
+
 if __name__ == '__main__':
     ag = Augmenter()
     text = 'COL content VAL vldb conference papers 2020-01-01 COL year VAL 2020 [SEP] COL content VAL sigmod conference 2010 papers 2019-12-31 COL year VAL 2019'
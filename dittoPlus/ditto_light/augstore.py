@@ -0,0 +1,222 @@
+import itertools
+import json
+import os
+import random
+import shutil
+import numpy as np
+
+from multiprocessing import Pool
+
+from .augment import Augmenter
+from .cache import TokenCache
+
+
+def pair_key(left, right):
+    """Whitespace-insensitive key of a pair, used to align stores and splits."""
+    return ' '.join(left.split()) + '\t' + ' '.join(right.split())
+
+
+def _augment_chunk(args):
+    """Augment a chunk of pairs in a worker process.
+
+    Every pair is augmented with its own RNG seeded from (seed, sid), so the
+    output does not depend on the number of processes or the chunking.
+    """
+    chunk, da, k, seed = args
+    augmenter = Augmenter()
+    records = []
+    for sid, left, right, label in chunk:
+        random.seed('%d-%d' % (seed, sid))
+        variants = []
+        for _ in range(k):
+            combined = augmenter.augment_sent(left + ' [SEP] ' + right, da)
+            aug_left, aug_right = combined.split(' [SEP] ')
+            variants.append(aug_left + '\t' + aug_right)
+        records.append({'sid': sid,
+                        'original': left + '\t' + right,
+                        'augment': variants,
+                        'label': str(label)})
+    return records
+
+
+def generate_augment_store(path, output, da='all', k=10,
+                           size=None,
+                           processes=None,
+                           seed=0,
+                           chunk_size=256):
+    """Precompute k augmented variants of every pair of a split.
+
+    The variants are written in the jsonlines format of the
+    train.txt.balance.augment.jsonl files, i.e., one record per pair with
+    the fields sid (the line number), original ("left \\t right"), augment
+    (the list of variants) and label.
+
+    Args:
+        path (str): the split in the "left \\t right \\t label" format
+        output (str): the output jsonlines file
+        da (str, optional): the augmentation operator
+        k (int, optional): the number of variants per pair
+        size (int, optional): the max number of pairs augmented
+        processes (int, optional): the number of worker processes
+            (all the cores by default)
+        seed (int, optional): the random seed
+        chunk_size (int, optional): the number of pairs sent to a worker at once
+
+    Returns:
+        int: the number of records written
+    """
+    def chunks():
+        with open(path, encoding='utf-8') as fin:
+            lines = itertools.islice(fin, size)
+            for start in itertools.count(0, chunk_size):
+                chunk = []
+                for sid, line in zip(range(start, start + chunk_size), lines):
+                    left, right, label = line.strip().split('\t')
+                    chunk.append((sid, left, right, int(label)))
+                if len(chunk) == 0:
+                    return
+                yield chunk, da, k, seed
+
+    total = 0
+    tmp_output = '%s.tmp%d' % (output, os.getpid())
+    with open(tmp_output, 'w', encoding='utf-8') as fout, Pool(processes) as pool:
+        # imap keeps the records in the order of the split
+        for records in pool.imap(_augment_chunk, chunks()):
+            for record in records:
+                fout.write(json.dumps(record) + '\n')
+            total += len(records)
+    os.replace(tmp_output, output)
+    return total
+
+
+class AugmentStore:
+    """Pre-tokenized augmented variants of the pairs of a split.
+
+    The token ID's of all the variants are stored back to back in a flat
+    array (CSR layout, as in TokenCache); record r owns the variants
+    starts[r] to starts[r+1]. A dataset aligns its pairs to the records once
+    (see align) and then samples a variant with a single slice, instead of
+    augmenting and tokenizing the pair on every fetch.
+
+    Args:
+        ids (np.ndarray): the flat array of token ID's (int32)
+        offsets (np.ndarray): variant i spans ids[offsets[i]:offsets[i+1]]
+        starts (np.ndarray): the first variant of every record
+        keys (list of str): the pair_key of the original pair of every record
+    """
+    def __init__(self, ids, offsets, starts, keys):
+        self.ids = ids
+        self.offsets = offsets
+        self.starts = starts
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def variants(self, record):
+        """Return the number of variants of a record."""
+        return int(self.starts[record + 1] - self.starts[record])
+
+    def sample(self, record):
+        """Return the token ID's of a random variant of a record."""
+        variant = self.starts[record] + random.randrange(self.variants(record))
+        return self.ids[self.offsets[variant]:self.offsets[variant+1]].tolist()
+
+    def align(self, pairs):
+        """Map the pairs of a dataset to the records holding their variants.
+
+        Args:
+            pairs (iterable of tuple): the (left, right) pairs of a dataset
+
+        Returns:
+            np.ndarray: the record of every pair (-1 if it has no variants)
+        """
+        index = {key: record for record, key in enumerate(self.keys)
+                 if self.variants(record) > 0}
+        return np.array([index.get(pair_key(left, right), -1)
+                         for left, right in pairs], dtype=np.int64)
+
+    @classmethod
+    def load(cls, path, tokenizer, max_len=256, cache_dir=None,
+             batch_size=2048):
+        """Tokenize the variants of a jsonlines store.
+
+        Args:
+            path (str): the store written by generate_augment_store
+            tokenizer (Tokenizer): a (fast) huggingface tokenizer
+            max_len (int, optional): the max sequence length
+            cache_dir (str, optional): if set, the token ID's are saved under
+                this directory and reused by later runs
+            batch_size (int, optional): the number of variants tokenized at once
+
+        Returns:
+            AugmentStore: the store
+        """
+        directory = None
+        if cache_dir is not None:
+            key = TokenCache.cache_key(path, tokenizer, max_len)
+            directory = os.path.join(cache_dir,
+                                     '%s.%s' % (os.path.basename(path), key[:16]))
+            if os.path.exists(directory):
+                return cls.open(directory)
+
+        ids = []
+        lengths = []
+        counts = []
+        keys = []
+
+        def flush(variants):
+            lefts, rights = zip(*variants)
+            encoded = tokenizer(list(lefts), list(rights),
+                                max_length=max_len,
+                                truncation=True)['input_ids']
+            for x in encoded:
+                ids.append(np.asarray(x, dtype=np.int32))
+                lengths.append(len(x))
+
+        pending = []
+        with open(path, encoding='utf-8') as fin:
+            for line in fin:
+                record = json.loads(line)
+                keys.append(pair_key(*record['original'].split('\t')))
+                counts.append(len(record['augment']))
+                pending += [variant.split('\t') for variant in record['augment']]
+                if len(pending) >= batch_size:
+                    flush(pending)
+                    pending = []
+        if len(pending) > 0:
+            flush(pending)
+
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        starts = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=starts[1:])
+        flat = np.concatenate(ids) if len(ids) > 0 else np.zeros(0, dtype=np.int32)
+        store = cls(flat, offsets, starts, keys)
+        if directory is not None:
+            store.save(directory)
+        return store
+
+    @classmethod
+    def open(cls, directory):
+        """Open a store saved by AugmentStore.save (memory-mapped)."""
+        arrays = [np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+                  for name in ['ids', 'offsets', 'starts']]
+        with open(os.path.join(directory, 'keys.json'), encoding='utf-8') as fin:
+            keys = json.load(fin)
+        return cls(*arrays, keys)
+
+    def save(self, directory):
+        """Save the arrays, renaming a temporary directory when complete."""
+        tmp_dir = '%s.tmp%d' % (directory, os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+        np.save(os.path.join(tmp_dir, 'ids.npy'), self.ids)
+        np.save(os.path.join(tmp_dir, 'offsets.npy'), self.offsets)
+        np.save(os.path.join(tmp_dir, 'starts.npy'), self.starts)
+        with open(os.path.join(tmp_dir, 'keys.json'), 'w', encoding='utf-8') as fout:
+            json.dump(self.keys, fout)
+        try:
+            os.rename(tmp_dir, directory)
+        except OSError:
+            # another run saved the same store in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -0,0 +1,228 @@
+import hashlib
+import numpy as np
+import torch
+
+from collections import OrderedDict
+
+from .threshold import cascade_band
+
+
+def checkpoint_bi_encoder(state_dict):
+    """Return whether a DittoModel state has the bi-encoder head."""
+    return any(key.startswith('bi_head.') for key in state_dict)
+
+
+def pad_entities(seqs):
+    """Pad token ID sequences of single entries into a batch.
+
+    Args:
+        seqs (list of list of int): the token ID's of the entries
+
+    Returns:
+        LongTensor: the padded ID's, (batch_size, max_len)
+        LongTensor: the attention mask (0 for the padding)
+    """
+    maxlen = max(len(seq) for seq in seqs)
+    x = [seq + [0]*(maxlen - len(seq)) for seq in seqs]
+    mask = [[1]*len(seq) + [0]*(maxlen - len(seq)) for seq in seqs]
+    return torch.LongTensor(x), torch.LongTensor(mask)
+
+
+def split_pairs(x):
+    """Split a padded batch of pair ID's into its left and right entries.
+
+    A pair is encoded as "CLS left SEP [SEP] right SEP" (one SEP between the
+    entries for BERT, two for RoBERTa) and padded with 0's. The left entry
+    is "CLS left SEP" and the right one "CLS right SEP", as the tokenizer
+    encodes a single entry.
+
+    Args:
+        x (LongTensor): the pairs, (batch_size, seq_len)
+
+    Returns:
+        LongTensor, LongTensor: the left entries and their attention mask
+        LongTensor, LongTensor: the right entries and their attention mask
+    """
+    lefts, rights = [], []
+    for row in x.tolist():
+        # the last token of a pair is a SEP, the padding follows
+        end = len(row)
+        while end > 1 and row[end - 1] == 0:
+            end -= 1
+        row = row[:end]
+        cls, sep = row[0], row[-1]
+        first = row.index(sep)
+        rest = row[first + 1:]
+        while len(rest) > 1 and rest[0] == sep:
+            rest = rest[1:]
+        lefts.append(row[:first + 1])
+        rights.append([cls] + rest)
+    left_x, left_mask = pad_entities(lefts)
+    right_x, right_mask = pad_entities(rights)
+    return left_x, left_mask, right_x, right_mask
+
+
+def entity_key(entity):
+    """The cache key of a serialized entry."""
+    return hashlib.sha1(entity.encode('utf-8')).digest()
+
+
+class EntityCache:
+    """An LRU cache of entity embeddings, keyed by the hash of the entry.
+
+    Args:
+        max_size (int, optional): the max number of embeddings (unbounded
+            if None)
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.embeddings = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def get(self, key):
+        """Return the embedding of a key (None if it is not cached)."""
+        embedding = self.embeddings.get(key)
+        if embedding is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.embeddings.move_to_end(key)
+        return embedding
+
+    def put(self, key, embedding):
+        self.embeddings[key] = embedding
+        self.embeddings.move_to_end(key)
+        if self.max_size is not None and len(self.embeddings) > self.max_size:
+            self.embeddings.popitem(last=False)
+
+
+class BiEncoder:
+    """Score pairs with the bi-encoder head of a DittoModel.
+
+    Every distinct entry of the scored pairs is encoded once by the LM (in
+    batches of entries of similar length) and its embedding cached, so the
+    cost grows with the number of unique entries instead of the number of
+    pairs. The pairs are then scored by the interaction head of the model
+    (see DittoModel.bi_logits). After calibration (see calibrate), the pairs
+    scoring below low are non-matches, those above high are matches, and
+    the others are left to the cross-encoder.
+
+    Args:
+        model (DittoModel): a model trained with bi_encoder
+        tokenizer (Tokenizer): the tokenizer of the LM
+        max_len (int, optional): the max length of an entry
+        batch_size (int, optional): the number of entries encoded together
+        cache_size (int, optional): the max number of cached embeddings
+
+    Attributes:
+        cache (EntityCache): the embeddings of the entries seen so far
+        low (float): the probability under which a pair is a non-match
+        high (float): the probability above which a pair is a match
+    """
+
+    def __init__(self, model, tokenizer, max_len=256, batch_size=256, cache_size=None):
+        if model.bi_head is None:
+            raise ValueError('the model was not trained with the bi-encoder head')
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_len = max_len
+        self.batch_size = batch_size
+        self.cache = EntityCache(cache_size)
+        self.low = 0.0
+        self.high = 1.0
+
+    def embed(self, entities):
+        """Return the embeddings of serialized entries.
+
+        Args:
+            entities (list of str): the entries
+
+        Returns:
+            Tensor: the embeddings, (num_entities, hidden_size)
+        """
+        keys = [entity_key(entity) for entity in entities]
+        found = {}
+        missing = {}
+        for key, entity in zip(keys, entities):
+            if key in found or key in missing:
+                continue
+            embedding = self.cache.get(key)
+            if embedding is None:
+                missing[key] = entity
+            else:
+                found[key] = embedding
+
+        if len(missing) > 0:
+            missing_keys = list(missing)
+            ids = [self.tokenizer.encode(missing[key], max_length=self.max_len, truncation=True)
+                   for key in missing_keys]
+            # encode the entries of similar length together
+            order = sorted(range(len(ids)), key=lambda i: len(ids[i]))
+            self.model.eval()
+            with torch.no_grad():
+                for start in range(0, len(order), self.batch_size):
+                    batch = order[start:start + self.batch_size]
+                    x, mask = pad_entities([ids[i] for i in batch])
+                    embeddings = self.model.embed(x, mask).cpu()
+                    for i, embedding in zip(batch, embeddings):
+                        found[missing_keys[i]] = embedding
+                        self.cache.put(missing_keys[i], embedding)
+        return torch.stack([found[key] for key in keys])
+
+    def predict_proba(self, pairs):
+        """Return the match probability of serialized pairs (left \\t right
+        [\\t label])."""
+        if len(pairs) == 0:
+            return np.zeros(0)
+        lefts, rights = zip(*[pair.split('\t')[:2] for pair in pairs])
+        u = self.embed(list(lefts))
+        v = self.embed(list(rights))
+        with torch.no_grad():
+            logits = self.model.bi_logits(u.to(self.model.device), v.to(self.model.device))
+        return logits.softmax(dim=1)[:, 1].cpu().numpy()
+
+    def decide(self, pairs):
+        """Decide the pairs outside the calibrated band.
+
+        Args:
+            pairs (list of str): the serialized pairs
+
+        Returns:
+            np.ndarray: 0 (non-match), 1 (match) or -1 (left to the
+                cross-encoder) for every pair
+            np.ndarray: the match probabilities
+        """
+        probs = self.predict_proba(pairs)
+        decisions = np.full(len(pairs), -1)
+        decisions[probs < self.low] = 0
+        decisions[probs > self.high] = 1
+        return decisions, probs
+
+    def calibrate(self, pairs, labels, cross_probs, threshold=0.5, max_f1_loss=0.005):
+        """Set the band of the bi-encoder on labeled (validation) pairs.
+
+        The band sends the fewest pairs to the cross-encoder while keeping
+        the F1 within max_f1_loss of the cross-encoder's alone (see
+        threshold.cascade_band).
+
+        Args:
+            pairs (list of str): the serialized pairs
+            labels (list of int): the 0/1 labels
+            cross_probs (np.ndarray): the match probabilities of the
+                cross-encoder
+            threshold (float, optional): the threshold of the cross-encoder
+            max_f1_loss (float, optional): the max F1 loss
+
+        Returns:
+            float: the F1 score with the bi-encoder stage
+            float: the share of the pairs left to the cross-encoder
+        """
+        probs = self.predict_proba(pairs)
+        self.low, self.high, f1, passed = cascade_band(probs, cross_probs, np.asarray(labels),
+                                                       threshold, max_f1_loss=max_f1_loss)
+        return f1, passed
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+
+class TokenCache:
+    """Pre-tokenized copy of a split of entry pairs.
+
+    The token ID's of all the pairs are stored back to back in one flat
+    array and sliced with an offsets array (CSR layout); the labels are
+    kept in a separate array. Every array is opened with np.memmap, so
+    several datasets or processes reading the same cache share the pages.
+
+    Args:
+        directory (str): the directory of a cache built by TokenCache.build
+
+    Attributes:
+        ids (np.memmap): the flat array of token ID's (int32)
+        offsets (np.memmap): pair i spans ids[offsets[i]:offsets[i+1]] (int64)
+        labels (np.memmap): the labels of the pairs (int8)
+        meta (Dictionary): how the cache was built
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.ids = np.load(os.path.join(directory, 'ids.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(directory, 'offsets.npy'), mmap_mode='r')
+        self.labels = np.load(os.path.join(directory, 'labels.npy'), mmap_mode='r')
+        with open(os.path.join(directory, 'meta.json')) as fin:
+            self.meta = json.load(fin)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        """Return the token ID's of a pair as a view of the flat array."""
+        return self.ids[self.offsets[idx]:self.offsets[idx+1]]
+
+    def lengths(self):
+        """Return the number of tokens of every pair."""
+        return np.diff(self.offsets)
+
+    @staticmethod
+    def file_hash(path):
+        """Return the sha1 hex digest of a file's content."""
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as fin:
+            for block in iter(lambda: fin.read(1 << 20), b''):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+    @staticmethod
+    def cache_key(path, tokenizer, max_len, kbert=False):
+        """Return the key identifying a cache.
+
+        The key covers the content of the file, the tokenizer (name and
+        vocabulary size, which includes the added knowledge tokens), the max
+        sequence length and the tokenization mode.
+        """
+        key = {'file': TokenCache.file_hash(path),
+               'tokenizer': tokenizer.name_or_path,
+               'vocab': len(tokenizer),
+               'max_len': max_len,
+               'kbert': kbert}
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def load(cls, path, tokenizer, cache_dir, max_len=256, kbert=False,
+             batch_size=2048):
+        """Open the cache of a split, building it on the first call.
+
+        Args:
+            path (str): the split in the "left \\t right \\t label" format
+            tokenizer (Tokenizer): a (fast) huggingface tokenizer
+            cache_dir (str): the directory holding all the caches
+            max_len (int, optional): the max sequence length
+            kbert (boolean, optional): if true, store the untruncated
+                "<s> left right </s>" tokens used by the kbert mode instead
+                of the "left, right" encoding pair
+            batch_size (int, optional): the number of lines tokenized at once
+
+        Returns:
+            TokenCache: the opened cache
+        """
+        key = cls.cache_key(path, tokenizer, max_len, kbert=kbert)
+        directory = os.path.join(cache_dir,
+                                 '%s.%s' % (os.path.basename(path), key[:16]))
+        if not os.path.exists(directory):
+            cls.build(path, tokenizer, directory, max_len=max_len,
+                      kbert=kbert, batch_size=batch_size)
+        return cls(directory)
+
+    @classmethod
+    def build(cls, path, tokenizer, directory, max_len=256, kbert=False,
+              batch_size=2048):
+        """Tokenize a split with batched tokenization and write the cache.
+
+        The arrays are written to a temporary directory which is then renamed,
+        so concurrent runs never observe a partial cache.
+
+        Args:
+            path (str): the split in the "left \\t right \\t label" format
+            tokenizer (Tokenizer): a (fast) huggingface tokenizer
+            directory (str): the output directory
+            max_len (int, optional): the max sequence length
+            kbert (boolean, optional): see TokenCache.load
+            batch_size (int, optional): the number of lines tokenized at once
+
+        Returns:
+            None
+        """
+        ids = []
+        lengths = []
+        labels = []
+
+        def flush(lefts, rights):
+            if kbert:
+                left_ids = tokenizer(lefts, add_special_tokens=False)['input_ids']
+                right_ids = tokenizer(rights, add_special_tokens=False)['input_ids']
+                encoded = [[tokenizer.bos_token_id] + l + r + [tokenizer.eos_token_id]
+                           for l, r in zip(left_ids, right_ids)]
+            else:
+                encoded = tokenizer(lefts, rights,
+                                    max_length=max_len,
+                                    truncation=True)['input_ids']
+            for x in encoded:
+                ids.append(np.asarray(x, dtype=np.int32))
+                lengths.append(len(x))
+
+        lefts, rights = [], []
+        with open(path, encoding='utf-8') as fin:
+            for line in fin:
+                s1, s2, label = line.strip().split('\t')
+                lefts.append(s1)
+                rights.append(s2)
+                labels.append(int(label))
+                if len(lefts) == batch_size:
+                    flush(lefts, rights)
+                    lefts, rights = [], []
+        if len(lefts) > 0:
+            flush(lefts, rights)
+
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        flat = np.concatenate(ids) if len(ids) > 0 else np.zeros(0, dtype=np.int32)
+
+        tmp_dir = '%s.tmp%d' % (directory, os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+        np.save(os.path.join(tmp_dir, 'ids.npy'), flat)
+        np.save(os.path.join(tmp_dir, 'offsets.npy'), offsets)
+        np.save(os.path.join(tmp_dir, 'labels.npy'), np.asarray(labels, dtype=np.int8))
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as fout:
+            json.dump({'path': path,
+                       'tokenizer': tokenizer.name_or_path,
+                       'max_len': max_len,
+                       'kbert': kbert,
+                       'size': len(lengths)}, fout)
+        try:
+            os.rename(tmp_dir, directory)
+        except OSError:
+            # another run built the same cache in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -0,0 +1,156 @@
+import glob
+import os
+import queue
+import random
+import re
+import threading
+import numpy as np
+import torch
+
+
+def snapshot(obj):
+    """Copy the tensors of a (nested) state dict to the CPU.
+
+    The copy is taken synchronously so that training can go on updating the
+    parameters while the snapshot is being written.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def rng_state(loader=None):
+    """Capture the states of the RNGs used during training.
+
+    Args:
+        loader (DataLoader, optional): a loader whose shuffling generator
+            is captured
+
+    Returns:
+        Dictionary: the RNG states
+    """
+    state = {'python': random.getstate(),
+             'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    generator = getattr(getattr(loader, 'sampler', None), 'generator', None)
+    if generator is not None:
+        state['loader'] = generator.get_state()
+    return state
+
+
+def set_rng_state(state, loader=None):
+    """Restore the RNG states captured by rng_state."""
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    generator = getattr(getattr(loader, 'sampler', None), 'generator', None)
+    if 'loader' in state and generator is not None:
+        generator.set_state(state['loader'])
+
+
+def load_checkpoint(path):
+    """Load a checkpoint (with its RNG states) on the CPU."""
+    try:
+        return torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError:
+        # torch < 1.13 has no weights_only
+        return torch.load(path, map_location='cpu')
+
+
+class CheckpointWriter:
+    """Write checkpoints from a background thread.
+
+    save() snapshots the state on the CPU and returns; a worker thread then
+    writes it to a temporary file which is atomically renamed, so a job
+    killed mid-write never leaves a truncated checkpoint behind. Only the
+    last keep resume checkpoints (ckpt-<step>.pt) of the directory are kept.
+
+    Args:
+        directory (str): the checkpoint directory
+        keep (int, optional): the number of resume checkpoints kept
+    """
+    pattern = 'ckpt-*.pt'
+
+    def __init__(self, directory, keep=1):
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            state, name, prune = item
+            try:
+                path = os.path.join(self.directory, name)
+                tmp_path = '%s.tmp%d' % (path, os.getpid())
+                torch.save(state, tmp_path)
+                os.replace(tmp_path, path)
+                if prune:
+                    self._prune()
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def _prune(self):
+        for path in self.checkpoints(self.directory)[:-self.keep]:
+            os.remove(path)
+
+    def save(self, state, name, prune=False):
+        """Snapshot a state and write it to directory/name in the background.
+
+        Args:
+            state (Dictionary): the state (state dicts, counters, ...)
+            name (str): the file name
+            prune (boolean, optional): remove the old resume checkpoints
+                once the file is written
+
+        Returns:
+            Dictionary: the CPU snapshot of the state
+        """
+        if self.error is not None:
+            raise self.error
+        state = snapshot(state)
+        self.queue.put((state, name, prune))
+        return state
+
+    def wait(self):
+        """Block until all the pending checkpoints are written."""
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """Write the pending checkpoints and stop the worker thread."""
+        self.queue.put(None)
+        self.wait()
+        self.thread.join()
+
+    @classmethod
+    def checkpoints(cls, directory):
+        """List the resume checkpoints of a directory, oldest first."""
+        paths = glob.glob(os.path.join(directory, cls.pattern))
+        def step(path):
+            match = re.search(r'ckpt-(\d+)\.pt$', path)
+            return int(match.group(1)) if match else -1
+        return sorted([p for p in paths if step(p) >= 0], key=step)
+
+    @classmethod
+    def latest(cls, directory):
+        """Return the path of the latest resume checkpoint (None if none)."""
+        paths = cls.checkpoints(directory)
+        return paths[-1] if len(paths) > 0 else None
@@ -1,16 +1,33 @@
 from unittest.mock import sentinel
+import itertools
+import json
+import random
 import torch
 
 from torch.utils import data
 from transformers import AutoTokenizer, RobertaTokenizer
 
-from .augment import Augmenter
+from .augment import Augmenter, TokenAugmenter
+from .cache import TokenCache
+from .kbert import build_knowledge_trees, visible_matrix, visibility_groups
+from .storage import PairStore
 import numpy as np
 
 # map lm name to huggingface's pre-trained model names
 lm_mp = {'roberta': 'roberta-base',
          'distilbert': 'distilbert-base-uncased'}
 
+# special tokens marking the knowledge injected by the prompt_type 0 injectors
+knowledge_tokens = ['<head>', '</head>', '<tail>', '</tail>']
+
+def label_tensor(y):
+    """Return the labels of a batch as a LongTensor, or as a FloatTensor if
+    they are soft labels (see the soft_labels of DittoDataset)."""
+    if isinstance(y[0], (float, np.floating, np.ndarray)):
+        return torch.tensor(np.asarray(y), dtype=torch.float32)
+    return torch.LongTensor(y)
+
+
 def get_tokenizer(lm):
     if lm in lm_mp:
         return AutoTokenizer.from_pretrained(lm_mp[lm])
@@ -18,8 +35,25 @@ def get_tokenizer(lm):
         return AutoTokenizer.from_pretrained(lm)
 
 
+def get_ditto_tokenizer(lm):
+    """Load the tokenizer of lm with the knowledge tokens escaped.
+
+    The result can be shared by several DittoDataset instances (see the
+    tokenizer argument of DittoDataset) to avoid reloading it.
+    """
+    tokenizer = get_tokenizer(lm)
+    tokenizer.add_tokens(knowledge_tokens, special_tokens=True)
+    return tokenizer
+
+
 class DittoDataset(data.Dataset):
-    """EM dataset"""
+    """EM dataset
+
+    If soft_labels is set (a float or an array of floats per pair, e.g., the
+    match probability of a teacher model and the label, see
+    distill.distillation_labels), the items and batches carry it in place of
+    the 0/1 label.
+    """
 
     def __init__(self,
                  path,
@@ -27,41 +61,87 @@ class DittoDataset(data.Dataset):
                  size=None,
                  lm='roberta',
                  da=None,
-                 kbert=False):
-        self.tokenizer:RobertaTokenizer = get_tokenizer(lm)
+                 kbert=False,
+                 tokenizer=None,
+                 cache_dir=None,
+                 augment_store=None,
+                 pack=False,
+                 soft_labels=None):
+        # escape special tokens unless a prepared tokenizer is shared with us
+        if tokenizer is None:
+            tokenizer = get_ditto_tokenizer(lm)
+        self.tokenizer:RobertaTokenizer = tokenizer
         self.kbert = kbert
-        # escape special tokens 
-        self.tokenizer.add_tokens(['<head>', '</head>','<tail>','</tail>'], special_tokens=True)
-        self.pairs = []
-        self.labels = []
-        self.rows = []
         self.max_len = max_len
         self.size = size
+        # pack several pairs per sequence in pad (see pack_batch)
+        self.pack = pack
 
-        if isinstance(path, list):
-            lines = path
+        if isinstance(path, str):
+            with open(path, encoding='utf-8') as lines:
+                self.pairs = PairStore.from_lines(itertools.islice(lines, size))
         else:
-            lines = open(path, encoding='utf-8')
-
-        for line in lines:
-            self.rows.append(line)
-            s1, s2, label = line.strip().split('\t')
-            self.pairs.append((s1, s2))
-            self.labels.append(int(label))
-
-        self.pairs = self.pairs[:size]
-        self.labels = self.labels[:size]
+            self.pairs = PairStore.from_lines(itertools.islice(path, size))
+        # the labels and raw rows are backed by the same compact store
+        self.labels = self.pairs.labels
+        self.rows = self.pairs.rows
+        self.soft_labels = soft_labels
         self.da = da
         if da is not None:
             self.augmenter = Augmenter()
         else:
             self.augmenter = None
+        self.token_augmenter = self.make_token_augmenter()
+
+        # precomputed variants sampled instead of augmenting on every fetch
+        self.augment_store = augment_store
+        if augment_store is not None:
+            self.augment_index = augment_store.align(self.pairs)
+        else:
+            self.augment_index = None
+
+        # pre-tokenized copy of the split, shared by all runs on the same file
+        if cache_dir is not None and isinstance(path, str):
+            self.cache = TokenCache.load(path, self.tokenizer, cache_dir,
+                                         max_len=max_len, kbert=kbert)
+        else:
+            self.cache = None
 
 
     def __len__(self):
         """Return the size of the dataset."""
         return len(self.pairs)
 
+    def make_token_augmenter(self):
+        """Return a TokenAugmenter if da can be applied to the token ID's."""
+        if self.da is None or self.kbert or not TokenAugmenter.supports(self.da):
+            return None
+        return TokenAugmenter(self.tokenizer, max_len=self.max_len)
+
+    def lengths(self, batch_size=2048):
+        """Return the token length of every pair (without augmentation).
+
+        Args:
+            batch_size (int, optional): the number of pairs tokenized at once
+
+        Returns:
+            np.ndarray: the lengths
+        """
+        if self.kbert:
+            # the sentence trees are always padded to the same length
+            return np.full(len(self), 128, dtype=np.int64)
+        if self.cache is not None:
+            return self.cache.lengths()[:len(self)]
+
+        lengths = []
+        for start in range(0, len(self.pairs), batch_size):
+            lefts, rights = zip(*self.pairs[start:start+batch_size])
+            encoded = self.tokenizer(list(lefts), list(rights),
+                                     max_length=self.max_len,
+                                     truncation=True)['input_ids']
+            lengths += [len(x) for x in encoded]
+        return np.asarray(lengths, dtype=np.int64)
+
     def __getitem__(self, idx):
         """Return a tokenized item of the dataset.
 
@@ -73,22 +153,43 @@ class DittoDataset(data.Dataset):
             List of int: token ID's of the two entities augmented (if da is set)
             int: the label of the pair (0: unmatch, 1: match)
         """
-        left = self.pairs[idx][0]
-        right = self.pairs[idx][1]
+        left, right = self.pairs[idx]
+        ids = self.cache[idx] if self.cache is not None else None
+        x_aug = None
+        if self.augment_index is not None and self.augment_index[idx] >= 0:
+            x_aug = self.augment_store.sample(self.augment_index[idx])
+        if self.soft_labels is not None:
+            label = self.soft_labels[idx]
+        else:
+            label = self.pairs.label(idx)
+        return self.encode(left, right, label, ids=ids, x_aug=x_aug)
+
+    def encode(self, left, right, label, ids=None, x_aug=None):
+        """Tokenize a pair into a dataset item (see __getitem__).
 
+        Args:
+            left (str): the serialized left entry
+            right (str): the serialized right entry
+            label (int): the label of the pair
+            ids (np.ndarray, optional): the pre-tokenized pair from the cache
+            x_aug (list of int, optional): a pre-tokenized augmented variant
 
+        Returns:
+            tuple: the dataset item
+        """
         if self.kbert:
-            left_tokenize = self.tokenizer.tokenize(left)
-            right_tokenize = self.tokenizer.tokenize(right)
-            x_tokenize = [self.tokenizer.bos_token] + left_tokenize + right_tokenize + [self.tokenizer.eos_token]
-            know_sent_batch, position_batch, visible_matrix_batch, seg_batch = self.add_knowledge_with_vm(x_tokenize)
-
-            # convert tokenized x into ids
-            x = self.tokenizer.convert_tokens_to_ids(know_sent_batch)
-            # x_tokenize.convert_tokens_to_idx(text=left,
-            #                           text_pair=right,
-            #                           max_length=self.max_len,
-            #                           truncation=True)
+            if ids is not None:
+                x_ids = ids
+            else:
+                left_ids = self.tokenizer(left, add_special_tokens=False)['input_ids']
+                right_ids = self.tokenizer(right, add_special_tokens=False)['input_ids']
+                x_ids = [self.tokenizer.bos_token_id] + left_ids + right_ids + [self.tokenizer.eos_token_id]
+            # the visible matrix is shipped as compact groups, see RobertaWithVM
+            know, pos, groups, seg = self.add_knowledge_batch([x_ids], compact=True)
+            x = know_sent_batch = know[0].tolist()
+            position_batch, visible_matrix_batch, seg_batch = pos[0], groups[0], seg[0]
+        elif ids is not None:
+            x = ids.tolist()
         else:
             # left + right
             x = self.tokenizer.encode(text=left,
@@ -99,18 +200,23 @@ class DittoDataset(data.Dataset):
             # raise Exception("debug")
 
         # augment if da is set
-        if self.da is not None:
+        if self.da is not None and x_aug is not None:
+            return x, x_aug, label
+        elif self.token_augmenter is not None:
+            # augmented in token space by pad, a batch at a time
+            return x, None, label
+        elif self.da is not None:
             combined = self.augmenter.augment_sent(left + ' [SEP] ' + right, self.da)
             left, right = combined.split(' [SEP] ')
             x_aug = self.tokenizer.encode(text=left,
                                       text_pair=right,
                                       max_length=self.max_len,
                                       truncation=True)
-            return x, x_aug, self.labels[idx]
+            return x, x_aug, label
         elif self.kbert:
-            return x, self.labels[idx],know_sent_batch,position_batch,visible_matrix_batch,seg_batch
+            return x, label,know_sent_batch,position_batch,visible_matrix_batch,seg_batch
         else:
-            return x, self.labels[idx]
+            return x, label
     
     def parser_adhoc(self, sent_batch):
         # input: sent_batch ['COL', 'Ġ', '<head>',"person","name","column",'</head>','Ġ',"<tail>","author", "name", "</tail>"....]
@@ -128,139 +234,48 @@ class DittoDataset(data.Dataset):
         return output
     
     def add_knowledge_with_vm(self, sent_batch, max_entities=128, add_pad=True, max_length=128):
+        """Build the sentence tree of a tokenized sequence (see kbert.py).
+
+        Args:
+            sent_batch (list of str or np.ndarray): the tokens of the sequence,
+                or their token ID's
+            max_length (int, optional): the padded/truncated length
+
+        Returns:
+            list of int: the token ID's of the sentence tree
+            np.ndarray: the soft position of each token
+            np.ndarray: the visible matrix (bool), (max_length, max_length)
+            np.ndarray: the segment tags (1 for knowledge tokens)
         """
-        input: sent_batch - list of sentences, e.g., ["abcd", "efgh"]
-        return: know_sent_batch - list of sentences with entites embedding
-                position_batch - list of position index of each character.
-                visible_matrix_batch - list of visible matrixs
-                seg_batch - list of segment tags
-        """
-        # know_sent_batch = []
-        # position_batch = []
-        # visible_matrix_batch = []
-        # seg_batch = []
-
-        # create tree
-        sent_tree = []
-        pos_idx_tree = []
-        abs_idx_tree = []
-        pos_idx = -1
-        abs_idx = -1
-        abs_idx_src = []
-        # skip_idx = []
-        head_left_id, head_right_id = -1, -1
-        tail_left_id, tail_right_id = -1, -1
-        # print('sent_batch', sent_batch) 
-        for i,token in enumerate(sent_batch): 
-            # token_skip_idx = []
-            # skip = False
-            if token=='<head>':
-                # skip_idx.append(i)
-                # token_skip_idx.append(i)
-                # skip = True
-                head_left_id = i
-                head_right_id = sent_batch[i:].index('</head>') + i
-                tail_left_id = sent_batch[i:].index("<tail>")+1 +i
-                tail_right_id = sent_batch[i:].index("</tail>") + i
-                
-                # tail_skip_idx += list(range(i+tail_left_id-1,tail_right_id+i+1))
-                # token_skip_idx += [i+tail_left_id-1,tail_right_id+i]
-                # skip = True
-                # entities= [" ".join(tail_value)] # entities: ["author name"]
-                entities = [] 
-                # raise NotImplementedError
-            # elif token == '</head>':
-                # skip_idx.append(i)
-                # token_skip_idx.append(i)
-                # skip = True
-            elif head_left_id < i < head_right_id:
-                tail_value = sent_batch[tail_left_id:tail_right_id]
-                entities = tail_value
-            elif tail_left_id <= i <= tail_right_id:
-                continue
-            else: entities = []
-
-            # if not skip:
-            if  token not in ['<head>','</head>','<tail>','</tail>']: # and not (tail_left_id <= i <= tail_right_id):
-                sent_tree.append((token, entities))
-                token_pos_idx = [pos_idx+1] #[pos_idx+i for i in range(1, len(token)+1)]
-                token_abs_idx = [abs_idx+1] #[abs_idx+i for i in range(1, len(token)+1)]
-                abs_idx = token_abs_idx[-1]
-
-            entities_pos_idx = []
-            entities_abs_idx = []
-            # for ent in entities:
-            # if len(entities) >0:
-            for ent in entities:
-                if ent not in ['<tail>','</tail>']:
-                    ent_pos_idx = [token_pos_idx[-1]+1]#[token_pos_idx[-1] + p for p in range(1, len(entities)+1)]#ent
-                    entities_pos_idx.append(ent_pos_idx)
-                    ent_abs_idx = [abs_idx + 1]#[abs_idx + a for a in range(1, len(entities)+1)]#ent
-                    abs_idx = ent_abs_idx[-1]
-                    entities_abs_idx.append(ent_abs_idx)
-            if  token not in ['<head>','</head>','<tail>','</tail>']:
-                pos_idx_tree.append((token_pos_idx, entities_pos_idx))
-                abs_idx_tree.append((token_abs_idx, entities_abs_idx))
-                pos_idx = token_pos_idx[-1]
-                abs_idx_src += token_abs_idx
-
-        # Get know_sent and pos
-        know_sent = []
-        pos = []
-        seg = []
-        # print('sent_tree',sent_tree)
-        for i in range(len(sent_tree)):
-            word = sent_tree[i][0]
-            # if word in self.special_tags:
-            #     know_sent += [word]
-            #     seg += [0]
-            # else:
-            # print(word, i)
-            # if i not in skip_idx:
-            add_word = [word]#self.tokenizer.tokenize(word)
-            know_sent += add_word 
-            seg += [0] * len(add_word)
-            pos += pos_idx_tree[i][0]
-            for j in range(len(sent_tree[i][1])):
-                add_word = [sent_tree[i][1][j]]
-                know_sent += add_word
-                seg += [1] #* len(add_word)
-                pos += pos_idx_tree[i][1][j]
-
-        token_num = len(know_sent)
-        # assert token_num == abs_idx_tree, "length of know_sent = abs_idx_tree maximum idx"
-        # Calculate visible matrix
-        visible_matrix = np.zeros((token_num, token_num))
-        for item in abs_idx_tree:
-            src_ids = item[0]
-            for id in src_ids:
-                visible_abs_idx = abs_idx_src + [idx for ent in item[1] for idx in ent]
-                visible_matrix[id, visible_abs_idx] = 1
-            for ent in item[1]:
-                for id in ent:
-                    visible_abs_idx = ent + src_ids
-                    visible_matrix[id, visible_abs_idx] = 1
-
-        src_length = len(know_sent)
-        if len(know_sent) < max_length:
-            pad_num = max_length - src_length
-            know_sent += [self.tokenizer.pad_token] * pad_num # TODO
-            seg += [0] * pad_num
-            pos += [max_length - 1] * pad_num
-            visible_matrix = np.pad(visible_matrix, ((0, pad_num), (0, pad_num)), 'constant')  # pad 0
-        else:
-            know_sent = know_sent[:max_length]
-            seg = seg[:max_length]
-            pos = pos[:max_length]
-            visible_matrix = visible_matrix[:max_length, :max_length]
-        
-        # know_sent_batch.append(know_sent)
-        # position_batch.append(pos)
-        # visible_matrix_batch.append(visible_matrix)
-        # seg_batch.append(seg)
+        if len(sent_batch) > 0 and isinstance(sent_batch[0], str):
+            sent_batch = self.tokenizer.convert_tokens_to_ids(sent_batch)
+        know, pos, vm, seg = self.add_knowledge_batch([sent_batch], max_length=max_length)
+        return know[0].tolist(), pos[0], vm[0], seg[0]
 
-    
-        return know_sent, pos, visible_matrix, seg
+    def add_knowledge_batch(self, sequences, max_length=128, compact=False):
+        """Build the sentence trees of a batch of token ID sequences at once.
+
+        Args:
+            sequences (list of array-like): the token ID's of each sequence
+            max_length (int, optional): the padded/truncated length
+            compact (boolean, optional): if true, return the visibility
+                groups (see kbert.visibility_groups) instead of the matrices
+
+        Returns:
+            np.ndarray: the token ID's of the trees, (batch_size, max_length)
+            np.ndarray: the soft positions, (batch_size, max_length)
+            np.ndarray: the visible matrices, (batch_size, max_length, max_length),
+                or the visibility groups, (batch_size, max_length)
+            np.ndarray: the segment tags, (batch_size, max_length)
+        """
+        marker_ids = self.tokenizer.convert_tokens_to_ids(knowledge_tokens)
+        know, pos, seg, owners = build_knowledge_trees(sequences,
+                                                       marker_ids,
+                                                       self.tokenizer.pad_token_id,
+                                                       max_length=max_length)
+        if compact:
+            return know, pos, visibility_groups(owners, seg), seg
+        return know, pos, visible_matrix(owners, seg), seg
 
     def pad(self, batch):
         """Merge a list of dataset items into a train/test batch
@@ -275,15 +290,22 @@ class DittoDataset(data.Dataset):
         """
         if len(batch[0]) == 3:
             x1, x2, y = zip(*batch)
+            todo = [i for i, xi in enumerate(x2) if xi is None]
+            if len(todo) > 0:
+                x2 = list(x2)
+                augmented = self.token_augmenter.augment_batch([x1[i] for i in todo], self.da)
+                for i, xi in zip(todo, augmented):
+                    x2[i] = xi
+                x2 = tuple(x2)
 
             maxlen = max([len(x) for x in x1+x2])
             x1 = [xi + [0]*(maxlen - len(xi)) for xi in x1]
             x2 = [xi + [0]*(maxlen - len(xi)) for xi in x2]
             return torch.LongTensor(x1), \
                    torch.LongTensor(x2), \
-                   torch.LongTensor(y)
+                   label_tensor(y)
         elif len(batch[0]) == 6:
-            #  know_sent, pos, visible_matrix, seg
+            #  know_sent, pos, visibility groups, seg
             x1, y, x2, x3, x4, x5 = zip(*batch)
 
             # maxlen = max([len(x) for x in x1+x3+x4])
@@ -294,13 +316,197 @@ class DittoDataset(data.Dataset):
             # x4 = [xi + [0]*(maxlen - len(xi)) for xi in x4]
             # x5 = [xi + [0]*(maxlen - len(xi)) for xi in x5]
             return  torch.LongTensor(x1), \
-                    torch.LongTensor(x3), \
-                    torch.LongTensor(x4), \
-                    torch.LongTensor(y)
+                    torch.from_numpy(np.stack(x3)), \
+                    torch.from_numpy(np.stack(x4)), \
+                    label_tensor(y)
         else:
             x12, y = zip(*batch)
+            if self.pack:
+                return self.pack_batch(x12, y)
             maxlen = max([len(x) for x in x12])
             x12 = [xi + [0]*(maxlen - len(xi)) for xi in x12]
             return torch.LongTensor(x12), \
-                   torch.LongTensor(y)
+                   label_tensor(y)
+
+    def pack_batch(self, x12, y):
+        """Pack the sequences of a batch into rows of up to max_len tokens.
+
+        The sequences are placed first-fit decreasing, so short pairs share
+        a row instead of being padded to the longest pair of the batch. The
+        pair index of every token gives the block-diagonal attention mask (a
+        pair only attends to itself, padding only to padding) and the
+        positions restart at 0 with every pair; see DittoModel.forward.
+
+        Args:
+            x12 (list of list of int): the token ID's of the pairs
+            y (list of int): the labels
+
+        Returns:
+            LongTensor: the packed ID's, (n_rows, row_len)
+            LongTensor: the position of every token in its pair
+            LongTensor: the pair index of every token (-1 for padding)
+            LongTensor: the (row, column) of the CLS token of every pair,
+                in the batch order, (batch_size, 2)
+            LongTensor: the labels, (batch_size,)
+        """
+        capacity = max([self.max_len] + [len(x) for x in x12])
+        rows = []
+        fill = []
+        for i in sorted(range(len(x12)), key=lambda i: -len(x12[i])):
+            for r in range(len(rows)):
+                if fill[r] + len(x12[i]) <= capacity:
+                    break
+            else:
+                r = len(rows)
+                rows.append([])
+                fill.append(0)
+            rows[r].append(i)
+            fill[r] += len(x12[i])
+
+        x = np.zeros((len(rows), max(fill)), dtype=np.int64)
+        positions = np.zeros_like(x)
+        segments = np.full_like(x, -1)
+        cls_index = np.zeros((len(x12), 2), dtype=np.int64)
+        for r, members in enumerate(rows):
+            start = 0
+            for i in members:
+                end = start + len(x12[i])
+                x[r, start:end] = x12[i]
+                positions[r, start:end] = np.arange(end - start)
+                segments[r, start:end] = i
+                cls_index[i] = r, start
+                start = end
+        return torch.from_numpy(x), \
+               torch.from_numpy(positions), \
+               torch.from_numpy(segments), \
+               torch.from_numpy(cls_index), \
+               label_tensor(y)
 
+
+def serialize_entry(entry):
+    """Serialize a data entry given as a string or an attribute dictionary."""
+    if isinstance(entry, str):
+        return entry
+    content = ''
+    for attr in entry.keys():
+        content += 'COL %s VAL %s ' % (attr, entry[attr])
+    return content
+
+
+class DittoStreamDataset(data.IterableDataset):
+    """EM dataset streamed from a file larger than memory.
+
+    The pairs are read in chunks from a tsv file (left \t right \t label) or
+    a jsonlines file ([left, right] or [left, right, label], the entries
+    being strings or attribute dictionaries). Only shuffle_buffer pairs are
+    held in memory at a time; size stops the reading early. With several
+    DataLoader workers, each worker reads every num_workers-th pair.
+
+    Args:
+        path (str): the input file
+        max_len (int, optional): the max sequence length
+        size (int, optional): the max number of pairs read from the file
+        lm (str, optional): the language model
+        da (str, optional): the augmentation operator
+        kbert (boolean, optional): whether to build K-BERT sentence trees
+        tokenizer (Tokenizer, optional): a tokenizer to share
+        shuffle_buffer (int, optional): if positive, shuffle the stream
+            through a buffer of this many pairs
+        pack (boolean, optional): pack several pairs per sequence (see
+            DittoDataset.pack_batch)
+        chunk_size (int, optional): the number of bytes read at once
+    """
+    encode = DittoDataset.encode
+    pad = DittoDataset.pad
+    pack_batch = DittoDataset.pack_batch
+    add_knowledge_with_vm = DittoDataset.add_knowledge_with_vm
+    add_knowledge_batch = DittoDataset.add_knowledge_batch
+    make_token_augmenter = DittoDataset.make_token_augmenter
+
+    def __init__(self,
+                 path,
+                 max_len=256,
+                 size=None,
+                 lm='roberta',
+                 da=None,
+                 kbert=False,
+                 tokenizer=None,
+                 shuffle_buffer=0,
+                 pack=False,
+                 chunk_size=1 << 20):
+        if tokenizer is None:
+            tokenizer = get_ditto_tokenizer(lm)
+        self.tokenizer = tokenizer
+        self.path = path
+        self.max_len = max_len
+        self.size = size
+        self.kbert = kbert
+        self.da = da
+        self.shuffle_buffer = shuffle_buffer
+        self.pack = pack
+        self.chunk_size = chunk_size
+        self.augmenter = Augmenter() if da is not None else None
+        self.token_augmenter = self.make_token_augmenter()
+        self.jsonl = path.endswith('.jsonl')
+
+    def count(self):
+        """Count the pairs of the stream (up to size) without parsing them.
+
+        As in __iter__, the blank lines are skipped and a last line without
+        a newline is a pair.
+        """
+        total = 0
+        with open(self.path, 'rb') as fin:
+            for line in fin:
+                if line.strip() != b'':
+                    total += 1
+                    if self.size is not None and total >= self.size:
+                        break
+        return total
+
+    def lines(self):
+        """Yield the raw lines of the file, reading it in chunks."""
+        with open(self.path, encoding='utf-8') as fin:
+            while True:
+                chunk = fin.readlines(self.chunk_size)
+                if len(chunk) == 0:
+                    break
+                yield from chunk
+
+    def parse(self, line):
+        """Parse a line into a (left, right, label) triple."""
+        if self.jsonl:
+            row = json.loads(line)
+            label = int(row[2]) if len(row) > 2 else 0
+            return serialize_entry(row[0]), serialize_entry(row[1]), label
+        s1, s2, label = line.strip().split('\t')
+        return s1, s2, int(label)
+
+    def __iter__(self):
+        lines = (line for line in self.lines() if line.strip() != '')
+        lines = itertools.islice(lines, self.size)
+
+        # shard the lines over the DataLoader workers
+        worker = data.get_worker_info()
+        if worker is not None:
+            lines = itertools.islice(lines, worker.id, None, worker.num_workers)
+
+        rows = (self.parse(line) for line in lines)
+        if self.shuffle_buffer > 0:
+            rows = self.shuffled(rows)
+
+        for left, right, label in rows:
+            yield self.encode(left, right, label)
+
+    def shuffled(self, rows):
+        """Approximately shuffle a stream with a bounded buffer."""
+        buffer = []
+        for row in rows:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(row)
+                continue
+            idx = random.randrange(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = row
+        random.shuffle(buffer)
+        yield from buffer
@@ -0,0 +1,130 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from .dataset import DittoDataset
+from .loader import make_loader
+
+
+def soft_cross_entropy(logits, target, temperature=1.0):
+    """The cross entropy of logits against soft match probabilities.
+
+    The logits are softened by the temperature and the loss is scaled by its
+    square, so the gradients keep the same magnitude for any temperature.
+
+    Args:
+        logits (Tensor): the logits of the student, (batch_size, 2)
+        target (FloatTensor): the target match probabilities, (batch_size,)
+        temperature (float, optional): the distillation temperature
+
+    Returns:
+        Tensor: the mean loss
+    """
+    log_probs = F.log_softmax(logits.float() / temperature, dim=1)
+    loss = -(target * log_probs[:, 1] + (1.0 - target) * log_probs[:, 0])
+    return loss.mean() * temperature ** 2
+
+
+def checkpoint_num_layers(state_dict):
+    """Return the number of layers of the RobertaWithVM of a DittoModel state
+    (None for the other LMs)."""
+    layers = [int(key.split('.')[3]) for key in state_dict
+              if key.startswith('bert.encoder.layer.')]
+    return max(layers) + 1 if layers else None
+
+
+def unlabeled_lines(path, size=None):
+    """Read candidate pairs as the lines of unlabeled pairs.
+
+    Args:
+        path (str): a file in the format of the task files (left \\t right
+            \\t label); the labels are ignored
+        size (int, optional): the max number of pairs
+
+    Returns:
+        list of str: the "left \\t right \\t -1" lines
+    """
+    lines = []
+    with open(path, encoding='utf-8') as fin:
+        for line in fin:
+            if size is not None and len(lines) >= size:
+                break
+            left, right = line.rstrip('\n').split('\t')[:2]
+            lines.append('%s\t%s\t-1' % (left, right))
+    return lines
+
+
+def teacher_probs(teacher, lines, lm, max_len=256, batch_size=256,
+                  temperature=1.0, kbert=False):
+    """Score pairs with a teacher model.
+
+    Args:
+        teacher (DittoModel): the trained teacher
+        lines (list of str): the pairs (left \\t right \\t label)
+        lm (str): the language model of the teacher (for its tokenizer)
+        max_len (int, optional): the max sequence length
+        batch_size (int, optional): the batch size
+        temperature (float, optional): the temperature of the softmax
+        kbert (boolean, optional): feed the K-BERT inputs to the teacher
+
+    Returns:
+        np.ndarray: the softened match probability of every pair (float32)
+    """
+    dataset = DittoDataset(lines, lm=lm, max_len=max_len, kbert=kbert)
+    iterator = make_loader(dataset,
+                           batch_size=batch_size,
+                           shuffle=False,
+                           collate_fn=dataset.pad)
+    teacher.eval()
+    all_probs = []
+    with torch.no_grad():
+        for batch in iterator:
+            if len(batch) == 4:
+                x, position_ids, vm, _ = batch
+                logits = teacher(x, vm=vm, position_ids=position_ids)
+            else:
+                x, _ = batch
+                logits = teacher(x)
+            all_probs.append((logits.float() / temperature).softmax(dim=1)[:, 1].cpu())
+    return torch.cat(all_probs).numpy().astype(np.float32)
+
+
+def distillation_loss(logits, target, temperature=1.0, alpha=0.5):
+    """The distillation loss of a batch: alpha * T^2 * CE(teacher_T, student_T)
+    + (1 - alpha) * CE(y, student_1).
+
+    The soft term (see soft_cross_entropy) is averaged over all the pairs,
+    the hard term over the labeled ones only; a batch without labeled pairs
+    only has the soft term.
+
+    Args:
+        logits (Tensor): the logits of the student, (batch_size, 2)
+        target (FloatTensor): the teacher's match probability at the
+            temperature and the 0/1 label (-1 if unlabeled) of every pair,
+            (batch_size, 2) (see distillation_labels)
+        temperature (float, optional): the distillation temperature
+        alpha (float, optional): the weight of the teacher
+
+    Returns:
+        Tensor: the loss
+    """
+    loss = alpha * soft_cross_entropy(logits, target[:, 0], temperature)
+    labels = target[:, 1].long()
+    labeled = labels >= 0
+    if labeled.any():
+        loss = loss + (1.0 - alpha) * F.cross_entropy(logits[labeled].float(), labels[labeled])
+    return loss
+
+
+def distillation_labels(probs, labels):
+    """Pair the teacher's probabilities with the labels (the soft labels of a
+    DittoDataset, see distillation_loss).
+
+    Args:
+        probs (np.ndarray): the teacher's match probabilities
+        labels (np.ndarray): the 0/1 labels (-1 for the unlabeled pairs)
+
+    Returns:
+        np.ndarray: the (prob, label) of every pair, (num_pairs, 2) (float32)
+    """
+    return np.stack([probs, labels], axis=1).astype(np.float32)
@@ -0,0 +1,140 @@
+import contextlib
+import os
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from torch.utils import data
+
+
+def is_distributed():
+    """Whether the process is part of an initialized process group."""
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    """Return the global rank of the process (0 without a process group)."""
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    """Return the number of processes (1 without a process group)."""
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    """Whether the process is rank 0 (always true without a process group)."""
+    return get_rank() == 0
+
+
+def init_distributed(rank, world_size, init_file, backend='gloo'):
+    """Join the process group through a rendezvous file.
+
+    Args:
+        rank (int): the global rank of the process
+        world_size (int): the total number of processes (over all the nodes)
+        init_file (str): the rendezvous file; it must be on a file system
+            shared by all the nodes and must not exist before the first
+            process starts
+        backend (str, optional): the backend ('gloo' runs on CPUs)
+    """
+    dist.init_process_group(backend,
+                            init_method='file://' + os.path.abspath(init_file),
+                            rank=rank,
+                            world_size=world_size)
+
+
+def cleanup_distributed():
+    """Leave the process group, if any."""
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+@contextlib.contextmanager
+def main_process_first():
+    """Run a block on rank 0 first, e.g., to build files shared by all ranks.
+
+    The other ranks wait for rank 0 to leave the block before entering it, so
+    they find the files (caches, augmentation stores, ...) it wrote.
+    """
+    if is_distributed() and not is_main_process():
+        dist.barrier()
+    yield
+    if is_distributed() and is_main_process():
+        dist.barrier()
+
+
+def all_gather(array):
+    """Concatenate a numpy array over all the ranks, in rank order.
+
+    The arrays may have different lengths (but the same trailing shape and
+    dtype). Without a process group, the array is returned as is.
+
+    Args:
+        array (np.ndarray): the array of this rank
+
+    Returns:
+        np.ndarray: the arrays of all the ranks, concatenated
+    """
+    if not is_distributed():
+        return array
+    world_size = get_world_size()
+    tensor = torch.from_numpy(np.ascontiguousarray(array))
+
+    sizes = [torch.zeros(1, dtype=torch.int64) for _ in range(world_size)]
+    dist.all_gather(sizes, torch.tensor([len(tensor)], dtype=torch.int64))
+    sizes = [int(size) for size in sizes]
+
+    # all_gather needs tensors of the same shape on every rank
+    padded = tensor.new_zeros((max(sizes),) + tuple(tensor.shape[1:]))
+    padded[:len(tensor)] = tensor
+    gathered = [torch.empty_like(padded) for _ in range(world_size)]
+    dist.all_gather(gathered, padded)
+    return np.concatenate([part[:size].numpy()
+                           for part, size in zip(gathered, sizes)])
+
+
+def gather_shards(array):
+    """Gather the outputs of the shards of all the ranks in dataset order.
+
+    Every rank holds the outputs of its shard (see DatasetShard), i.e., of
+    the examples rank, rank + world_size, ...; they are all-gathered and
+    put back in the order of the examples.
+
+    Args:
+        array (np.ndarray): the outputs of the shard of this rank
+
+    Returns:
+        np.ndarray: the outputs of all the examples
+    """
+    gathered = all_gather(array)
+    world_size = get_world_size()
+    order = np.concatenate([np.arange(rank, len(gathered), world_size)
+                            for rank in range(world_size)])
+    outputs = np.empty_like(gathered)
+    outputs[order] = gathered
+    return outputs
+
+
+class DatasetShard(data.Subset):
+    """The examples rank, rank + world_size, rank + 2 * world_size, ... of a
+    dataset.
+
+    Unlike DistributedSampler, no example is repeated to even out the shards,
+    so the outputs gathered from all the ranks are exactly the dataset's
+    (used for evaluation).
+
+    Args:
+        dataset (Dataset): the dataset
+        rank (int, optional): the shard (the current rank by default)
+        world_size (int, optional): the number of shards
+    """
+    def __init__(self, dataset, rank=None, world_size=None):
+        rank = get_rank() if rank is None else rank
+        world_size = get_world_size() if world_size is None else world_size
+        super().__init__(dataset, range(rank, len(dataset), world_size))
+
+    def lengths(self):
+        """Return the token length of every example of the shard."""
+        lengths = np.asarray(self.dataset.lengths())
+        return lengths[np.asarray(self.indices, dtype=np.int64)]
@@ -10,94 +10,344 @@ import sklearn.metrics as metrics
 import argparse
 
 from .dataset import DittoDataset
+from .sampler import BucketBatchSampler
+from .loader import make_loader
+from .threshold import best_threshold, f1_at
+from .checkpoint import CheckpointWriter, load_checkpoint, rng_state, set_rng_state, snapshot
+from .distributed import DatasetShard, all_gather, get_rank, get_world_size, \
+    is_distributed, is_main_process
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils import data
+from torch.utils.data.distributed import DistributedSampler
 from transformers import AutoModel, AdamW, RobertaModel, get_linear_schedule_with_warmup
 from tensorboardX import SummaryWriter
-# from apex import amp
 from .models import RobertaWithVM
+from .distill import distillation_loss
+from .biencoder import split_pairs
 
 lm_mp = {'roberta': 'roberta-base',
          'distilbert': 'distilbert-base-uncased'}
 
+# the autocast dtype of each precision mode (None: full precision)
+precision_dtypes = {'fp32': None,
+                    'bf16': torch.bfloat16,
+                    'fp16': torch.float16}
+
+
+def autocast(device, precision='fp32'):
+    """Return the torch.autocast context of a precision mode.
+
+    Args:
+        device (str): the device the model runs on ('cpu' or 'cuda')
+        precision (str, optional): 'fp32', 'bf16' or 'fp16'; the CPU
+            autocast runs fp16 as bf16
+
+    Returns:
+        torch.autocast: the autocast context (disabled for fp32)
+    """
+    device_type = 'cuda' if 'cuda' in str(device) else 'cpu'
+    dtype = precision_dtypes[precision]
+    if dtype == torch.float16 and device_type == 'cpu':
+        dtype = torch.bfloat16
+    return torch.autocast(device_type, dtype=dtype, enabled=dtype is not None)
+
+
+def get_precision(hp):
+    """Return the precision mode of a run (--fp16 is a shortcut for fp16)."""
+    return 'fp16' if hp.fp16 else hp.precision
+
 class DittoModel(nn.Module):
-    """A baseline model for EM."""
+    """A baseline model for EM.
+
+    With exit_layers, a classifier is added on the CLS token of each of these
+    layers of the LM (1-based). The heads are trained jointly with the final
+    classifier (see train_step) and, once exit_thresholds is set (see
+    early_exit.calibrate_exits), a pair stops at the first layer whose head
+    is confident enough (see DittoModel.early_exit).
+
+    With num_layers, only this many evenly spaced layers of the LM are kept
+    (always the first and the last), e.g., for the students of a
+    distillation (see distill.py).
+
+    With bi_encoder, a bi-encoder head is added: the two entries of a pair
+    are encoded separately (see embed) and their CLS embeddings u and v are
+    classified by an MLP over (u, v, |u-v|, u*v) (see bi_logits). It is
+    trained jointly with the cross-encoder (see train_step) and scores pairs
+    from cached entity embeddings (see biencoder.BiEncoder).
+    """
 
-    def __init__(self, device='cuda', lm='roberta', alpha_aug=0.8):
+    def __init__(self, device='cuda', lm='roberta', alpha_aug=0.8, precision='fp32',
+                 attn='eager', attn_dropout=None, exit_layers=None, num_layers=None,
+                 bi_encoder=False):
         super().__init__()
         # self.enc_history = []
-        if lm in lm_mp:
+        if lm == 'roberta':
             # self.bert = RobertaModel.from_pretrained(lm_mp[lm])
             # self.bert = AutoModel.from_pretrained(lm_mp[lm])
             self.bert = RobertaWithVM.from_pretrained(lm_mp[lm])
+        elif lm in lm_mp:
+            # e.g., distilbert: no position_ids, K-BERT or packing
+            self.bert = AutoModel.from_pretrained(lm_mp[lm])
         else:
             self.bert = AutoModel.from_pretrained(lm)
 
+        # 'sdpa': fused attention with a boolean mask, see RobertaWithVM
+        if attn != 'eager' or attn_dropout is not None:
+            if not hasattr(self.bert, 'set_attention'):
+                raise ValueError('attn=%s is only supported by RobertaWithVM' % attn)
+            self.bert.set_attention(attn)
+            if attn_dropout is not None:
+                self.bert.set_attention_dropout(attn_dropout)
+
+        if num_layers is not None and num_layers != self.bert.config.num_hidden_layers:
+            if not isinstance(self.bert, RobertaWithVM):
+                raise ValueError('num_layers is only supported by RobertaWithVM')
+            layers = self.bert.encoder.layer
+            if not 1 <= num_layers <= len(layers):
+                raise ValueError('num_layers must be in [1, %d]' % len(layers))
+            keep = np.linspace(0, len(layers) - 1, num_layers).round().astype(int)
+            self.bert.encoder.layer = nn.ModuleList([layers[int(i)] for i in keep])
+            self.bert.config.num_hidden_layers = num_layers
+
         self.device = device
         self.alpha_aug = alpha_aug
+        self.precision = precision
+        # RoBERTa numbers the positions from padding_idx + 1
+        self.position_offset = getattr(self.bert.embeddings, 'padding_idx', -1) + 1
 
         # linear layer
         hidden_size = self.bert.config.hidden_size
         self.fc = torch.nn.Linear(hidden_size, 2)
 
-
-    def forward(self, x1, x2=None, vm=None, position_ids=None, save=False):
+        # the early-exit heads, by layer
+        self.exit_layers = sorted(exit_layers) if exit_layers else []
+        if self.exit_layers:
+            num_layers = self.bert.config.num_hidden_layers
+            if not hasattr(self.bert, 'layer_attention_mask'):
+                raise ValueError('exit_layers are only supported by RobertaWithVM')
+            if self.exit_layers[0] < 1 or self.exit_layers[-1] >= num_layers:
+                raise ValueError('the exit layers must be in [1, %d)' % num_layers)
+        self.exit_heads = nn.ModuleDict({str(layer): nn.Linear(hidden_size, 2)
+                                         for layer in self.exit_layers})
+        # the min confidence of each exit head, set by calibration
+        self.exit_thresholds = None
+
+        # the interaction MLP of the bi-encoder
+        self.bi_head = None
+        if bi_encoder:
+            self.bi_head = nn.Sequential(nn.Linear(4 * hidden_size, hidden_size),
+                                         nn.ReLU(),
+                                         nn.Linear(hidden_size, 2))
+
+
+    def forward(self, x1, x2=None, vm=None, position_ids=None, save=False,
+                segments=None, cls_index=None, exits=False, bi=False):
         """Encode the left, right, and the concatenation of left+right.
 
         Args:
             x1 (LongTensor): a batch of ID's
             x2 (LongTensor, optional): a batch of ID's (augmented)
+            segments (LongTensor, optional): the pair index of every token
+                of a packed batch (see DittoDataset.pack_batch); the
+                position_ids then restart at 0 with every pair
+            cls_index (LongTensor, optional): the (row, column) of the CLS
+                token of every pair of a packed batch
+            exits (boolean, optional): also return the logits of the exit
+                heads (a list, in the order of exit_layers)
+            bi (boolean, optional): also return the logits of the bi-encoder
+                on the entries of the (plain) pairs of x1, after the exit
+                logits if any
 
         Returns:
             Tensor: binary prediction
         """
+        if self.exit_thresholds is not None and not self.training and \
+           not exits and not bi and not save and x2 is None and segments is None:
+            return self.early_exit(x1, vm=vm, position_ids=position_ids)
+
         import inspect
         frame = inspect.currentframe()
         while frame:
             # print(frame.f_code.co_filename, frame.f_lineno)
             frame = frame.f_back
 
-        x1 = x1.to(self.device) # (batch_size, seq_len)
+        x1 = x1.to(self.device, non_blocking=True) # (batch_size, seq_len)
         # print('what is x1 dimension')
         # print(x1.size())
-        if x2 is not None:
-            # MixDA
-            x2 = x2.to(self.device) # (batch_size, seq_len)
-
-            enc = self.bert(torch.cat((x1, x2)), attention_mask=vm, position_ids=position_ids)[0][:, 0, :]
-            batch_size = len(x1)
-            enc1 = enc[:batch_size] # (batch_size, emb_size)
-            enc2 = enc[batch_size:] # (batch_size, emb_size)
-
-            aug_lam = np.random.beta(self.alpha_aug, self.alpha_aug)
-            enc = enc1 * aug_lam + enc2 * (1.0 - aug_lam)
-        else:
-            # print(vm)
-            # raise NotImplementedError
-            if vm is not None and position_ids is not None:
-                vm, position_ids = vm.to(self.device), position_ids.to(self.device)
-            enc = self.bert(x1, attention_mask=vm, position_ids=position_ids)[0][:, 0, :]
+        # the encoder runs under autocast, the classifier in full precision
+        with autocast(self.device, self.precision):
+            if x2 is not None:
+                # MixDA
+                x2 = x2.to(self.device, non_blocking=True) # (batch_size, seq_len)
+
+                out = self.encode(torch.cat((x1, x2)), attention_mask=vm, position_ids=position_ids,
+                                  output_hidden_states=exits)
+                batch_size = len(x1)
+                aug_lam = np.random.beta(self.alpha_aug, self.alpha_aug)
+
+                def pool(hidden):
+                    enc = hidden[:, 0, :]
+                    enc1 = enc[:batch_size] # (batch_size, emb_size)
+                    enc2 = enc[batch_size:] # (batch_size, emb_size)
+                    return enc1 * aug_lam + enc2 * (1.0 - aug_lam)
+            elif segments is not None:
+                # packed pairs: block-diagonal attention, one CLS per pair
+                if not isinstance(self.bert, RobertaWithVM):
+                    raise ValueError('packed pairs are only supported by RobertaWithVM')
+                segments = segments.to(self.device, non_blocking=True)
+                position_ids = position_ids.to(self.device, non_blocking=True) + self.position_offset
+                cls_index = cls_index.to(self.device, non_blocking=True)
+                mask = segments.unsqueeze(2) == segments.unsqueeze(1)
+                out = self.bert(x1, attention_mask=mask, position_ids=position_ids,
+                                output_hidden_states=exits)
+
+                def pool(hidden):
+                    return hidden[cls_index[:, 0], cls_index[:, 1]]
+            else:
+                # print(vm)
+                # raise NotImplementedError
+                if vm is not None and not isinstance(self.bert, RobertaWithVM):
+                    raise ValueError('K-BERT inputs are only supported by RobertaWithVM')
+                if vm is not None and position_ids is not None:
+                    vm = vm.to(self.device, non_blocking=True)
+                    position_ids = position_ids.to(self.device, non_blocking=True)
+                if vm is not None and vm.dim() == 2:
+                    # compact visibility groups, expanded inside RobertaWithVM
+                    out = self.bert(x1, vm=vm, position_ids=position_ids,
+                                    output_hidden_states=exits)
+                else:
+                    out = self.encode(x1, attention_mask=vm, position_ids=position_ids,
+                                      output_hidden_states=exits)
+
+                def pool(hidden):
+                    return hidden[:, 0, :]
+            enc = pool(out[0])
+            if exits:
+                # hidden_states[0] is the output of the embeddings
+                exit_encs = [pool(out.hidden_states[layer]) for layer in self.exit_layers]
+        enc = enc.float()
         # print(f'enc dimension is {enc.size()}')
         if save is True:
             # raise NotImplementedError
             self.enc = enc.detach().cpu().numpy()
             # print(self.enc)
-        return self.fc(enc) # .squeeze() # .sigmoid()
+        logits = self.fc(enc) # .squeeze() # .sigmoid()
+        outputs = [logits]
+        if exits:
+            outputs.append([self.exit_heads[str(layer)](exit_enc.float())
+                            for layer, exit_enc in zip(self.exit_layers, exit_encs)])
+        if bi:
+            if segments is not None:
+                raise ValueError('the bi-encoder does not support packed pairs')
+            left_x, left_mask, right_x, right_mask = split_pairs(x1)
+            outputs.append(self.bi_logits(self.embed(left_x, left_mask),
+                                          self.embed(right_x, right_mask)))
+        return tuple(outputs) if len(outputs) > 1 else logits
+
+    def encode(self, x, **kwargs):
+        """Run the LM, leaving out the unset arguments (e.g., the position_ids,
+        which DistilBERT does not take)."""
+        return self.bert(x, **{k: v for k, v in kwargs.items() if v is not None})
+
+    def embed(self, x, attention_mask):
+        """Encode a batch of single entries (the bi-encoder).
+
+        Args:
+            x (LongTensor): the ID's of the entries, (batch_size, seq_len)
+            attention_mask (LongTensor): the padding mask
+
+        Returns:
+            Tensor: the CLS embeddings, (batch_size, hidden_size)
+        """
+        x = x.to(self.device, non_blocking=True)
+        attention_mask = attention_mask.to(self.device, non_blocking=True)
+        with autocast(self.device, self.precision):
+            out = self.encode(x, attention_mask=attention_mask)
+        return out[0][:, 0, :].float()
+
+    def bi_logits(self, u, v):
+        """Classify pairs from the embeddings of their entries (see embed)."""
+        return self.bi_head(torch.cat([u, v, (u - v).abs(), u * v], dim=1))
 
+    def early_exit(self, x1, vm=None, position_ids=None):
+        """Classify a batch, stopping every pair at its first confident exit.
 
-def evaluate(model, iterator, threshold=None):
+        The encoder is run layer by layer. After each exit layer, the pairs
+        whose head's max probability reaches exit_thresholds[layer] take its
+        logits and leave the batch, so the following layers only run on the
+        remaining pairs. The exit layer of every pair is kept in
+        self.exit_layer (the number of layers if it went through all of them).
+
+        Args:
+            x1 (LongTensor): a batch of ID's
+            vm (Tensor, optional): the K-BERT visibility groups or matrices
+            position_ids (LongTensor, optional): the K-BERT soft positions
+
+        Returns:
+            Tensor: binary prediction
+        """
+        x1 = x1.to(self.device, non_blocking=True)
+        if vm is not None and position_ids is not None:
+            vm = vm.to(self.device, non_blocking=True)
+            position_ids = position_ids.to(self.device, non_blocking=True)
+        groups = None
+        if vm is not None and vm.dim() == 2:
+            groups, vm = vm, None
+
+        layers = self.bert.encoder.layer
+        logits = torch.empty((len(x1), 2), device=x1.device)
+        exit_layer = torch.full((len(x1),), len(layers), dtype=torch.long, device=x1.device)
+        remaining = torch.arange(len(x1), device=x1.device)
+        with autocast(self.device, self.precision):
+            mask = self.bert.layer_attention_mask(vm, x1.shape, x1.device,
+                                                  vm=groups,
+                                                  position_ids=position_ids)
+            hidden = self.bert.embeddings(input_ids=x1, position_ids=position_ids)
+
+        for layer, module in enumerate(layers, 1):
+            with autocast(self.device, self.precision):
+                hidden = module(hidden, attention_mask=mask)[0]
+            if str(layer) not in self.exit_heads:
+                continue
+            layer_logits = self.exit_heads[str(layer)](hidden[:, 0, :].float())
+            done = layer_logits.softmax(dim=1).max(dim=1).values >= self.exit_thresholds[layer]
+            if done.any():
+                logits[remaining[done]] = layer_logits[done]
+                exit_layer[remaining[done]] = layer
+                keep = ~done
+                hidden, remaining = hidden[keep], remaining[keep]
+                if mask is not None and mask.size(0) > 1:
+                    mask = mask[keep]
+                if len(remaining) == 0:
+                    break
+
+        if len(remaining) > 0:
+            logits[remaining] = self.fc(hidden[:, 0, :].float())
+        self.exit_layer = exit_layer
+        return logits
+
+
+def evaluate(model, iterator, threshold=None, min_precision=None, min_recall=None):
     """Evaluate a model on a validation/test dataset
 
+    With a process group, every rank evaluates a shard of the dataset (see
+    distributed.DatasetShard) and the scores are gathered, so all the ranks
+    return the same F1 score and threshold.
+
     Args:
         model (DMModel): the EM model
         iterator (Iterator): the valid/test dataset iterator
         threshold (float, optional): the threshold on the 0-class
+        min_precision (float, optional): constrain the tuned threshold to
+            this precision (see threshold.best_threshold)
+        min_recall (float, optional): constrain the tuned threshold to
+            this recall
 
     Returns:
         float: the F1 score
         float (optional): if threshold is not provided, the threshold
             value that gives the optimal F1
     """
-    all_p = []
     all_y = []
     all_probs = []
     with torch.no_grad():
@@ -110,80 +360,113 @@ def evaluate(model, iterator, threshold=None):
                 # visible_matrix_batch, position_batch = visible_matrix_batch.to(model.device), position_batch.to(model.device)
                 logits = model(x, vm=visible_matrix_batch, position_ids=position_batch)
                 del position_batch, visible_matrix_batch
+            elif len(batch) == 5:
+                # packed pairs, see DittoDataset.pack_batch
+                x, positions, segments, cls_index, y = batch
+                logits = model(x, position_ids=positions, segments=segments, cls_index=cls_index)
             
-            probs = logits.softmax(dim=1)[:, 1]
-            all_probs += probs.cpu().numpy().tolist()
-            all_y += y.cpu().numpy().tolist()
+            all_probs.append(logits.softmax(dim=1)[:, 1])
+            all_y.append(y)
+
+    # a single device-to-host copy for the whole set
+    all_probs = torch.cat(all_probs).cpu().numpy()
+    all_y = torch.cat(all_y).numpy()
+    # with a process group, every rank scored a shard of the set
+    all_probs = all_gather(all_probs)
+    all_y = all_gather(all_y)
 
     if threshold is not None:
-        pred = [1 if p > threshold else 0 for p in all_probs]
-        f1 = metrics.f1_score(all_y, pred)
-        return f1
+        return f1_at(all_probs, all_y, threshold)
     else:
-        best_th = 0.5
-        f1 = 0.0 # metrics.f1_score(all_y, all_p)
-
-        for th in np.arange(0.0, 1.0, 0.05):
-            pred = [1 if p > th else 0 for p in all_probs]
-            new_f1 = metrics.f1_score(all_y, pred)
-            if new_f1 > f1:
-                f1 = new_f1
-                best_th = th
-
-        return f1, best_th
+        return best_threshold(all_probs, all_y,
+                              min_precision=min_precision,
+                              min_recall=min_recall)
 
 
-def train_step(train_iter, model, optimizer, scheduler, hp):
+def train_step(train_iter, model, optimizer, scheduler, hp, scaler=None,
+               callback=None):
     """Perform a single training step
 
     Args:
         train_iter (Iterator): the train data loader
-        model (DMModel): the model
+        model (DMModel): the model (or its DistributedDataParallel wrapper)
         optimizer (Optimizer): the optimizer (Adam or AdamW)
         scheduler (LRScheduler): learning rate scheduler
-        hp (Namespace): other hyper-parameters (e.g., fp16)
+        hp (Namespace): other hyper-parameters (e.g., fp16, exit_weight,
+            temperature, distill_alpha, bi_weight)
+        scaler (GradScaler, optional): the loss scaler of fp16 training
+        callback (function, optional): called after every optimizer step;
+            the epoch is interrupted if it returns True
 
     Returns:
-        None
+        boolean: whether the callback interrupted the epoch
     """
     criterion = nn.CrossEntropyLoss()
     # criterion = nn.MSELoss()
+    # the model may be wrapped in DistributedDataParallel
+    device = getattr(model, 'module', model).device
+    # the exit heads are trained with the final classifier
+    exits = len(getattr(model, 'module', model).exit_layers) > 0
+    # so is the bi-encoder, on the plain and MixDA batches
+    bi_encoder = getattr(model, 'module', model).bi_head is not None
     for i, batch in enumerate(train_iter):
         # print(len(batch))
         optimizer.zero_grad()
 
+        bi = bi_encoder and len(batch) in (2, 3)
         if len(batch) == 2:
             x,y = batch
-            prediction = model(x)         
+            prediction = model(x, exits=exits, bi=bi)
         elif len(batch) == 4:
-            # x, self.labels[idx],know_sent_batch,position_batch,visible_matrix_batch,seg_batch
+            # the sentence trees, their soft positions and visibility groups,
+            # fed as in evaluate so that training sees the same inputs
             x, position_batch, visible_matrix_batch, y = batch
-            # print(visible_matrix_batch.shape)
-            # raise NotImplementedError
-            # visible_matrix_batch, position_batch = visible_matrix_batch.to(model.device), position_batch.to(model.device)
-            # prediction = model(x, vm=visible_matrix_batch, position_ids=position_batch) #TODO pass know_sent_batch,position_batch,visible_matrix_batch,seg_batch with x to the model 
-            prediction = model(x, vm=None, position_ids=None) #TODO pass know_sent_batch,position_batch,visible_matrix_batch,seg_batch with x to the model 
+            prediction = model(x, vm=visible_matrix_batch, position_ids=position_batch,
+                               exits=exits)
             del position_batch, visible_matrix_batch
+        elif len(batch) == 5:
+            # packed pairs, see DittoDataset.pack_batch
+            x, positions, segments, cls_index, y = batch
+            prediction = model(x, position_ids=positions, segments=segments, cls_index=cls_index,
+                               exits=exits)
 
         else:
             x1, x2, y = batch
-            prediction = model(x1, x2)
-
-        loss = criterion(prediction, y.to(model.device))
-
-        if hp.fp16:
-            with amp.scale_loss(loss, optimizer) as scaled_loss:
-                scaled_loss.backward()
+            prediction = model(x1, x2, exits=exits, bi=bi)
+
+        y = y.to(device, non_blocking=True)
+        if y.is_floating_point():
+            # the soft labels of a distillation
+            criterion = lambda logits, y: distillation_loss(logits, y, hp.temperature,
+                                                            hp.distill_alpha)
+        if exits or bi:
+            prediction, *outputs = prediction
+        loss = criterion(prediction, y)
+        if exits:
+            # the mean loss of the heads, weighted against the final one
+            exit_logits = outputs.pop(0)
+            loss = loss + hp.exit_weight * sum(criterion(logits, y) for logits in exit_logits) / len(exit_logits)
+        if bi:
+            loss = loss + hp.bi_weight * criterion(outputs.pop(0), y)
+
+        if scaler is not None:
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
         else:
             loss.backward()
-        optimizer.step()
+            optimizer.step()
         scheduler.step()
         if i % 10 == 0: # monitoring
             print(f"step: {i}, loss: {loss.item()}")
         del loss
+
+        if callback is not None and callback():
+            return True
+    return False
         
 
-def train(trainset, validset, testset, run_tag, hp):
+def train(trainset, validset, testset, run_tag, hp, callback=None):
     """Train and evaluate the model
 
     Args:
@@ -193,27 +476,91 @@ def train(trainset, validset, testset, run_tag, hp):
         run_tag (str): the tag of the run
         hp (Namespace): Hyper-parameters (e.g., batch_size,
                         learning rate, fp16)
+        callback (function, optional): called after every evaluation with
+            the name ('epoch' or 'step'), the epoch or step, the dev F1 and
+            the test F1 (None if not evaluated); the training stops if it
+            returns True (on every rank, which all get the same scores)
+
+    If a process group is initialized (see distributed.py), every process
+    trains on a shard of the training set with the gradients all-reduced
+    through DistributedDataParallel, the evaluation is spread over the ranks,
+    and only rank 0 writes the logs and checkpoints.
 
     Returns:
-        None
+        DittoModel: the trained model, restored to its best dev F1 state
+            if save_model is set
     """
     padder = trainset.pad
+    distributed = is_distributed()
+    shard_args = {}
+    if distributed:
+        if isinstance(trainset, data.IterableDataset):
+            raise ValueError('a streamed training set cannot be distributed')
+        shard_args = {'num_replicas': get_world_size(),
+                      'rank': get_rank(),
+                      'seed': hp.run_id}
+        # every rank evaluates a shard of the valid/test sets
+        validset = DatasetShard(validset)
+        testset = DatasetShard(testset)
+    # worker processes, seeded from the run_id, and pinned batches for the GPU
+    pin_memory = hp.device != 'cpu' and torch.cuda.is_available()
+    loader_args = {'num_workers': hp.num_workers,
+                   'seed': hp.run_id,
+                   'pin_memory': pin_memory,
+                   'collate_fn': padder}
+    # the training workers live across epochs; the valid/test loaders are
+    # only iterated once per evaluation and release theirs
+    train_args = dict(loader_args, persistent=True)
+
     # create the DataLoaders
-    train_iter = data.DataLoader(dataset=trainset,
+    if isinstance(trainset, data.IterableDataset):
+        # streamed training set: shuffled through its own buffer
+        train_iter = make_loader(trainset,
                                  batch_size=hp.batch_size,
-                                 shuffle=True,
-                                 num_workers=0,
-                                 collate_fn=padder)
-    valid_iter = data.DataLoader(dataset=validset,
-                                 batch_size=hp.batch_size*16,
-                                 shuffle=False,
-                                 num_workers=0,
-                                 collate_fn=padder)
-    test_iter = data.DataLoader(dataset=testset,
+                                 **train_args)
+    if hp.bucket:
+        # batch pairs of similar length under a padded-token budget
+        eval_tokens = hp.max_tokens * 16 if hp.max_tokens is not None else None
+        if not isinstance(trainset, data.IterableDataset):
+            train_iter = make_loader(trainset,
+                                     batch_sampler=BucketBatchSampler(trainset.lengths(),
+                                                                      hp.batch_size,
+                                                                      max_tokens=hp.max_tokens,
+                                                                      shuffle=True,
+                                                                      **shard_args),
+                                     **train_args)
+        valid_iter = make_loader(validset,
+                                 batch_sampler=BucketBatchSampler(validset.lengths(),
+                                                                  hp.batch_size*16,
+                                                                  max_tokens=eval_tokens,
+                                                                  shuffle=False),
+                                 **loader_args)
+        test_iter = make_loader(testset,
+                                batch_sampler=BucketBatchSampler(testset.lengths(),
+                                                                 hp.batch_size*16,
+                                                                 max_tokens=eval_tokens,
+                                                                 shuffle=False),
+                                **loader_args)
+    else:
+        if distributed:
+            # the shards are padded to the same number of batches
+            train_iter = make_loader(trainset,
+                                     batch_size=hp.batch_size,
+                                     sampler=DistributedSampler(trainset, seed=hp.run_id),
+                                     **train_args)
+        elif not isinstance(trainset, data.IterableDataset):
+            train_iter = make_loader(trainset,
+                                     batch_size=hp.batch_size,
+                                     shuffle=True,
+                                     **train_args)
+        valid_iter = make_loader(validset,
                                  batch_size=hp.batch_size*16,
                                  shuffle=False,
-                                 num_workers=0,
-                                 collate_fn=padder)
+                                 **loader_args)
+        test_iter = make_loader(testset,
+                                batch_size=hp.batch_size*16,
+                                shuffle=False,
+                                **loader_args)
 
     # initialize model, optimizer, and LR scheduler
     # device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -221,60 +568,201 @@ def train(trainset, validset, testset, run_tag, hp):
         device = 'cpu'
     else:
         device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    precision = get_precision(hp)
     model = DittoModel(device=device,
                        lm=hp.lm,
-                       alpha_aug=hp.alpha_aug)
+                       alpha_aug=hp.alpha_aug,
+                       precision=precision,
+                       attn=hp.attn,
+                       attn_dropout=hp.attn_dropout,
+                       exit_layers=hp.exit_layers,
+                       num_layers=hp.num_layers,
+                       bi_encoder=hp.bi_encoder)
     model = model.to(device)
     optimizer = AdamW(model.parameters(), lr=hp.lr)
 
-    if hp.fp16:
-        model, optimizer = amp.initialize(model, optimizer, opt_level='O2')
-    num_steps = (len(trainset) // hp.batch_size) * hp.n_epochs
+    # fp16 gradients need loss scaling; bf16 has the range of fp32
+    scaler = None
+    if precision == 'fp16' and 'cuda' in device:
+        scaler = torch.cuda.amp.GradScaler()
+    if isinstance(trainset, data.IterableDataset):
+        num_steps = (trainset.count() // hp.batch_size) * hp.n_epochs
+    elif hp.bucket or distributed:
+        num_steps = len(train_iter) * hp.n_epochs
+    else:
+        num_steps = (len(trainset) // hp.batch_size) * hp.n_epochs
     scheduler = get_linear_schedule_with_warmup(optimizer,
                                                 num_warmup_steps=0,
                                                 num_training_steps=num_steps)
 
     # logging with tensorboardX
-    writer = SummaryWriter(log_dir=hp.logdir)
+    writer = SummaryWriter(log_dir=hp.logdir) if is_main_process() else None
 
     best_dev_f1 = best_test_f1 = 0.0
-    for epoch in range(1, hp.n_epochs+1):
-        # train
-        model.train()
-        train_step(train_iter, model, optimizer, scheduler, hp)
-
-        # eval
+    bad_evals = 0
+    step = 0
+    start_epoch = 1
+    best_state = None
+
+    # checkpoints are written in the background, see checkpoint.py
+    directory = os.path.join(hp.logdir, hp.task)
+    ckpt_writer = None
+    if is_main_process() and (hp.save_model or hp.keep_ckpts > 0):
+        ckpt_writer = CheckpointWriter(directory, keep=max(hp.keep_ckpts, 1))
+
+    # resume from the last checkpoint of the directory
+    resume_path = CheckpointWriter.latest(directory) if hp.resume else None
+    resume_rng = None
+    skip_batches = 0
+    if resume_path is not None:
+        resume = load_checkpoint(resume_path)
+        model.load_state_dict(resume['model'])
+        optimizer.load_state_dict(resume['optimizer'])
+        scheduler.load_state_dict(resume['scheduler'])
+        if scaler is not None and resume['scaler'] is not None:
+            scaler.load_state_dict(resume['scaler'])
+        start_epoch = resume['epoch'] + 1
+        if resume['batches'] is not None:
+            # written within the epoch: its first batches are replayed
+            # (without training) from the RNG states of its start
+            start_epoch = resume['epoch']
+            skip_batches = resume['batches']
+            resume_rng = resume['rng']
+        step = resume['step']
+        best_dev_f1 = resume['best_dev_f1']
+        best_test_f1 = resume['best_test_f1']
+        bad_evals = resume['bad_evals']
+        set_rng_state(resume['epoch_rng'] if resume_rng is not None else resume['rng'],
+                      train_iter)
+        best_path = os.path.join(directory, 'model.pt')
+        if hp.save_model and os.path.exists(best_path):
+            best_state = load_checkpoint(best_path)['model']
+        if is_main_process():
+            print(f"resuming from {resume_path} (epoch {resume['epoch']}, step {step})")
+        del resume
+
+    train_model = model
+    if distributed:
+        # all-reduce the gradients (the pooler of the LM is not used)
+        train_model = DistributedDataParallel(model, find_unused_parameters=True)
+
+    def validate(name, x):
+        """Evaluate on the valid set (and the test set), save the best model.
+
+        Returns True if training should stop early.
+        """
+        nonlocal best_dev_f1, best_test_f1, bad_evals, best_state
         model.eval()
-        dev_f1, th = evaluate(model, valid_iter)
-        test_f1 = evaluate(model, test_iter, threshold=th)
+        dev_f1, th = evaluate(model, valid_iter,
+                              min_precision=hp.min_precision,
+                              min_recall=hp.min_recall)
+        improved = dev_f1 > best_dev_f1 + hp.min_delta
 
-        if dev_f1 > best_dev_f1:
+        # the test score is only reported for the best dev score
+        test_f1 = None
+        if improved or not hp.test_on_improve:
+            test_f1 = evaluate(model, test_iter, threshold=th)
+
+        if improved:
             best_dev_f1 = dev_f1
             best_test_f1 = test_f1
+            bad_evals = 0
             if hp.save_model:
-                # create the directory if not exist
-                directory = os.path.join(hp.logdir, hp.task)
-                if not os.path.exists(directory):
-                    os.makedirs(directory)
-
                 # save the checkpoints for each component
-                ckpt_path = os.path.join(hp.logdir, hp.task, 'model.pt')
                 ckpt = {'model': model.state_dict(),
                         'optimizer': optimizer.state_dict(),
                         'scheduler': scheduler.state_dict(),
                         'epoch': epoch}
-                torch.save(ckpt, ckpt_path)
+                if ckpt_writer is not None:
+                    best_state = ckpt_writer.save(ckpt, 'model.pt')['model']
+                else:
+                    # only rank 0 writes the checkpoints
+                    best_state = snapshot(model.state_dict())
+        else:
+            bad_evals += 1
 
+        # logging
+        if is_main_process():
+            print(f"{name} {x}: dev_f1={dev_f1}, f1={test_f1}, best_f1={best_test_f1}")
+            scalars = {'f1': dev_f1}
+            if test_f1 is not None:
+                scalars['t_f1'] = test_f1
+            writer.add_scalars(run_tag, scalars, x)
 
-        print(f"epoch {epoch}: dev_f1={dev_f1}, f1={test_f1}, best_f1={best_test_f1}")
+        model.train()
+        if hp.patience is not None and bad_evals >= hp.patience:
+            if is_main_process():
+                print(f"early stopping: no dev_f1 improvement in {bad_evals} evaluations")
+            return True
+        if callback is not None:
+            return bool(callback(name, x, dev_f1, test_f1))
+        return False
+
+    def save_resume(batches=None):
+        """Write everything needed to resume training after this step.
+
+        Within an epoch (batches is the number of batches trained), the RNG
+        states of the epoch start are also saved to replay its batches.
+        """
+        if hp.keep_ckpts > 0 and ckpt_writer is not None:
+            ckpt_writer.save({'model': model.state_dict(),
+                              'optimizer': optimizer.state_dict(),
+                              'scheduler': scheduler.state_dict(),
+                              'scaler': scaler.state_dict() if scaler is not None else None,
+                              'epoch': epoch,
+                              'batches': batches,
+                              'step': step,
+                              'best_dev_f1': best_dev_f1,
+                              'best_test_f1': best_test_f1,
+                              'bad_evals': bad_evals,
+                              'rng': rng_state(train_iter),
+                              'epoch_rng': epoch_rng if batches is not None else None},
+                             'ckpt-%d.pt' % step, prune=True)
+
+    def on_step():
+        nonlocal step, batches
+        step += 1
+        batches += 1
+        if hp.eval_steps is not None and step % hp.eval_steps == 0:
+            stop = validate('step', step)
+            save_resume(batches)
+            return stop
+        return False
+
+    for epoch in range(start_epoch, hp.n_epochs+1):
+        # reshuffle the shards of the distributed samplers
+        if distributed:
+            for sampler in (train_iter.sampler, train_iter.batch_sampler):
+                if hasattr(sampler, 'set_epoch'):
+                    sampler.set_epoch(epoch)
 
-        # logging
-        scalars = {'f1': dev_f1,
-                   't_f1': test_f1}
-        writer.add_scalars(run_tag, scalars, epoch)
+        # train
+        model.train()
+        epoch_rng = rng_state(train_iter)
+        batches = 0
+        epoch_iter = iter(train_iter)
+        if skip_batches > 0:
+            # the batches trained before the checkpoint we resume from
+            for _ in range(skip_batches):
+                next(epoch_iter)
+            batches, skip_batches = skip_batches, 0
+            set_rng_state(resume_rng, train_iter)
+        if train_step(epoch_iter, train_model, optimizer, scheduler, hp,
+                      scaler=scaler, callback=on_step):
+            break
 
-    writer.close()
-    if hp.save_model is True:
-        return ckpt.model
-    else:
-        return model
\ No newline at end of file
+        # eval
+        if hp.eval_steps is None and validate('epoch', epoch):
+            break
+
+        # everything needed to resume after this epoch
+        save_resume()
+
+    if writer is not None:
+        writer.close()
+    if ckpt_writer is not None:
+        ckpt_writer.close()
+    if hp.save_model is True and best_state is not None:
+        # return the best model, i.e., the one saved to model.pt
+        model.load_state_dict(best_state)
+    return model
\ No newline at end of file
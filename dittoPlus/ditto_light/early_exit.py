@@ -0,0 +1,218 @@
+import json
+import os
+import numpy as np
+import torch
+
+from .threshold import f1_at
+
+
+def checkpoint_exit_layers(state_dict):
+    """Return the exit layers of a DittoModel state (None if it has no heads)."""
+    layers = sorted(set(int(key.split('.')[1]) for key in state_dict
+                        if key.startswith('exit_heads.')))
+    return layers if layers else None
+
+
+def exit_probs(model, iterator):
+    """Score a dataset with every exit head and the final classifier.
+
+    Args:
+        model (DittoModel): a model with exit heads
+        iterator (Iterator): the batches of the dataset (plain, K-BERT or
+            packed)
+
+    Returns:
+        np.ndarray: the match probabilities, (num_pairs, num_exits + 1); the
+            last column is the final classifier's
+        np.ndarray: the labels
+    """
+    all_probs = []
+    all_y = []
+    model.eval()
+    with torch.no_grad():
+        for batch in iterator:
+            if len(batch) == 4:
+                x, position_ids, vm, y = batch
+                logits, exit_logits = model(x, vm=vm, position_ids=position_ids, exits=True)
+            elif len(batch) == 5:
+                x, positions, segments, cls_index, y = batch
+                logits, exit_logits = model(x, position_ids=positions, segments=segments,
+                                            cls_index=cls_index, exits=True)
+            else:
+                x, y = batch
+                logits, exit_logits = model(x, exits=True)
+            probs = [l.softmax(dim=1)[:, 1] for l in exit_logits + [logits]]
+            all_probs.append(torch.stack(probs, dim=1))
+            all_y.append(y)
+    return torch.cat(all_probs).cpu().numpy(), torch.cat(all_y).numpy()
+
+
+def exit_thresholds(probs, threshold=0.5, max_disagreement=0.01):
+    """Pick the min confidence of each exit head.
+
+    A pair exits at a head if the head's max probability is at least the
+    head's threshold. For each head, the threshold is the lowest one for
+    which the pairs exiting there disagree with the final classifier (at the
+    decision threshold) on at most max_disagreement of them.
+
+    Args:
+        probs (np.ndarray): the match probabilities of exit_probs
+        threshold (float, optional): the decision threshold of the matches
+        max_disagreement (float, optional): the max rate of exited pairs
+            predicted differently from the final classifier
+
+    Returns:
+        list of float: the threshold of each head (inf if none qualifies)
+    """
+    final = probs[:, -1] > threshold
+    thresholds = []
+    for head in range(probs.shape[1] - 1):
+        p = probs[:, head]
+        confidence = np.maximum(p, 1.0 - p)
+        order = np.argsort(-confidence, kind='stable')
+        confidence = confidence[order]
+        disagree = np.cumsum((p > threshold)[order] != final[order])
+        # only cut after the last pair of a group of equal confidences
+        last = np.append(np.diff(confidence) != 0, True)
+        rate = disagree / np.arange(1, len(p) + 1)
+        ok = np.flatnonzero(last & (rate <= max_disagreement))
+        thresholds.append(float(confidence[ok[-1]]) if len(ok) > 0 else float('inf'))
+    return thresholds
+
+
+def exit_report(probs, labels, exit_layers, thresholds, num_layers, threshold=0.5):
+    """Simulate the early exits of a dataset.
+
+    Args:
+        probs (np.ndarray): the match probabilities of exit_probs
+        labels (np.ndarray): the labels
+        exit_layers (list of int): the layers of the heads
+        thresholds (list of float): the threshold of each head
+        num_layers (int): the number of layers of the LM
+        threshold (float, optional): the decision threshold of the matches
+
+    Returns:
+        Dictionary: the number of pairs exiting at each layer ('exits', by
+            layer, num_layers for the final classifier), the F1 scores of
+            the full model ('f1') and with the early exits ('exit_f1'), and
+            the mean number of layers run per pair ('layers')
+    """
+    num_pairs, num_heads = len(probs), len(exit_layers)
+    exit_head = np.full(num_pairs, num_heads)
+    for head in reversed(range(num_heads)):
+        p = probs[:, head]
+        exit_head[np.maximum(p, 1.0 - p) >= thresholds[head]] = head
+
+    layers = np.asarray(list(exit_layers) + [num_layers])[exit_head]
+    exit_p = probs[np.arange(num_pairs), exit_head]
+    return {'exits': {int(layer): int((layers == layer).sum())
+                      for layer in list(exit_layers) + [num_layers]},
+            'f1': f1_at(probs[:, -1], labels, threshold),
+            'exit_f1': f1_at(exit_p, labels, threshold),
+            'layers': float(layers.mean()) if num_pairs > 0 else 0.0}
+
+
+def format_exit_report(report, num_layers):
+    """Format an exit_report as a line of text."""
+    total = max(sum(report['exits'].values()), 1)
+    exits = ', '.join('%d: %.1f%%' % (layer, 100.0 * count / total)
+                      for layer, count in report['exits'].items())
+    return 'exits by layer {%s}, f1=%f, exit_f1=%f, layers=%.2f (%.1f%% of the encoder)' % (
+        exits, report['f1'], report['exit_f1'], report['layers'],
+        100.0 * report['layers'] / num_layers)
+
+
+def calibrate_exits(model, iterator, threshold=0.5, max_disagreement=0.01):
+    """Calibrate the exit thresholds of a model on a (validation) set.
+
+    The thresholds are set on the model, so the following scoring stops the
+    confident pairs early (see DittoModel.early_exit).
+
+    Args:
+        model (DittoModel): a model with exit heads
+        iterator (Iterator): the batches of the dataset
+        threshold (float, optional): the decision threshold of the matches
+        max_disagreement (float, optional): see exit_thresholds
+
+    Returns:
+        Dictionary: the exit_report of the dataset
+    """
+    if len(model.exit_layers) == 0:
+        raise ValueError('the model has no exit heads (train it with --exit_layers)')
+    model.exit_thresholds = None
+    probs, labels = exit_probs(model, iterator)
+    thresholds = exit_thresholds(probs, threshold, max_disagreement)
+    model.exit_thresholds = dict(zip(model.exit_layers, thresholds))
+    return exit_report(probs, labels, model.exit_layers, thresholds,
+                       model.bert.config.num_hidden_layers, threshold)
+
+
+def evaluate_exits(model, iterator, threshold=0.5):
+    """Report the early exits of a calibrated model on a dataset.
+
+    Args:
+        model (DittoModel): a model with calibrated exit thresholds
+        iterator (Iterator): the batches of the dataset
+        threshold (float, optional): the decision threshold of the matches
+
+    Returns:
+        Dictionary: the exit_report of the dataset
+    """
+    probs, labels = exit_probs(model, iterator)
+    thresholds = [model.exit_thresholds[layer] for layer in model.exit_layers]
+    return exit_report(probs, labels, model.exit_layers, thresholds,
+                       model.bert.config.num_hidden_layers, threshold)
+
+
+def exit_thresholds_path(checkpoint):
+    """Return the path of the exit thresholds of a checkpoint (model.exits.json)."""
+    return os.path.splitext(checkpoint)[0] + '.exits.json'
+
+
+def save_exit_thresholds(model, checkpoint, threshold, max_disagreement):
+    """Save the calibrated exit thresholds of a model next to its checkpoint.
+
+    Args:
+        model (DittoModel): a model with calibrated exit thresholds
+        checkpoint (str): the checkpoint of the model (model.pt)
+        threshold (float): the decision threshold of the calibration
+        max_disagreement (float): the tolerance of the calibration
+    """
+    path = exit_thresholds_path(checkpoint)
+    tmp_path = '%s.tmp%d' % (path, os.getpid())
+    with open(tmp_path, 'w') as fout:
+        json.dump({'exit_layers': list(model.exit_layers),
+                   'thresholds': [model.exit_thresholds[layer] for layer in model.exit_layers],
+                   'threshold': float(threshold),
+                   'max_disagreement': max_disagreement}, fout)
+    os.replace(tmp_path, path)
+
+
+def load_exit_thresholds(model, checkpoint, threshold, max_disagreement):
+    """Set the saved exit thresholds of a checkpoint on a model.
+
+    The thresholds are only reused if they are newer than the checkpoint
+    and were calibrated for the same heads, decision threshold and
+    tolerance.
+
+    Args:
+        model (DittoModel): the model of the checkpoint, with exit heads
+        checkpoint (str): the checkpoint (model.pt)
+        threshold (float): the decision threshold of the matches
+        max_disagreement (float): see exit_thresholds
+
+    Returns:
+        boolean: whether the thresholds were loaded
+    """
+    path = exit_thresholds_path(checkpoint)
+    if not os.path.exists(path) or \
+       os.path.getmtime(path) < os.path.getmtime(checkpoint):
+        return False
+    with open(path) as fin:
+        saved = json.load(fin)
+    if saved['exit_layers'] != list(model.exit_layers) or \
+       saved['threshold'] != float(threshold) or \
+       saved['max_disagreement'] != max_disagreement:
+        return False
+    model.exit_thresholds = dict(zip(model.exit_layers, saved['thresholds']))
+    return True
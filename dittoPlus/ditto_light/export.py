@@ -0,0 +1,198 @@
+import os
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+
+from .threshold import f1_at
+
+
+class DittoScorer(nn.Module):
+    """The scoring graph of a DittoModel: token ID's (and K-BERT inputs) to logits."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, position_ids=None, vm=None):
+        return self.model(input_ids, vm=vm, position_ids=position_ids)
+
+
+def onnx_path(checkpoint, vm=False):
+    """Return the path of the graph exported from a checkpoint (model.onnx,
+    or model.kbert.onnx with the K-BERT inputs)."""
+    root = os.path.splitext(checkpoint)[0]
+    return root + ('.kbert.onnx' if vm else '.onnx')
+
+
+def export_onnx(model, path, vm=False, opset=17):
+    """Export a DittoModel to an ONNX graph with dynamic batch and sequence axes.
+
+    The model is exported in fp32 with the eager attention. The graph takes
+    input_ids (batch, seq) and, if vm is set, the K-BERT position_ids and
+    compact visibility groups (see RobertaWithVM), and outputs the logits.
+    The file is written to a temporary path first.
+
+    Args:
+        model (DittoModel): the model (moved to the CPU)
+        path (str): the output .onnx file
+        vm (boolean, optional): export the K-BERT inputs
+        opset (int, optional): the ONNX opset version
+    """
+    model = model.to('cpu')
+    model.device = 'cpu'
+    model.precision = 'fp32'
+    # the full graph: the early exits depend on the data
+    model.exit_thresholds = None
+    if hasattr(model.bert, 'set_attention'):
+        model.bert.set_attention('eager')
+    model.eval()
+
+    batch_size, seq_len = 2, 16
+    input_ids = torch.randint(3, 100, (batch_size, seq_len))
+    inputs = (input_ids,)
+    input_names = ['input_ids']
+    if vm:
+        position_ids = torch.arange(seq_len).repeat(batch_size, 1)
+        groups = torch.zeros(batch_size, seq_len, dtype=torch.long)
+        inputs += (position_ids, groups)
+        input_names += ['position_ids', 'vm']
+    dynamic_axes = {name: {0: 'batch', 1: 'seq'} for name in input_names}
+    dynamic_axes['logits'] = {0: 'batch'}
+
+    kwargs = dict(input_names=input_names,
+                  output_names=['logits'],
+                  dynamic_axes=dynamic_axes,
+                  opset_version=opset)
+    tmp_path = '%s.tmp%d' % (path, os.getpid())
+    with torch.no_grad():
+        try:
+            # the TorchScript-based exporter handles dynamic_axes
+            torch.onnx.export(DittoScorer(model), inputs, tmp_path, dynamo=False, **kwargs)
+        except TypeError:
+            # torch < 2.5 has no dynamo argument
+            torch.onnx.export(DittoScorer(model), inputs, tmp_path, **kwargs)
+    os.replace(tmp_path, path)
+
+
+def make_session(path, threads=None):
+    """Create an ONNX Runtime CPU session of a graph."""
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if threads is not None:
+        options.intra_op_num_threads = threads
+    return ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+
+def tune_threads(path, batch_size=64, seq_len=128, candidates=None, repeats=3):
+    """Find the intra-op thread count scoring a batch the fastest.
+
+    Args:
+        path (str): the .onnx graph
+        batch_size (int, optional): the batch size of the timed batch
+        seq_len (int, optional): the sequence length of the timed batch
+        candidates (list of int, optional): the thread counts tried (powers
+            of two up to the number of cores by default)
+        repeats (int, optional): the number of timed runs per candidate
+
+    Returns:
+        int: the fastest thread count
+    """
+    if candidates is None:
+        cores = os.cpu_count() or 1
+        candidates = sorted(set([2**i for i in range(cores.bit_length()) if 2**i <= cores] + [cores]))
+    input_ids = np.random.randint(3, 100, size=(batch_size, seq_len)).astype(np.int64)
+
+    best, best_time = candidates[0], None
+    for threads in candidates:
+        session = make_session(path, threads)
+        feeds = {'input_ids': input_ids}
+        names = [i.name for i in session.get_inputs()]
+        if 'vm' in names:
+            feeds['position_ids'] = np.tile(np.arange(seq_len), (batch_size, 1))
+            feeds['vm'] = np.zeros((batch_size, seq_len), dtype=np.int64)
+        session.run(['logits'], feeds) # warm up
+        start = time.time()
+        for _ in range(repeats):
+            session.run(['logits'], feeds)
+        elapsed = time.time() - start
+        if best_time is None or elapsed < best_time:
+            best, best_time = threads, elapsed
+    return best
+
+
+class OnnxModel:
+    """A DittoModel graph run by ONNX Runtime, used in place of the model in
+    scoring (evaluate, MatchSession).
+
+    Only plain batches and K-BERT batches (if exported with vm) are
+    supported; the logits are returned as a CPU tensor.
+
+    Args:
+        path (str): the .onnx graph (see export_onnx)
+        threads (int, optional): the intra-op thread count; tuned with
+            tune_threads if not set
+    """
+    device = 'cpu'
+
+    def __init__(self, path, threads=None):
+        if threads is None:
+            threads = tune_threads(path)
+        self.path = path
+        self.threads = threads
+        self.session = make_session(path, threads)
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def __call__(self, x1, x2=None, vm=None, position_ids=None, save=False,
+                 segments=None, cls_index=None):
+        if x2 is not None or segments is not None:
+            raise ValueError('the ONNX graph only scores plain and K-BERT batches')
+        # the graph takes int64 inputs (the compact vm is int8)
+        feeds = {'input_ids': x1.cpu().numpy().astype(np.int64, copy=False)}
+        if 'vm' in self.input_names:
+            if vm is None:
+                raise ValueError('%s needs the K-BERT vm and position_ids' % self.path)
+            feeds['position_ids'] = position_ids.cpu().numpy().astype(np.int64, copy=False)
+            feeds['vm'] = vm.cpu().numpy().astype(np.int64, copy=False)
+        logits = self.session.run(['logits'], feeds)[0]
+        return torch.from_numpy(logits)
+
+    def eval(self):
+        return self
+
+
+def check_parity(model, onnx_model, iterator, threshold=0.5):
+    """Compare the match probabilities of a model and its ONNX graph.
+
+    Args:
+        model (DittoModel): the PyTorch model
+        onnx_model (OnnxModel): the exported graph
+        iterator (Iterator): the batches of a dataset (plain or K-BERT)
+        threshold (float, optional): the threshold of the F1 scores
+
+    Returns:
+        float: the max absolute difference of the probabilities
+        float: the F1 score of the PyTorch model
+        float: the F1 score of the ONNX graph
+    """
+    torch_probs, onnx_probs, labels = [], [], []
+    model.eval()
+    with torch.no_grad():
+        for batch in iterator:
+            if len(batch) == 4:
+                x, position_ids, vm, y = batch
+                kwargs = {'vm': vm, 'position_ids': position_ids}
+            else:
+                x, y = batch
+                kwargs = {}
+            torch_probs.append(model(x, **kwargs).softmax(dim=1)[:, 1].cpu().numpy())
+            onnx_probs.append(onnx_model(x, **kwargs).softmax(dim=1)[:, 1].numpy())
+            labels.append(y.numpy())
+
+    torch_probs = np.concatenate(torch_probs)
+    onnx_probs = np.concatenate(onnx_probs)
+    labels = np.concatenate(labels)
+    return float(np.abs(torch_probs - onnx_probs).max()), \
+           f1_at(torch_probs, labels, threshold), \
+           f1_at(onnx_probs, labels, threshold)
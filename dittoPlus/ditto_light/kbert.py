@@ -0,0 +1,161 @@
+import numpy as np
+
+
+def _next_marker(positions, starts):
+    """Return, for every start, the index in positions of the first marker
+    at or after it (len(positions) if there is none)."""
+    return np.searchsorted(positions, starts)
+
+
+def _span_labels(n, starts, ends, labels):
+    """Label the half-open spans [starts, ends) of a length-n array.
+
+    The spans must not overlap. Tokens outside every span get -1.
+    """
+    acc = np.zeros(n + 1, dtype=np.int64)
+    np.add.at(acc, starts, labels + 1)
+    np.add.at(acc, ends, -(labels + 1))
+    return np.cumsum(acc[:n]) - 1
+
+
+def build_knowledge_trees(sequences, marker_ids, pad_id, max_length=128):
+    """Build the K-BERT sentence trees of a batch of token sequences.
+
+    The sequences are serialized with the prompt_type 0 format, i.e.,
+    ``COL <head> attr </head> <tail> knowledge </tail> VAL ...``. The tokens
+    of the knowledge span are attached as a branch to every token of the
+    preceding head span; the markers are dropped. All the sequences are
+    processed at once on a flat array, locating the head/tail spans with
+    a single search.
+
+    Args:
+        sequences (list of array-like): the token ID's of each sequence
+        marker_ids (tuple of int): the ID's of <head>, </head>, <tail>, </tail>
+        pad_id (int): the ID of the padding token
+        max_length (int, optional): the length the trees are padded or
+            truncated to
+
+    Returns:
+        np.ndarray: the token ID's of the trees, (batch_size, max_length)
+        np.ndarray: the soft positions, (batch_size, max_length)
+        np.ndarray: the segment tags (1 for knowledge tokens)
+        np.ndarray: the index of the source token owning each token
+            (-1 for padding), (batch_size, max_length)
+    """
+    head, head_end, tail, tail_end = marker_ids
+    batch_size = len(sequences)
+    lens = np.array([len(seq) for seq in sequences], dtype=np.int64)
+    if batch_size > 0 and lens.sum() > 0:
+        flat = np.concatenate([np.asarray(seq, dtype=np.int64) for seq in sequences])
+    else:
+        flat = np.zeros(0, dtype=np.int64)
+    n = len(flat)
+    seq_of = np.repeat(np.arange(batch_size), lens)
+    is_marker = np.isin(flat, marker_ids)
+
+    # the closing markers following each <head>
+    heads = np.flatnonzero(flat == head)
+    closers = []
+    for marker in [head_end, tail, tail_end]:
+        positions = np.flatnonzero(flat == marker)
+        idx = _next_marker(positions, heads)
+        found = idx < len(positions)
+        closers.append((positions, idx, found))
+    complete = closers[0][2] & closers[1][2] & closers[2][2]
+    heads = heads[complete]
+    head_ends, tail_lefts, tail_rights = [pos[idx[complete]] for pos, idx, _ in closers]
+    tail_lefts = tail_lefts + 1
+    same_seq = seq_of[tail_rights] == seq_of[heads]
+    heads, head_ends = heads[same_seq], head_ends[same_seq]
+    tail_lefts, tail_rights = tail_lefts[same_seq], tail_rights[same_seq]
+    n_heads = len(heads)
+
+    # tokens of the knowledge spans (and the markers) are not source tokens
+    hidden = np.zeros(n + 1, dtype=np.int64)
+    np.add.at(hidden, tail_lefts, 1)
+    np.add.at(hidden, tail_rights + 1, -1)
+    hidden = np.cumsum(hidden[:n]) > 0
+    source = ~is_marker & ~hidden
+    src_idx = np.flatnonzero(source)
+    n_src = len(src_idx)
+
+    # the knowledge tokens of each head, stored back to back
+    ent_pos = np.flatnonzero(hidden & ~is_marker)
+    ent_start = np.searchsorted(ent_pos, tail_lefts)
+    ent_count = np.searchsorted(ent_pos, tail_rights) - ent_start
+
+    # the head owning each source token (-1 outside of the head spans)
+    branch = _span_labels(n, heads + 1, head_ends, np.arange(n_heads))[src_idx]
+    counts = np.where(branch >= 0, ent_count[np.maximum(branch, 0)] if n_heads > 0 else 0, 0)
+
+    # lay out every source token followed by its branch
+    widths = 1 + counts
+    total = int(widths.sum())
+    owner = np.repeat(np.arange(n_src), widths)
+    first = np.repeat(np.cumsum(widths) - widths, widths)
+    within = np.arange(total) - first
+    is_ent = within > 0
+    gather = src_idx[owner]
+    if is_ent.any():
+        ent_idx = ent_start[branch[owner[is_ent]]] + within[is_ent] - 1
+        gather[is_ent] = ent_pos[ent_idx]
+
+    # soft positions restart in every sequence; knowledge sits at owner+1
+    src_seq = seq_of[src_idx]
+    src_rank = np.arange(n_src) - np.searchsorted(src_seq, src_seq)
+    slot_seq = src_seq[owner]
+    slot = np.arange(total) - np.searchsorted(slot_seq, slot_seq)
+    keep = slot < max_length
+    rows, cols = slot_seq[keep], slot[keep]
+
+    know = np.full((batch_size, max_length), pad_id, dtype=np.int64)
+    pos = np.full((batch_size, max_length), max_length - 1, dtype=np.int64)
+    seg = np.zeros((batch_size, max_length), dtype=np.int8)
+    owners = np.full((batch_size, max_length), -1, dtype=np.int64)
+    know[rows, cols] = flat[gather[keep]]
+    pos[rows, cols] = src_rank[owner[keep]] + is_ent[keep]
+    seg[rows, cols] = is_ent[keep]
+    owners[rows, cols] = src_rank[owner[keep]]
+    return know, pos, seg, owners
+
+
+def visible_matrix(owners, seg):
+    """Compute the visible matrices of a batch of sentence trees.
+
+    A source token sees every source token and its own branch; a knowledge
+    token only sees itself and its source token.
+
+    Args:
+        owners (np.ndarray): the owning source token (-1 for padding)
+        seg (np.ndarray): the segment tags (1 for knowledge tokens)
+
+    Returns:
+        np.ndarray: boolean matrices of shape (batch_size, max_length, max_length)
+    """
+    valid = owners >= 0
+    src = valid & (seg == 0)
+    eye = np.eye(owners.shape[-1], dtype=bool)
+    same = owners[..., :, None] == owners[..., None, :]
+    vm = (src[..., :, None] & src[..., None, :]) | \
+         (same & (src[..., :, None] | src[..., None, :] | eye))
+    return vm & valid[..., :, None] & valid[..., None, :]
+
+
+def visibility_groups(owners, seg):
+    """Encode the visible matrices of a batch of sentence trees compactly.
+
+    Every token gets a group id: 0 for source tokens, 1 for knowledge tokens
+    and -1 for padding. Together with the soft positions (a knowledge token
+    sits at the position of its source token + 1) this determines the
+    visible matrix, which can then be expanded on the device (see
+    models.expand_visible_matrix) instead of shipping (max_length, max_length)
+    matrices around.
+
+    Args:
+        owners (np.ndarray): the owning source token (-1 for padding)
+        seg (np.ndarray): the segment tags (1 for knowledge tokens)
+
+    Returns:
+        np.ndarray: the group ids (int8), same shape as owners
+    """
+    return np.where(owners >= 0, seg, -1).astype(np.int8)
@@ -0,0 +1,71 @@
+import os
+import random
+import numpy as np
+import torch
+
+from torch.utils import data
+
+
+def seed_worker(worker_id):
+    """Seed the python and numpy RNGs of a DataLoader worker.
+
+    torch seeds each worker with base_seed + worker_id, where base_seed is
+    drawn from the DataLoader's generator; the same seed is used for the
+    RNGs that the augmentation operators rely on, so that augmentation is
+    reproducible for a given run_id and number of workers.
+    """
+    seed = torch.initial_seed() % 2**32
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def make_loader(dataset, num_workers=0, seed=None,
+                pin_memory=False,
+                persistent=False,
+                prefetch_factor=4,
+                **kwargs):
+    """Create a DataLoader, optionally backed by worker processes.
+
+    With worker processes, the dataset (and the tokenizer it holds) is
+    inherited by the workers instead of being reloaded, each worker is seeded
+    from seed (e.g., the run_id), and prefetch_factor batches per worker
+    are prepared ahead of the forward pass. Pinned batches can then be copied
+    to the GPU asynchronously.
+
+    Args:
+        dataset (Dataset): the dataset
+        num_workers (int, optional): the number of worker processes
+        seed (int, optional): the seed of the workers' RNGs
+        pin_memory (boolean, optional): whether to pin the batches
+        persistent (boolean, optional): keep the workers alive across epochs
+        prefetch_factor (int, optional): batches loaded ahead per worker
+        **kwargs: other arguments of DataLoader (batch_size, collate_fn, ...)
+
+    Returns:
+        DataLoader: the data loader
+    """
+    if kwargs.pop('shuffle', False):
+        # the shuffling order has a generator of its own, so that it only
+        # depends on the seed and can be checkpointed (see checkpoint.py)
+        sampler_generator = None
+        if seed is not None:
+            sampler_generator = torch.Generator()
+            sampler_generator.manual_seed(seed)
+        kwargs['sampler'] = data.RandomSampler(dataset, generator=sampler_generator)
+
+    if num_workers > 0:
+        # the forked workers share the tokenizer; keep its own thread pool off
+        os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+        generator = None
+        if seed is not None:
+            generator = torch.Generator()
+            generator.manual_seed(seed)
+        kwargs.update(worker_init_fn=seed_worker,
+                      generator=generator,
+                      persistent_workers=persistent,
+                      prefetch_factor=prefetch_factor)
+
+    return data.DataLoader(dataset=dataset,
+                           num_workers=num_workers,
+                           pin_memory=pin_memory,
+                           **kwargs)
@@ -1,18 +1,170 @@
 from typing import Optional, List, Union, Tuple
 
 import torch
+import torch.nn.functional as F
 from transformers import RobertaModel
 from transformers.modeling_outputs import BaseModelOutputWithPoolingAndCrossAttentions
+from transformers.models.roberta.modeling_roberta import RobertaSelfAttention
+
+def expand_visible_matrix(groups, position_ids):
+    """Expand compact K-BERT visibility groups into visible matrices.
+
+    See kbert.visibility_groups for the encoding. The owner of a knowledge
+    token is recovered from its soft position, and the matrices are built
+    with a broadcast comparison on the device of the inputs.
+
+    Args:
+        groups (Tensor): the group ids, (batch_size, seq_len)
+        position_ids (Tensor): the soft positions, (batch_size, seq_len)
+
+    Returns:
+        BoolTensor: the visible matrices, (batch_size, seq_len, seq_len)
+    """
+    valid = groups >= 0
+    src = groups == 0
+    owners = position_ids - (groups == 1).long()
+    # an arange comparison rather than torch.eye, which has no boolean
+    # kernel in ONNX Runtime (see export.py)
+    idx = torch.arange(groups.size(1), device=groups.device)
+    eye = idx.unsqueeze(0) == idx.unsqueeze(1)
+    same = owners.unsqueeze(2) == owners.unsqueeze(1)
+    src_i, src_j = src.unsqueeze(2), src.unsqueeze(1)
+    vm = (src_i & src_j) | (same & (src_i | src_j | eye))
+    return vm & valid.unsqueeze(2) & valid.unsqueeze(1)
+
+
+def sdpa_attention_mask(attention_mask):
+    """Turn an attention mask into the boolean mask of RobertaSdpaSelfAttention.
+
+    Args:
+        attention_mask (Tensor): a padding mask (batch_size, seq_len), a
+            visible matrix (batch_size, seq_len, seq_len) or a mask
+            broadcastable to (batch_size, num_heads, seq_len, seq_len); non-zero
+            (or True) where a token can attend
+
+    Returns:
+        BoolTensor: the mask, broadcastable to the attention scores
+    """
+    mask = attention_mask.bool()
+    if mask.dim() == 2:
+        return mask[:, None, None, :]
+    if mask.dim() == 3:
+        mask = mask[:, None]
+    # every token sees itself: SDPA returns NaNs for fully masked rows (e.g.,
+    # the padding of K-BERT sentence trees), which would leak into the values
+    eye = torch.eye(mask.size(-1), dtype=torch.bool, device=mask.device)
+    return mask | eye
+
+
+class RobertaSdpaSelfAttention(RobertaSelfAttention):
+    """RoBERTa self-attention through torch's scaled_dot_product_attention.
+
+    The mask is the boolean mask of sdpa_attention_mask, built once per
+    forward pass and shared by all the layers, so neither the float extended
+    mask nor (with the fused kernels) the [B, H, L, L] scores are
+    materialized. The module has the same weights as RobertaSelfAttention;
+    attention outputs, head masks, relative positions and decoders fall back
+    to the eager implementation.
+    """
+    def forward(self,
+                hidden_states,
+                attention_mask=None,
+                head_mask=None,
+                encoder_hidden_states=None,
+                encoder_attention_mask=None,
+                past_key_value=None,
+                output_attentions=False):
+        if output_attentions or head_mask is not None or self.is_decoder or \
+           encoder_hidden_states is not None or \
+           self.position_embedding_type != 'absolute':
+            if attention_mask is not None and attention_mask.dtype == torch.bool:
+                # the additive mask of the eager attention
+                attention_mask = torch.zeros(attention_mask.shape,
+                                             dtype=hidden_states.dtype,
+                                             device=attention_mask.device)\
+                    .masked_fill(~attention_mask, torch.finfo(hidden_states.dtype).min)
+            return super().forward(hidden_states, attention_mask, head_mask,
+                                   encoder_hidden_states, encoder_attention_mask,
+                                   past_key_value, output_attentions)
+
+        query = self.transpose_for_scores(self.query(hidden_states))
+        key = self.transpose_for_scores(self.key(hidden_states))
+        value = self.transpose_for_scores(self.value(hidden_states))
+        context = F.scaled_dot_product_attention(query, key, value,
+                                                 attn_mask=attention_mask,
+                                                 dropout_p=self.dropout.p if self.training else 0.0)
+        batch_size, seq_len = hidden_states.shape[:2]
+        context = context.transpose(1, 2).reshape(batch_size, seq_len, self.all_head_size)
+        return (context,)
+
 
 class RobertaWithVM(RobertaModel):
     """ 
     Roberta Model with 3D Attention Mask input
     """
+    attention_classes = {'eager': RobertaSelfAttention,
+                         'sdpa': RobertaSdpaSelfAttention}
+
     def __init__(self, config):
         super().__init__(config)
         print("config.is_decoder")
         print(config.is_decoder)
+        self.attn_implementation = 'eager'
+
+    def set_attention(self, implementation):
+        """Switch the self-attention of all the layers.
+
+        The weights are kept, so a checkpoint loads with either one.
+
+        Args:
+            implementation (str): 'eager' (the stock attention, with a float
+                extended mask) or 'sdpa' (see RobertaSdpaSelfAttention)
+        """
+        attention_class = self.attention_classes[implementation]
+        for layer in self.encoder.layer:
+            layer.attention.self.__class__ = attention_class
+        self.attn_implementation = implementation
+
+    def set_attention_dropout(self, p):
+        """Set the dropout rate of the attention probabilities of all the layers.
+
+        The fused CPU kernels of scaled_dot_product_attention do not
+        implement dropout; with p > 0, SDPA falls back to its math kernel.
+        """
+        self.config.attention_probs_dropout_prob = p
+        for layer in self.encoder.layer:
+            layer.attention.self.dropout.p = p
         
+    def layer_attention_mask(self, attention_mask, input_shape, device, vm=None,
+                             position_ids=None, past_key_values_length=0):
+        """Build the attention mask passed to every layer of the encoder.
+
+        Args:
+            attention_mask (Tensor): a padding mask (batch_size, seq_len), a
+                visible matrix (batch_size, seq_len, seq_len), or None
+            input_shape (tuple): (batch_size, seq_len)
+            device (torch.device): the device of the inputs
+            vm (Tensor, optional): compact K-BERT visibility groups, expanded
+                with the position_ids in place of attention_mask
+            position_ids (Tensor, optional): the soft positions of vm
+            past_key_values_length (int, optional): the length of the cache
+
+        Returns:
+            Tensor: the boolean mask of the SDPA attention, or the additive
+                extended mask of the eager one
+        """
+        if vm is not None:
+            attention_mask = expand_visible_matrix(vm, position_ids)
+
+        if self.attn_implementation == 'sdpa' and past_key_values_length == 0:
+            # the boolean mask is passed as is to all the layers
+            return sdpa_attention_mask(attention_mask) if attention_mask is not None else None
+
+        if attention_mask is None:
+            batch_size, seq_length = input_shape
+            attention_mask = torch.ones(((batch_size, seq_length + past_key_values_length)), device=device)
+        return self.get_extended_attention_mask(attention_mask, input_shape)
+
     def forward(
         self,
         input_ids: Optional[torch.Tensor] = None,
@@ -49,6 +201,9 @@ class RobertaWithVM(RobertaModel):
         use_cache (`bool`, *optional*):
             If set to `True`, `past_key_values` key value states are returned and can be used to speed up decoding (see
             `past_key_values`).
+        vm (`torch.Tensor` of shape `(batch_size, sequence_length)`, *optional*):
+            Compact K-BERT visibility groups (see `expand_visible_matrix`). If set, the 3D attention mask is
+            expanded from them and `position_ids` on the device, and `attention_mask` is ignored.
         """
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -76,9 +231,6 @@ class RobertaWithVM(RobertaModel):
         # past_key_values_length
         past_key_values_length = past_key_values[0][0].shape[2] if past_key_values is not None else 0
 
-        if attention_mask is None:
-            attention_mask = torch.ones(((batch_size, seq_length + past_key_values_length)), device=device)
-
         if token_type_ids is None:
             if hasattr(self.embeddings, "token_type_ids"):
                 buffered_token_type_ids = self.embeddings.token_type_ids[:, :seq_length]
@@ -89,7 +241,10 @@ class RobertaWithVM(RobertaModel):
 
         # We can provide a self-attention mask of dimensions [batch_size, from_seq_length, to_seq_length]
         # ourselves in which case we just need to make it broadcastable to all heads.
-        extended_attention_mask: torch.Tensor = self.get_extended_attention_mask(attention_mask, input_shape)
+        extended_attention_mask = self.layer_attention_mask(attention_mask, input_shape, device,
+                                                            vm=vm,
+                                                            position_ids=position_ids,
+                                                            past_key_values_length=past_key_values_length)
 
 
         # If a 2D or 3D attention mask is provided for the cross-attention
@@ -0,0 +1,273 @@
+import os
+import pickle
+import re
+import numpy as np
+
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import LogisticRegression
+
+number_pattern = re.compile(r'\d+(?:\.\d+)?')
+
+
+def parse_entry(entry):
+    """Split a serialized entry (COL attr VAL value ...) into its attributes.
+
+    Args:
+        entry (str): the serialized entry
+
+    Returns:
+        Dictionary: the value of every attribute ('' for an entry without
+            COL/VAL headers)
+    """
+    if 'COL ' not in entry:
+        return {'': entry.strip()}
+    attrs = {}
+    for part in entry.split('COL ')[1:]:
+        attr, _, value = part.partition(' VAL')
+        attrs[attr.strip()] = value.strip()
+    return attrs
+
+
+def jaccard(left, right):
+    """The row-wise Jaccard similarity of two binary sparse matrices."""
+    inter = np.asarray(left.multiply(right).sum(axis=1)).ravel()
+    union = np.asarray(left.sum(axis=1)).ravel() + np.asarray(right.sum(axis=1)).ravel() - inter
+    return np.divide(inter, union, out=np.zeros(len(inter)), where=union > 0)
+
+
+def first_number(value):
+    """The first number of a value (nan if it has none)."""
+    match = number_pattern.search(value.replace(',', ''))
+    return float(match.group()) if match is not None else np.nan
+
+
+class PreFilter:
+    """A cheap lexical matcher deciding the easy pairs before the LM.
+
+    Every pair is described by per-attribute similarities of its two
+    serialized entries (token and 3-gram Jaccard, shared ID/model numbers,
+    numeric closeness, and whether both values are present), plus the same
+    similarities of the whole entries. The token sets are hashed, so the
+    features of a batch are computed with sparse matrix products. A logistic
+    regression scores the features; after calibration, the pairs scoring
+    below low are rejected and those at or above high are accepted, the
+    others are left to the model.
+
+    Args:
+        max_attributes (int, optional): the max number of attributes (the
+            most frequent ones of the training set) with their own features
+
+    Attributes:
+        attributes (list of str): the attributes with their own features
+        low (float): the probability under which a pair is rejected
+        high (float): the probability from which a pair is accepted
+    """
+    num_features = 5
+
+    def __init__(self, max_attributes=16):
+        self.max_attributes = max_attributes
+        self.attributes = []
+        self.low = 0.0
+        self.high = float('inf')
+        self.classifier = LogisticRegression(class_weight='balanced', max_iter=1000)
+        hashing = dict(binary=True, norm=None, alternate_sign=False, n_features=2**18)
+        self.word_vectorizer = HashingVectorizer(**hashing)
+        self.qgram_vectorizer = HashingVectorizer(analyzer='char_wb', ngram_range=(3, 3), **hashing)
+        # tokens with both digits and letters, e.g., model numbers
+        self.code_vectorizer = HashingVectorizer(token_pattern=r'(?u)\b(?=\w*\d)(?=\w*[a-zA-Z])\w{3,}\b',
+                                                 **hashing)
+
+    @staticmethod
+    def split(pairs):
+        """Split serialized pairs (left \\t right [\\t label]) into entries."""
+        lefts, rights = [], []
+        for pair in pairs:
+            left, right = pair.split('\t')[:2]
+            lefts.append(left)
+            rights.append(right)
+        return lefts, rights
+
+    def similarities(self, lefts, rights):
+        """The similarity features of pairs of values.
+
+        Args:
+            lefts (list of str): the left values
+            rights (list of str): the right values
+
+        Returns:
+            np.ndarray: the features, (num_pairs, num_features)
+        """
+        word = jaccard(self.word_vectorizer.transform(lefts), self.word_vectorizer.transform(rights))
+        qgram = jaccard(self.qgram_vectorizer.transform(lefts), self.qgram_vectorizer.transform(rights))
+        left_codes = self.code_vectorizer.transform(lefts)
+        right_codes = self.code_vectorizer.transform(rights)
+        code = np.asarray(left_codes.multiply(right_codes).sum(axis=1)).ravel() > 0
+
+        left_numbers = np.array([first_number(value) for value in lefts])
+        right_numbers = np.array([first_number(value) for value in rights])
+        scale = np.fmax(np.abs(left_numbers), np.abs(right_numbers))
+        closeness = 1.0 - np.abs(left_numbers - right_numbers) / np.where(scale > 0, scale, 1.0)
+        closeness = np.nan_to_num(closeness, nan=0.0)
+
+        present = np.array([len(l) > 0 and len(r) > 0 for l, r in zip(lefts, rights)])
+        return np.stack([word, qgram, code, closeness, present], axis=1).astype(np.float64)
+
+    def features(self, pairs):
+        """The features of serialized pairs (see similarities).
+
+        Args:
+            pairs (list of str): the serialized pairs
+
+        Returns:
+            np.ndarray: (num_pairs, (num_attributes + 1) * num_features)
+        """
+        lefts, rights = self.split(pairs)
+        left_attrs = [parse_entry(entry) for entry in lefts]
+        right_attrs = [parse_entry(entry) for entry in rights]
+
+        # the whole entries, without the headers
+        whole = lambda attrs: ' '.join(attrs.values())
+        blocks = [self.similarities([whole(a) for a in left_attrs],
+                                    [whole(a) for a in right_attrs])]
+        for attr in self.attributes:
+            blocks.append(self.similarities([a.get(attr, '') for a in left_attrs],
+                                            [a.get(attr, '') for a in right_attrs]))
+        return np.concatenate(blocks, axis=1)
+
+    def fit(self, pairs, labels):
+        """Train the classifier on labeled pairs.
+
+        Args:
+            pairs (list of str): the serialized pairs
+            labels (list of int): the 0/1 labels
+
+        Returns:
+            PreFilter: self
+        """
+        counts = {}
+        for left, right in zip(*self.split(pairs)):
+            for attr in list(parse_entry(left)) + list(parse_entry(right)):
+                counts[attr] = counts.get(attr, 0) + 1
+        self.attributes = sorted(counts, key=lambda attr: -counts[attr])[:self.max_attributes]
+        self.classifier.fit(self.features(pairs), np.asarray(labels))
+        return self
+
+    def predict_proba(self, pairs):
+        """Return the match probability of every pair."""
+        if len(pairs) == 0:
+            return np.zeros(0)
+        return self.classifier.predict_proba(self.features(pairs))[:, 1]
+
+    def decide(self, pairs):
+        """Decide the pairs outside the calibrated band.
+
+        Args:
+            pairs (list of str): the serialized pairs
+
+        Returns:
+            np.ndarray: 0 (rejected), 1 (accepted) or -1 (left to the model)
+                for every pair
+            np.ndarray: the match probabilities
+        """
+        probs = self.predict_proba(pairs)
+        decisions = np.full(len(pairs), -1)
+        decisions[probs < self.low] = 0
+        decisions[probs >= self.high] = 1
+        return decisions, probs
+
+    def calibrate(self, pairs, labels, max_recall_loss=0.01, min_precision=None):
+        """Set the band of the pre-filter on labeled (validation) pairs.
+
+        The reject threshold is the highest one losing at most
+        max_recall_loss of the matches. If min_precision is set, the accept
+        threshold is the lowest one whose accepted pairs reach this precision;
+        otherwise no pair is accepted.
+
+        Args:
+            pairs (list of str): the serialized pairs
+            labels (list of int): the 0/1 labels
+            max_recall_loss (float, optional): the max share of rejected matches
+            min_precision (float, optional): the min precision of the
+                accepted pairs
+
+        Returns:
+            Dictionary: the report of the band on the pairs (see report)
+        """
+        probs = self.predict_proba(pairs)
+        labels = np.asarray(labels).astype(bool)
+
+        positives = np.sort(probs[labels])
+        if len(positives) > 0:
+            self.low = float(positives[int(max_recall_loss * len(positives))])
+        else:
+            self.low = 0.0
+
+        self.high = float('inf')
+        if min_precision is not None and len(probs) > 0:
+            order = np.argsort(-probs, kind='stable')
+            sorted_probs = probs[order]
+            precision = np.cumsum(labels[order]) / np.arange(1, len(probs) + 1)
+            # only cut after the last pair of a group of equal probabilities
+            last = np.append(np.diff(sorted_probs) != 0, True)
+            ok = np.flatnonzero(last & (precision >= min_precision))
+            if len(ok) > 0:
+                self.high = max(float(sorted_probs[ok[-1]]), self.low)
+        return self.report(probs, labels)
+
+    def report(self, probs, labels):
+        """The filter rates and the recall loss of the band on labeled pairs.
+
+        Args:
+            probs (np.ndarray): the match probabilities of the pairs
+            labels (np.ndarray): the 0/1 labels
+
+        Returns:
+            Dictionary: the shares of the pairs rejected, accepted, and left
+                to the model, the share of the matches rejected
+                ('recall_loss') and the precision of the accepted pairs
+        """
+        labels = np.asarray(labels).astype(bool)
+        rejected = probs < self.low
+        accepted = probs >= self.high
+        total = max(len(probs), 1)
+        return {'rejected': rejected.sum() / total,
+                'accepted': accepted.sum() / total,
+                'passed': (~rejected & ~accepted).sum() / total,
+                'recall_loss': (rejected & labels).sum() / max(labels.sum(), 1),
+                'accept_precision': (accepted & labels).sum() / accepted.sum() if accepted.any() else 1.0}
+
+
+def load_prefilter(trainset, path):
+    """Load the pre-filter of a trainset, or train and save it.
+
+    The saved filter is reused if it is newer than the trainset; its band is
+    calibrated on every launch (see PreFilter.calibrate).
+
+    Args:
+        trainset (str): the path of the trainset
+        path (str): the path of the saved filter (e.g., prefilter.pkl next
+            to the checkpoint)
+
+    Returns:
+        PreFilter: the trained filter
+    """
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(trainset):
+        with open(path, 'rb') as fin:
+            return pickle.load(fin)
+
+    prefilter = PreFilter().fit(*read_pairs(trainset))
+    tmp_path = '%s.tmp%d' % (path, os.getpid())
+    with open(tmp_path, 'wb') as fout:
+        pickle.dump(prefilter, fout)
+    os.replace(tmp_path, path)
+    return prefilter
+
+
+def read_pairs(path):
+    """Read the serialized pairs and labels of a task file (left \\t right \\t label)."""
+    pairs, labels = [], []
+    with open(path) as fin:
+        for line in fin:
+            pairs.append(line.rstrip('\n'))
+            labels.append(int(line.strip().split('\t')[-1]))
+    return pairs, labels
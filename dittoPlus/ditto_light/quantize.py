@@ -0,0 +1,75 @@
+import os
+import torch
+import torch.nn as nn
+
+from torch.ao.quantization import quantize_dynamic
+
+from .checkpoint import load_checkpoint
+
+# the weight dtype of each quantization mode
+quantize_dtypes = {'int8': torch.qint8}
+
+
+def quantize_model(model, mode='int8'):
+    """Dynamically quantize the linear layers of a DittoModel for the CPU.
+
+    The weights of all the nn.Linear modules (the attention and feed-forward
+    layers of the LM and the fc head) are stored in int8 and the activations
+    are quantized on the fly, batch by batch; the embeddings and layer norms
+    stay in fp32. The model is moved to the CPU and run in fp32 (no autocast).
+
+    Args:
+        model (DittoModel): the fp32 model
+        mode (str, optional): the quantization mode ('int8')
+
+    Returns:
+        DittoModel: the quantized model (a copy)
+    """
+    model = model.to('cpu')
+    model.device = 'cpu'
+    model.precision = 'fp32'
+    model.eval()
+    return quantize_dynamic(model, {nn.Linear}, dtype=quantize_dtypes[mode])
+
+
+def quantized_path(checkpoint, mode='int8'):
+    """Return the path of the quantized artifact of a checkpoint (model.int8.pt)."""
+    root, ext = os.path.splitext(checkpoint)
+    return '%s.%s%s' % (root, mode, ext)
+
+
+def save_quantized(model, path, mode='int8'):
+    """Save the state of a quantized model (written to a temporary file first)."""
+    tmp_path = '%s.tmp%d' % (path, os.getpid())
+    torch.save({'model': model.state_dict(), 'quantize': mode}, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_quantized(model, checkpoint, mode='int8'):
+    """Load the quantized version of a checkpoint, creating it if needed.
+
+    The artifact (see quantized_path) is reused as long as it is newer than
+    the checkpoint; otherwise the fp32 weights are loaded, quantized and
+    saved next to the checkpoint.
+
+    Args:
+        model (DittoModel): a freshly built fp32 model of the same shape
+        checkpoint (str): the fp32 checkpoint (model.pt)
+        mode (str, optional): the quantization mode ('int8')
+
+    Returns:
+        DittoModel: the quantized model
+    """
+    path = quantized_path(checkpoint, mode)
+    if os.path.exists(path) and \
+       os.path.getmtime(path) >= os.path.getmtime(checkpoint):
+        # quantize the (untrained) layers to get the packed modules, then load
+        model = quantize_model(model, mode)
+        model.load_state_dict(load_checkpoint(path)['model'])
+        return model
+
+    saved_state = load_checkpoint(checkpoint)
+    model.load_state_dict(saved_state['model'])
+    model = quantize_model(model, mode)
+    save_quantized(model, path, mode)
+    return model
@@ -0,0 +1,134 @@
+import numpy as np
+
+from torch.utils import data
+
+
+class BucketBatchSampler(data.Sampler):
+    """Batch sampler grouping examples of similar token length.
+
+    When shuffling, the examples are shuffled, cut into windows of
+    bucket_size * batch_size examples, and sorted by length within each
+    window; the resulting batches are shuffled again. Without shuffling, all
+    the examples are sorted by length (longest first) and order() gives the
+    permutation needed to restore the original order of the outputs.
+
+    A batch holds at most batch_size examples and, if max_tokens is set, at
+    most max_tokens tokens once padded to its longest example.
+
+    For distributed training, every rank plans the same batches from seed
+    and the epoch (see set_epoch) and keeps every num_replicas-th batch; the
+    plan is cut to a multiple of num_replicas so that all the ranks run the
+    same number of steps.
+
+    Args:
+        lengths (list of int): the token length of every example
+        batch_size (int): the max number of examples per batch
+        max_tokens (int, optional): the max number of padded tokens per batch
+        shuffle (boolean, optional): whether to shuffle the examples
+        bucket_size (int, optional): the number of batches per sorting window
+        num_replicas (int, optional): the number of ranks sharing the batches
+        rank (int, optional): the rank of the process
+        seed (int, optional): the seed of the shuffling (the global numpy RNG
+            is used if not set)
+    """
+    def __init__(self, lengths, batch_size,
+                 max_tokens=None,
+                 shuffle=True,
+                 bucket_size=100,
+                 num_replicas=1,
+                 rank=0,
+                 seed=None):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self._plan = None
+
+    def set_epoch(self, epoch):
+        """Set the epoch of the seeded shuffling (as DistributedSampler)."""
+        self.epoch = epoch
+        self._plan = None
+
+    def _split(self, indices):
+        """Cut a length-sorted list of indices into batches."""
+        batches = []
+        batch = []
+        longest = 0
+        for idx in indices:
+            length = int(self.lengths[idx])
+            new_longest = max(longest, length)
+            if len(batch) > 0 and (len(batch) == self.batch_size or \
+               (self.max_tokens is not None and \
+                new_longest * (len(batch) + 1) > self.max_tokens)):
+                batches.append(batch)
+                batch = []
+                new_longest = length
+            batch.append(int(idx))
+            longest = new_longest
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    def _make_plan(self):
+        if not self.shuffle:
+            order = np.argsort(-self.lengths, kind='stable')
+            return self._shard(self._split(order))
+
+        rng = np.random if self.seed is None else \
+            np.random.RandomState(self.seed + self.epoch)
+        perm = rng.permutation(len(self.lengths))
+        window = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(perm), window):
+            chunk = perm[start:start+window]
+            chunk = chunk[np.argsort(-self.lengths[chunk], kind='stable')]
+            batches += self._split(chunk)
+        rng.shuffle(batches)
+        return self._shard(batches)
+
+    def _shard(self, batches):
+        """Keep the batches of this rank (all of them without replicas)."""
+        if self.num_replicas == 1:
+            return batches
+        usable = len(batches) - len(batches) % self.num_replicas
+        return batches[self.rank:usable:self.num_replicas]
+
+    def __iter__(self):
+        plan = self._plan if self._plan is not None else self._make_plan()
+        self._plan = None
+        return iter(plan)
+
+    def __len__(self):
+        # plan the next epoch now so that its length is exact
+        if self._plan is None:
+            self._plan = self._make_plan()
+        return len(self._plan)
+
+    def order(self):
+        """Return the example indices in the order they are batched.
+
+        Only meaningful without shuffling; outputs collected batch after
+        batch are put back in the dataset order with restore_order.
+        """
+        return np.argsort(-self.lengths, kind='stable')
+
+
+def restore_order(values, order):
+    """Put outputs collected in the order of order() back in dataset order.
+
+    Args:
+        values (list or np.ndarray): the outputs, one per example
+        order (np.ndarray): the batching order (see BucketBatchSampler.order)
+
+    Returns:
+        list: the outputs in the dataset order
+    """
+    result = [None] * len(values)
+    for pos, idx in enumerate(order):
+        result[idx] = values[pos]
+    return result
@@ -0,0 +1,112 @@
+from array import array
+import numpy as np
+
+
+class PairStore:
+    """Compact, array-backed storage of entry pairs and their labels.
+
+    The serialized entries are encoded in UTF-8 and stored back to back in a
+    single byte buffer: pair i spans buffer[offsets[2*i]:offsets[2*i+2]], the
+    left entry ending at offsets[2*i+1]. The labels are kept in an int8
+    array. A split is thus held in three numpy arrays instead of one Python
+    string, tuple and int per pair, and worker processes forked from the
+    main process share them without touching any reference counts.
+
+    Slicing a store returns another store viewing the same buffer (no copy).
+
+    Args:
+        buffer (np.ndarray): the UTF-8 bytes of all the entries (uint8)
+        offsets (np.ndarray): the 2 * len + 1 entry boundaries (int64)
+        labels (np.ndarray): the labels of the pairs (int8)
+    """
+    def __init__(self, buffer, offsets, labels):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.labels = labels
+
+    @classmethod
+    def from_lines(cls, lines):
+        """Build a store from lines in the "left \\t right \\t label" format.
+
+        Args:
+            lines (iterable of str): the lines of a split
+
+        Returns:
+            PairStore: the store
+        """
+        buffer = bytearray()
+        offsets = array('q', [0])
+        labels = array('b')
+        for line in lines:
+            s1, s2, label = line.strip().split('\t')
+            buffer += s1.encode('utf-8')
+            offsets.append(len(buffer))
+            buffer += s2.encode('utf-8')
+            offsets.append(len(buffer))
+            labels.append(int(label))
+        return cls(np.frombuffer(bytes(buffer), dtype=np.uint8),
+                   np.frombuffer(offsets, dtype=np.int64),
+                   np.frombuffer(labels, dtype=np.int8))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def _decode(self, start, end):
+        return self.buffer[start:end].tobytes().decode('utf-8')
+
+    def __getitem__(self, idx):
+        """Return the (left, right) pair at idx, or a store view of a slice."""
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step != 1:
+                raise ValueError('PairStore only supports contiguous slices')
+            stop = max(start, stop)
+            return PairStore(self.buffer,
+                             self.offsets[2*start:2*stop+1],
+                             self.labels[start:stop])
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError('pair index out of range')
+        start, middle, end = self.offsets[2*idx:2*idx+3]
+        return self._decode(start, middle), self._decode(middle, end)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def label(self, idx):
+        """Return the label of pair idx as an int."""
+        return int(self.labels[idx])
+
+    def row(self, idx):
+        """Reconstruct the "left \\t right \\t label" line of pair idx."""
+        left, right = self[idx]
+        return '%s\t%s\t%d\n' % (left, right, self.labels[idx])
+
+    @property
+    def rows(self):
+        """A read-only sequence of the reconstructed lines."""
+        return RowView(self)
+
+    def nbytes(self):
+        """Return the memory held by the arrays of the store."""
+        return self.buffer.nbytes + self.offsets.nbytes + self.labels.nbytes
+
+
+class RowView:
+    """Sequence of the lines of a PairStore, rebuilt on access."""
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return RowView(self.store[idx])
+        return self.store.row(idx)
+
+    def __iter__(self):
+        for idx in range(len(self.store)):
+            yield self.store.row(idx)
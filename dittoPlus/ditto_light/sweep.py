@@ -0,0 +1,149 @@
+import contextlib
+import itertools
+import os
+import queue
+import numpy as np
+
+
+def expand_grid(grid):
+    """Expand a grid of arguments into the list of its configurations.
+
+    Args:
+        grid (Dictionary): the values of every argument, e.g.,
+            {"lm": ["roberta", "distilbert"], "dk": [null, "doduo"]}
+
+    Returns:
+        list of Dictionary: one configuration per combination of values
+    """
+    keys = list(grid)
+    return [dict(zip(keys, values))
+            for values in itertools.product(*[grid[key] for key in keys])]
+
+
+def run_name(params):
+    """The name of a configuration, e.g., lm=roberta_dk=doduo."""
+    return '_'.join('%s=%s' % (key, value) for key, value in params.items()).replace('/', '_')
+
+
+def rung_epochs(min_epochs, eta, n_epochs):
+    """The epochs at which the runs are compared: min_epochs * eta^k < n_epochs."""
+    rungs = []
+    epoch = min_epochs
+    while epoch < n_epochs:
+        rungs.append(epoch)
+        epoch *= eta
+    return rungs
+
+
+def core_slots(cores_per_run, nprocs=None):
+    """Split the available cores into disjoint sets, one per parallel run.
+
+    Args:
+        cores_per_run (int): the number of cores of a run
+        nprocs (int, optional): the number of sets (as many as fit by default)
+
+    Returns:
+        list of list of int: the cores of every set
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    if nprocs is None:
+        nprocs = max(1, len(cores) // cores_per_run)
+    if nprocs * cores_per_run > len(cores):
+        raise ValueError('%d runs of %d cores need more than the %d available cores'
+                         % (nprocs, cores_per_run, len(cores)))
+    return [cores[i * cores_per_run:(i + 1) * cores_per_run] for i in range(nprocs)]
+
+
+def take_slot(free_slots, slots, index, timeout=10.0):
+    """Take the cores of a new worker process.
+
+    The sets of cores are handed out through a queue, one per worker. A
+    worker replacing one that died does not get the dead worker's set back;
+    after the timeout, it takes the set of its worker index instead of
+    waiting forever.
+
+    Args:
+        free_slots (Queue): the sets of cores not taken yet
+        slots (list of list of int): all the sets (see core_slots)
+        index (int): the index of the worker (0 for the first one)
+        timeout (float, optional): the seconds to wait for a free set
+
+    Returns:
+        list of int: the cores of the worker
+    """
+    try:
+        return free_slots.get(timeout=timeout)
+    except queue.Empty:
+        return slots[index % len(slots)]
+
+
+class SuccessiveHalving:
+    """Asynchronous successive halving of the runs of a sweep.
+
+    Every run reports its best dev F1 when it reaches a rung epoch. It is
+    stopped if the score is below the top 1/eta of the scores reported at
+    that rung by the earlier runs; the first eta runs of a rung always go
+    on. The runs are never paused, so a run only waits for the others'
+    scores, never for a free worker.
+
+    Args:
+        rungs (list of int): the rung epochs (see rung_epochs)
+        eta (int, optional): the reduction factor
+        scores (Dictionary, optional): the scores of every rung, shared by
+            the workers (e.g., a multiprocessing.Manager dict)
+        lock (Lock, optional): the lock of scores
+    """
+
+    def __init__(self, rungs, eta=3, scores=None, lock=None):
+        self.rungs = list(rungs)
+        self.eta = eta
+        self.scores = scores if scores is not None else {}
+        self.lock = lock
+
+    def report(self, epoch, dev_f1):
+        """Record the score of a run at an epoch.
+
+        Args:
+            epoch (int): the epoch the run has completed
+            dev_f1 (float): the best dev F1 of the run so far
+
+        Returns:
+            boolean: True if the run should stop
+        """
+        if epoch not in self.rungs:
+            return False
+        with self.lock if self.lock is not None else contextlib.nullcontext():
+            scores = list(self.scores.get(epoch, []))
+            self.scores[epoch] = scores + [dev_f1]
+        if len(scores) < self.eta:
+            return False
+        return dev_f1 < np.quantile(scores, 1.0 - 1.0 / self.eta)
+
+
+def write_summary(path, results, keys):
+    """Write the results of a sweep as a tsv table, best dev F1 first.
+
+    Args:
+        path (str): the output file
+        results (list of Dictionary): the params and the scores of every run
+            (see sweep.py)
+        keys (list of str): the swept arguments (the first columns)
+
+    Returns:
+        list of str: the lines of the table
+    """
+    columns = keys + ['status', 'epochs', 'dev_f1', 'test_f1', 'minutes']
+    lines = ['\t'.join(columns)]
+    for result in sorted(results, key=lambda r: -r['dev_f1']):
+        values = [result['params'][key] for key in keys]
+        values += [result['status'], result['epochs'],
+                   '%.4f' % result['dev_f1'],
+                   '%.4f' % result['test_f1'] if result['test_f1'] is not None else '-',
+                   '%.1f' % (result['seconds'] / 60.0)]
+        lines.append('\t'.join(str(value) for value in values))
+    with open(path, 'w') as fout:
+        fout.write('\n'.join(lines) + '\n')
+    return lines
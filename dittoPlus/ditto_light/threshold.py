@@ -0,0 +1,138 @@
+import numpy as np
+
+
+def threshold_curve(probs, labels):
+    """Compute the confusion counts of every distinct decision threshold.
+
+    The probabilities are sorted once (descending); the pairs predicted as
+    matches for a threshold are then a prefix of the sorted order, so the
+    true/false positives of all the thresholds are cumulative sums. Ties are
+    collapsed into a single threshold.
+
+    Args:
+        probs (np.ndarray): the match probabilities
+        labels (np.ndarray): the 0/1 labels
+
+    Returns:
+        np.ndarray: the thresholds; a pair is a match if its prob > threshold
+        np.ndarray: the number of true positives at each threshold
+        np.ndarray: the number of false positives at each threshold
+        int: the number of positive labels
+    """
+    probs = np.asarray(probs, dtype=np.float64)
+    labels = np.asarray(labels).astype(bool)
+    order = np.argsort(-probs, kind='stable')
+    probs, labels = probs[order], labels[order]
+
+    tp = np.cumsum(labels)
+    fp = np.cumsum(~labels)
+    # the last pair of every group of equal probabilities
+    last = np.flatnonzero(np.append(np.diff(probs) != 0, True))
+    values = probs[last]
+
+    # midpoints between consecutive distinct values (below the lowest one)
+    lowers = np.append(values[1:], min(values[-1], 0.0) - 1e-6) \
+        if len(values) > 0 else values
+    thresholds = (values + lowers) / 2
+    return thresholds, tp[last], fp[last], int(labels.sum())
+
+
+def best_threshold(probs, labels, min_precision=None, min_recall=None):
+    """Find the threshold maximizing the F1 score in O(n log n).
+
+    The search is exact: every distinct probability is a candidate cut, and
+    ties in F1 are broken in favor of the highest threshold. If min_precision
+    or min_recall is set, the F1 is maximized among the thresholds meeting
+    the constraints; if no threshold meets them, the unconstrained optimum is
+    returned.
+
+    Args:
+        probs (np.ndarray): the match probabilities
+        labels (np.ndarray): the 0/1 labels
+        min_precision (float, optional): the min precision of the threshold
+        min_recall (float, optional): the min recall of the threshold
+
+    Returns:
+        float: the F1 score at the threshold
+        float: the threshold (a pair is a match if its prob > threshold)
+    """
+    thresholds, tp, fp, positives = threshold_curve(probs, labels)
+    if len(thresholds) == 0 or positives == 0:
+        return 0.0, 0.5
+
+    f1 = 2 * tp / (tp + fp + positives)
+    feasible = np.ones(len(f1), dtype=bool)
+    if min_precision is not None:
+        feasible &= tp / (tp + fp) >= min_precision
+    if min_recall is not None:
+        feasible &= tp / positives >= min_recall
+    if not feasible.any():
+        feasible[:] = True
+
+    best = np.argmax(np.where(feasible, f1, -1.0))
+    return float(f1[best]), float(thresholds[best])
+
+
+def f1_at(probs, labels, threshold):
+    """Compute the F1 score of the predictions prob > threshold.
+
+    Args:
+        probs (np.ndarray): the match probabilities
+        labels (np.ndarray): the 0/1 labels
+        threshold (float): the threshold
+
+    Returns:
+        float: the F1 score
+    """
+    pred = np.asarray(probs) > threshold
+    labels = np.asarray(labels).astype(bool)
+    tp = np.sum(pred & labels)
+    denominator = pred.sum() + labels.sum()
+    return float(2 * tp / denominator) if denominator > 0 else 0.0
+
+
+def cascade_band(small_probs, large_probs, labels, large_threshold,
+                 max_f1_loss=0.005, num_cuts=100):
+    """Find the uncertainty band of a two-model cascade.
+
+    The pairs whose small-model probability is below low are non-matches,
+    those above high are matches, and the others are decided by the large
+    model (prob > large_threshold). Among the bands whose F1 is within
+    max_f1_loss of the large model's alone, the one sending the fewest pairs
+    to the large model is returned (ties broken by the F1). The cuts are the
+    quantiles of the small-model probabilities.
+
+    Args:
+        small_probs (np.ndarray): the match probabilities of the small model
+        large_probs (np.ndarray): the match probabilities of the large model
+        labels (np.ndarray): the 0/1 labels
+        large_threshold (float): the threshold of the large model
+        max_f1_loss (float, optional): the max F1 loss of the cascade
+        num_cuts (int, optional): the number of candidate cuts
+
+    Returns:
+        float: the lower end of the band
+        float: the upper end of the band
+        float: the F1 score of the cascade
+        float: the share of the pairs scored by the large model
+    """
+    small_probs = np.asarray(small_probs, dtype=np.float64)
+    large_pred = np.asarray(large_probs) > large_threshold
+    target = f1_at(large_probs, labels, large_threshold) - max_f1_loss
+
+    cuts = np.unique(np.quantile(small_probs, np.linspace(0, 1, num_cuts + 1))) \
+        if len(small_probs) > 0 else np.zeros(0)
+    # low = 0 rejects nothing, high = 1 accepts nothing
+    lows = np.concatenate([[0.0], cuts])
+    highs = np.concatenate([cuts, [1.0]])
+
+    best = (0.0, 1.0, target + max_f1_loss, 1.0)
+    for low in lows:
+        for high in highs[highs >= low]:
+            inside = (small_probs >= low) & (small_probs <= high)
+            pred = np.where(inside, large_pred, small_probs > high)
+            f1 = f1_at(pred, labels, 0.5)
+            passed = float(inside.mean())
+            if f1 >= target and (passed, -f1) < (best[3], -best[2]):
+                best = (float(low), float(high), f1, passed)
+    return best
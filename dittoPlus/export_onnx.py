@@ -0,0 +1,48 @@
+import os
+import argparse
+import sys
+
+from ditto_light.dataset import DittoDataset
+from ditto_light.export import OnnxModel, check_parity, export_onnx, onnx_path
+from ditto_light.loader import make_loader
+from matcher import load_model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--task", type=str, default='Structured/Beer')
+    parser.add_argument("--lm", type=str, default='distilbert')
+    parser.add_argument("--checkpoint_path", type=str, default='checkpoints/')
+    parser.add_argument("--max_len", type=int, default=256)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--kbert", dest="kbert", action="store_true")
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    hp = parser.parse_args()
+    if hp.kbert and hp.lm != 'roberta':
+        parser.error('--kbert needs --lm roberta (RobertaWithVM)')
+
+    config, model = load_model(hp.task, hp.checkpoint_path, hp.lm, False,
+                               fp16=False)
+
+    # the plain graph, and the K-BERT one (with vm and position_ids) if asked
+    for kbert in [False, True] if hp.kbert else [False]:
+        path = onnx_path(os.path.join(hp.checkpoint_path, hp.task, 'model.pt'), vm=kbert)
+        export_onnx(model, path, vm=kbert, opset=hp.opset)
+
+        # numerical parity with PyTorch on the validset
+        dataset = DittoDataset(config['validset'],
+                               max_len=hp.max_len,
+                               lm=hp.lm,
+                               kbert=kbert)
+        iterator = make_loader(dataset,
+                               batch_size=hp.batch_size,
+                               shuffle=False,
+                               collate_fn=dataset.pad)
+        onnx_model = OnnxModel(path, threads=hp.threads)
+        diff, torch_f1, onnx_f1 = check_parity(model, onnx_model, iterator)
+        print(f"{path}: threads={onnx_model.threads}, max_prob_diff={diff}, "
+              f"torch_f1={torch_f1}, onnx_f1={onnx_f1}")
+        if diff > hp.atol:
+            sys.exit(f"{path} differs from the PyTorch model by {diff} > {hp.atol}")
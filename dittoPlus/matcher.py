@@ -12,15 +12,25 @@ import argparse
 import sys
 import sklearn
 import traceback
+import warnings
 
 from torch.utils import data
 from tqdm import tqdm
-from apex import amp
 from scipy.special import softmax
 
 from ditto_light.ditto import evaluate, DittoModel
 from ditto_light.exceptions import ModelNotFoundError
-from ditto_light.dataset import DittoDataset
+from ditto_light.dataset import DittoDataset, get_ditto_tokenizer
+from ditto_light.sampler import BucketBatchSampler, restore_order
+from ditto_light.loader import make_loader
+from ditto_light.quantize import load_quantized
+from ditto_light.export import OnnxModel, export_onnx, onnx_path
+from ditto_light.early_exit import calibrate_exits, checkpoint_exit_layers, format_exit_report, \
+    exit_thresholds_path, load_exit_thresholds, save_exit_thresholds
+from ditto_light.distill import checkpoint_num_layers
+from ditto_light.biencoder import BiEncoder, checkpoint_bi_encoder
+from ditto_light.prefilter import load_prefilter, read_pairs
+from ditto_light.threshold import best_threshold, cascade_band
 from ditto_light.summarize import Summarizer
 from ditto_light.knowledge import *
 
@@ -70,12 +80,386 @@ def to_str(ent1, ent2, summarizer=None, max_len=256, dk_injector=None):
     return new_ent1 + '\t' + new_ent2 + '\t0'
 
 
+class MatchSession:
+    """A long-lived matching session.
+
+    The tokenizer, the model, the threshold and the optional summarizer and
+    domain-knowledge injector are set up once, then any number of pairs can
+    be scored in micro-batches of batch_size.
+
+    Args:
+        config (Dictionary): task configuration
+        model (DittoModel): the model for prediction
+        lm (str, optional): the language model
+        max_len (int, optional): the max sequence length
+        batch_size (int, optional): the micro-batch size of the forward pass
+        summarizer (Summarizer, optional): the summarization module
+        dk_injector (DKInjector, optional): the domain-knowledge injector
+        threshold (float, optional): the threshold of the 0's class
+        num_workers (int, optional): the number of data loading processes
+        pack (boolean, optional): pack several pairs per sequence (see
+            DittoDataset.pack_batch)
+        prefilter (PreFilter, optional): a calibrated lexical pre-filter;
+            the pairs it rejects or accepts are not scored by the model
+        bi_encoder (BiEncoder, optional): a calibrated bi-encoder stage
+            run on the serialized pairs; the pairs outside its band are not
+            scored by the cross-encoder
+        bucket (boolean, optional): score pairs of similar token length
+            together (the pairs are tokenized once more to get their lengths)
+
+    Attributes:
+        tokenizer (Tokenizer): the tokenizer shared by all the batches
+    """
+    def __init__(self, config, model,
+                 lm='distilbert',
+                 max_len=256,
+                 batch_size=64,
+                 summarizer=None,
+                 dk_injector=None,
+                 threshold=None,
+                 num_workers=0,
+                 pack=False,
+                 prefilter=None,
+                 bi_encoder=None,
+                 bucket=False):
+        self.config = config
+        self.model = model
+        self.lm = lm
+        self.max_len = max_len
+        self.batch_size = batch_size
+        self.summarizer = summarizer
+        self.dk_injector = dk_injector
+        self.threshold = threshold
+        self.num_workers = num_workers
+        self.pack = pack
+        self.prefilter = prefilter
+        self.bi_encoder = bi_encoder
+        self.bucket = bucket
+        self.tokenizer = get_ditto_tokenizer(lm)
+
+    @classmethod
+    def load(cls, task, path, lm='distilbert', use_gpu=False, fp16=False,
+             summarize=False, dk=None, precision='fp32', attn='eager',
+             quantize=None, engine='torch', threads=None, prefilter=False,
+             bi_encoder=False, bi_cache_size=100000, **kwargs):
+        """Load the model of a task and create a session around it.
+
+        Args:
+            task (str): the task name
+            path (str): the path of the checkpoint directory
+            lm (str, optional): the language model
+            use_gpu (boolean, optional): whether to use gpu
+            fp16 (boolean, optional): whether to use fp16
+            summarize (boolean, optional): whether to summarize the pairs
+            dk (str, optional): the domain-knowledge injector name
+            precision (str, optional): 'fp32', 'bf16' or 'fp16' autocast
+            attn (str, optional): the attention implementation, 'eager' or 'sdpa'
+            quantize (str, optional): 'int8' for the quantized CPU model
+            engine (str, optional): 'torch' or 'onnxruntime'
+            threads (int, optional): the intra-op threads of onnxruntime
+            prefilter (boolean, optional): train a lexical pre-filter on the
+                trainset, or load it from prefilter.pkl next to the
+                checkpoint (to be calibrated, see tune_threshold)
+            bi_encoder (boolean, optional): score the pairs with the
+                bi-encoder head of the checkpoint first (to be calibrated,
+                see tune_threshold)
+            bi_cache_size (int, optional): the max number of entry embeddings
+                cached by the bi-encoder (unbounded if None)
+            **kwargs: other arguments of MatchSession (e.g., batch_size)
+
+        Returns:
+            MatchSession: the session
+        """
+        config, model = load_model(task, path, lm, use_gpu, fp16,
+                                   precision=precision,
+                                   attn=attn,
+                                   quantize=quantize,
+                                   engine=engine,
+                                   threads=threads)
+
+        summarizer = dk_injector = None
+        if summarize:
+            summarizer = Summarizer(config, lm)
+
+        if dk is not None:
+            if 'product' in dk:
+                dk_injector = ProductDKInjector(config, dk)
+            else:
+                dk_injector = GeneralDKInjector(config, dk)
+
+        if prefilter:
+            prefilter = load_prefilter(config['trainset'],
+                                       os.path.join(path, task, 'prefilter.pkl'))
+        else:
+            prefilter = None
+
+        session = cls(config, model, lm=lm,
+                      summarizer=summarizer,
+                      dk_injector=dk_injector,
+                      prefilter=prefilter, **kwargs)
+        if bi_encoder:
+            session.bi_encoder = BiEncoder(model, session.tokenizer,
+                                           max_len=session.max_len,
+                                           batch_size=session.batch_size,
+                                           cache_size=bi_cache_size)
+        return session
+
+    def dataset(self, sentence_pairs):
+        """Wrap serialized pairs into a DittoDataset sharing the tokenizer."""
+        return DittoDataset(sentence_pairs,
+                            max_len=self.max_len,
+                            lm=self.lm,
+                            tokenizer=self.tokenizer,
+                            pack=self.pack)
+
+    def serialize(self, ent1, ent2):
+        """Serialize a pair of data entries (see to_str)."""
+        return to_str(ent1, ent2, self.summarizer, self.max_len,
+                      self.dk_injector)
+
+    def classify(self, sentence_pairs):
+        """Apply the model to a list of serialized pairs.
+
+        Args:
+            sentence_pairs (list of str): the sequence pairs
+
+        Returns:
+            list of int: the predictions
+            list of list of float: the logits of the pairs
+        """
+        dataset = self.dataset(sentence_pairs)
+        sampler = None
+        if self.bucket:
+            # score pairs of similar length together, then restore the order
+            sampler = BucketBatchSampler(dataset.lengths(), self.batch_size,
+                                         shuffle=False)
+            iterator = make_loader(dataset,
+                                   num_workers=self.num_workers,
+                                   batch_sampler=sampler,
+                                   collate_fn=dataset.pad)
+        else:
+            iterator = make_loader(dataset,
+                                   num_workers=self.num_workers,
+                                   batch_size=self.batch_size,
+                                   shuffle=False,
+                                   collate_fn=dataset.pad)
+
+        # prediction
+        all_probs = []
+        all_logits = []
+        with torch.no_grad():
+            for i, batch in enumerate(iterator):
+                if len(batch) == 5:
+                    x, positions, segments, cls_index, _ = batch
+                    logits = self.model(x, position_ids=positions, segments=segments,
+                                        cls_index=cls_index)
+                else:
+                    x, _ = batch
+                    logits = self.model(x)
+                probs = logits.softmax(dim=1)[:, 1]
+                all_probs += probs.cpu().numpy().tolist()
+                all_logits += logits.cpu().numpy().tolist()
+
+        if sampler is not None:
+            all_probs = restore_order(all_probs, sampler.order())
+            all_logits = restore_order(all_logits, sampler.order())
+
+        threshold = self.threshold
+        if threshold is None:
+            threshold = 0.5
+
+        pred = [1 if p > threshold else 0 for p in all_probs]
+        return pred, all_logits
+
+    def match(self, rows, chunk_size=1024):
+        """Score an iterable of raw entry pairs.
+
+        Args:
+            rows (iterable): pairs of data entries (str or Dictionary)
+            chunk_size (int, optional): the number of pairs serialized and
+                classified together
+
+        Yields:
+            row: the input pair
+            int: the prediction
+            float: the confidence of the prediction
+        """
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield from self._match_chunk(chunk)
+                chunk = []
+
+        if len(chunk) > 0:
+            yield from self._match_chunk(chunk)
+
+    def _match_chunk(self, rows):
+        # the pairs decided by the pre-filter (on the plain serialization)
+        # are neither summarized nor scored by the model
+        decisions = np.full(len(rows), -1)
+        probs = np.zeros(len(rows))
+        if self.prefilter is not None:
+            decisions, probs = self.prefilter.decide([to_str(row[0], row[1]) for row in rows])
+
+        todo = np.flatnonzero(decisions < 0)
+        pairs = [self.serialize(rows[i][0], rows[i][1]) for i in todo]
+        if self.bi_encoder is not None and len(todo) > 0:
+            # then the bi-encoder, from the cached embeddings of the entries
+            bi_decisions, probs[todo] = self.bi_encoder.decide(pairs)
+            decisions[todo] = bi_decisions
+            pairs = [pair for pair, decision in zip(pairs, bi_decisions) if decision < 0]
+            todo = todo[bi_decisions < 0]
+
+        if len(todo) > 0:
+            predictions, logits = self.classify(pairs)
+            scores = softmax(logits, axis=1)
+            model_results = dict(zip(todo.tolist(), zip(predictions, scores)))
+
+        for i, row in enumerate(rows):
+            if decisions[i] < 0:
+                pred, score = model_results[i]
+                yield row, pred, score[int(pred)]
+            else:
+                pred = int(decisions[i])
+                yield row, pred, probs[i] if pred == 1 else 1.0 - probs[i]
+
+
+class CascadeSession:
+    """A two-tier matching session: a small model first, a large one for the
+    uncertain pairs.
+
+    Every pair is scored by the small session; the pairs whose match
+    probability falls within [low, high] are scored again by the large
+    session, which decides them (see tune_cascade for the band). The time and
+    number of pairs of each tier are kept in stats.
+
+    Args:
+        small (MatchSession): the session of the small model (e.g., distilbert)
+        large (MatchSession): the session of the large model (e.g., roberta)
+        low (float, optional): the lower end of the uncertainty band
+        high (float, optional): the upper end of the uncertainty band
+
+    Attributes:
+        stats (Dictionary): the number of pairs and the seconds of each tier
+    """
+    def __init__(self, small, large, low=0.0, high=1.0):
+        self.small = small
+        self.large = large
+        self.low = low
+        self.high = high
+        self.config = large.config
+        self.lm = '%s+%s' % (small.lm, large.lm)
+        self.summarizer = large.summarizer
+        self.dk_injector = large.dk_injector
+        self.stats = {'small': [0, 0.0], 'large': [0, 0.0]}
+
+    @classmethod
+    def load(cls, task, small_path, large_path, small_lm='distilbert',
+             large_lm='roberta', **kwargs):
+        """Load the small and the large model of a task.
+
+        Args:
+            task (str): the task name
+            small_path (str): the checkpoint directory of the small model
+            large_path (str): the checkpoint directory of the large model
+            small_lm (str, optional): the language model of the small model
+            large_lm (str, optional): the language model of the large model
+            **kwargs: the other arguments of MatchSession.load, shared by
+                both sessions
+
+        Returns:
+            CascadeSession: the session
+        """
+        small = MatchSession.load(task, small_path, lm=small_lm, **kwargs)
+        large = MatchSession.load(task, large_path, lm=large_lm, **kwargs)
+        return cls(small, large)
+
+    def probs(self, tier, rows):
+        """Score raw entry pairs with one tier, timed in stats.
+
+        Args:
+            tier (str): 'small' or 'large'
+            rows (list): pairs of data entries (str or Dictionary)
+
+        Returns:
+            np.ndarray: the match probabilities
+        """
+        session = getattr(self, tier)
+        start_time = time.time()
+        pairs = [session.serialize(row[0], row[1]) for row in rows]
+        _, logits = session.classify(pairs)
+        self.stats[tier][0] += len(rows)
+        self.stats[tier][1] += time.time() - start_time
+        return softmax(np.asarray(logits), axis=1)[:, 1]
+
+    def match(self, rows, chunk_size=1024):
+        """Score an iterable of raw entry pairs.
+
+        Args:
+            rows (iterable): pairs of data entries (str or Dictionary)
+            chunk_size (int, optional): the number of pairs classified
+                together
+
+        Yields:
+            row: the input pair
+            int: the prediction
+            float: the confidence of the prediction
+            str: the tier deciding the pair ('small' or 'large')
+        """
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield from self._match_chunk(chunk)
+                chunk = []
+
+        if len(chunk) > 0:
+            yield from self._match_chunk(chunk)
+
+    def _match_chunk(self, rows):
+        small_probs = self.probs('small', rows)
+        uncertain = np.flatnonzero((small_probs >= self.low) & (small_probs <= self.high))
+        large_probs = {}
+        if len(uncertain) > 0:
+            probs = self.probs('large', [rows[i] for i in uncertain])
+            large_probs = dict(zip(uncertain.tolist(), probs))
+
+        large_threshold = self.large.threshold if self.large.threshold is not None else 0.5
+        for i, row in enumerate(rows):
+            if i in large_probs:
+                prob, tier = large_probs[i], 'large'
+                pred = int(prob > large_threshold)
+            else:
+                prob, tier = small_probs[i], 'small'
+                pred = int(prob > self.high)
+            yield row, pred, prob if pred == 1 else 1.0 - prob, tier
+
+    def throughput(self):
+        """Return the pairs/s of each tier and the share of the pairs
+        scored by the large model."""
+        rates = {tier: count / seconds if seconds > 0 else 0.0
+                 for tier, (count, seconds) in self.stats.items()}
+        total_time = self.stats['small'][1] + self.stats['large'][1]
+        rates['cascade'] = self.stats['small'][0] / total_time if total_time > 0 else 0.0
+        rates['large_share'] = self.stats['large'][0] / max(self.stats['small'][0], 1)
+        return rates
+
+
+# the sessions of classify, one per (lm, max_len)
+_sessions = {}
+
+
 def classify(sentence_pairs, model,
              lm='distilbert',
              max_len=256,
              threshold=None):
     """Apply the MRPC model.
 
+    The MatchSession (and its tokenizer) is created on the first call for a
+    (lm, max_len) and reused by the next calls; the model and the threshold
+    are the ones of the current call.
+
     Args:
         sentence_pairs (list of str): the sequence pairs
         model (MultiTaskNet): the model in pytorch
@@ -85,35 +469,14 @@ def classify(sentence_pairs, model,
     Returns:
         list of float: the scores of the pairs
     """
-    inputs = sentence_pairs
-    # print('max_len =', max_len)
-    dataset = DittoDataset(inputs,
-                           max_len=max_len,
-                           lm=lm)
-    # print(dataset[0])
-    iterator = data.DataLoader(dataset=dataset,
-                               batch_size=len(dataset),
-                               shuffle=False,
-                               num_workers=0,
-                               collate_fn=DittoDataset.pad)
-
-    # prediction
-    all_probs = []
-    all_logits = []
-    with torch.no_grad():
-        # print('Classification')
-        for i, batch in enumerate(iterator):
-            x, _ = batch
-            logits = model(x)
-            probs = logits.softmax(dim=1)[:, 1]
-            all_probs += probs.cpu().numpy().tolist()
-            all_logits += logits.cpu().numpy().tolist()
-
-    if threshold is None:
-        threshold = 0.5
-
-    pred = [1 if p > threshold else 0 for p in all_probs]
-    return pred, all_logits
+    key = (lm, max_len)
+    if key not in _sessions:
+        _sessions[key] = MatchSession(None, model, lm=lm, max_len=max_len)
+    session = _sessions[key]
+    session.model = model
+    session.threshold = threshold
+    session.batch_size = max(len(sentence_pairs), 1)
+    return session.classify(sentence_pairs)
 
 def predict(input_path, output_path, config,
             model,
@@ -122,7 +485,8 @@ def predict(input_path, output_path, config,
             lm='distilbert',
             max_len=256,
             dk_injector=None,
-            threshold=None):
+            threshold=None,
+            session=None):
     """Run the model over the input file containing the candidate entry pairs
 
     Args:
@@ -135,29 +499,20 @@ def predict(input_path, output_path, config,
         max_len (int, optional): the max sequence length
         dk_injector (DKInjector, optional): the domain-knowledge injector
         threshold (float, optional): the threshold of the 0's class
+        session (MatchSession, optional): a session to reuse; the model,
+            summarizer, lm, max_len, injector and threshold arguments
+            are ignored if it is set
 
     Returns:
         None
     """
-    pairs = []
-
-    def process_batch(rows, pairs, writer):
-        predictions, logits = classify(pairs, model, lm=lm,
-                                       max_len=max_len,
-                                       threshold=threshold)
-        # try:
-        #     predictions, logits = classify(pairs, model, lm=lm,
-        #                                    max_len=max_len,
-        #                                    threshold=threshold)
-        # except:
-        #     # ignore the whole batch
-        #     return
-        scores = softmax(logits, axis=1)
-        for row, pred, score in zip(rows, predictions, scores):
-            output = {'left': row[0], 'right': row[1],
-                'match': pred,
-                'match_confidence': score[int(pred)]}
-            writer.write(output)
+    if session is None:
+        session = MatchSession(config, model,
+                               lm=lm,
+                               max_len=max_len,
+                               summarizer=summarizer,
+                               dk_injector=dk_injector,
+                               threshold=threshold)
 
     # input_path can also be train/valid/test.txt
     # convert to jsonlines
@@ -171,69 +526,106 @@ def predict(input_path, output_path, config,
     start_time = time.time()
     with jsonlines.open(input_path) as reader,\
          jsonlines.open(output_path, mode='w') as writer:
-        pairs = []
-        rows = []
-        for idx, row in tqdm(enumerate(reader)):
-            pairs.append(to_str(row[0], row[1], summarizer, max_len, dk_injector))
-            rows.append(row)
-            if len(pairs) == batch_size:
-                process_batch(rows, pairs, writer)
-                pairs.clear()
-                rows.clear()
-
-        if len(pairs) > 0:
-            process_batch(rows, pairs, writer)
+        # a CascadeSession also yields the tier deciding each pair
+        for row, pred, confidence, *tier in tqdm(session.match(reader, chunk_size=batch_size)):
+            output = {'left': row[0], 'right': row[1],
+                'match': pred,
+                'match_confidence': confidence}
+            if tier:
+                output['tier'] = tier[0]
+            writer.write(output)
 
     run_time = time.time() - start_time
-    run_tag = '%s_lm=%s_dk=%s_su=%s' % (config['name'], lm, str(dk_injector != None), str(summarizer != None))
+    run_tag = '%s_lm=%s_dk=%s_su=%s' % (config['name'], session.lm,
+                                        str(session.dk_injector != None),
+                                        str(session.summarizer != None))
     os.system('echo %s %f >> log.txt' % (run_tag, run_time))
 
 
-def tune_threshold(config, model, hp):
-    """Tune the prediction threshold for a given model on a validation set"""
+def tune_threshold(config, model, hp, session=None):
+    """Tune the prediction threshold for a given model on a validation set
+
+    If a MatchSession is given, its tokenizer, summarizer and injector are
+    reused and its threshold is set to the tuned value.
+    """
     validset = config['validset']
     task = hp.task
 
+    if session is None:
+        session = MatchSession(config, model,
+                               lm=hp.lm,
+                               max_len=hp.max_len)
+        if hp.summarize:
+            session.summarizer = Summarizer(config, lm=hp.lm)
+
+        if hp.dk is not None:
+            if hp.dk == 'product':
+                session.dk_injector = ProductDKInjector(config, hp.dk)
+            else:
+                session.dk_injector = GeneralDKInjector(config, hp.dk)
+
     # summarize the sequences up to the max sequence length
     set_seed(123)
-    summarizer = injector = None
-    if hp.summarize:
-        summarizer = Summarizer(config, lm=hp.lm)
-        validset = summarizer.transform_file(validset, max_len=hp.max_len, overwrite=True)
-
-    if hp.dk is not None:
-        if hp.dk == 'product':
-            injector = ProductDKInjector(config, hp.dk)
-        else:
-            injector = GeneralDKInjector(config, hp.dk)
+    if session.summarizer is not None:
+        validset = session.summarizer.transform_file(validset, max_len=hp.max_len, overwrite=True)
 
-        validset = injector.transform_file(validset)
+    if session.dk_injector is not None:
+        validset = session.dk_injector.transform_file(validset, validset + '.dk')
 
     # load dev sets
-    valid_dataset = DittoDataset(validset,
-                                 max_len=hp.max_len,
-                                 lm=hp.lm)
-
-    # print(valid_dataset[0])
+    valid_dataset = session.dataset(validset)
 
-    valid_iter = data.DataLoader(dataset=valid_dataset,
-                                 batch_size=64,
-                                 shuffle=False,
-                                 num_workers=0,
-                                 collate_fn=DittoDataset.pad)
+    valid_iter = make_loader(valid_dataset,
+                             num_workers=session.num_workers,
+                             batch_size=session.batch_size,
+                             shuffle=False,
+                             collate_fn=valid_dataset.pad)
 
     # acc, prec, recall, f1, v_loss, th = eval_classifier(model, valid_iter,
     #                                                     get_threshold=True)
-    f1, th = evaluate(model, valid_iter, threshold=None)
+    f1, th = evaluate(model, valid_iter, threshold=None,
+                      min_precision=hp.min_precision,
+                      min_recall=hp.min_recall)
+
+    if session.prefilter is not None:
+        # the band of the pre-filter, on the unprocessed validset
+        report = session.prefilter.calibrate(*read_pairs(config['validset']),
+                                             max_recall_loss=hp.prefilter_recall_loss,
+                                             min_precision=hp.prefilter_precision)
+        print("prefilter: rejected=%.3f, accepted=%.3f, passed=%.3f, recall_loss=%.3f, accept_precision=%.3f"
+              % (report['rejected'], report['accepted'], report['passed'],
+                 report['recall_loss'], report['accept_precision']))
+
+    if session.bi_encoder is not None:
+        # the band of the bi-encoder, against the cross-encoder at its threshold
+        pairs, labels = read_pairs(validset)
+        _, logits = session.classify(pairs)
+        f1, passed = session.bi_encoder.calibrate(pairs, labels, softmax(logits, axis=1)[:, 1],
+                                                  threshold=th,
+                                                  max_f1_loss=hp.bi_tolerance)
+        print("bi-encoder: low=%f, high=%f, f1=%f, passed=%.3f, entities=%d"
+              % (session.bi_encoder.low, session.bi_encoder.high, f1, passed,
+                 len(session.bi_encoder.cache)))
+
+    if hp.early_exit:
+        # the confident pairs stop at the exit heads from now on; the
+        # thresholds are calibrated once per checkpoint (see model.exits.json)
+        checkpoint = os.path.join(hp.checkpoint_path, task, 'model.pt')
+        if load_exit_thresholds(model, checkpoint, th, hp.exit_tolerance):
+            print("exit thresholds (%s):" % exit_thresholds_path(checkpoint),
+                  model.exit_thresholds)
+        else:
+            report = calibrate_exits(model, valid_iter, threshold=th,
+                                     max_disagreement=hp.exit_tolerance)
+            save_exit_thresholds(model, checkpoint, th, hp.exit_tolerance)
+            print("exit thresholds:", model.exit_thresholds)
+            print(format_exit_report(report, model.bert.config.num_hidden_layers))
 
     # verify F1
     set_seed(123)
+    session.threshold = th
     predict(validset, "tmp.jsonl", config, model,
-            summarizer=summarizer,
-            max_len=hp.max_len,
-            lm=hp.lm,
-            dk_injector=injector,
-            threshold=th)
+            session=session)
 
     predicts = []
     with jsonlines.open("tmp.jsonl", mode="r") as reader:
@@ -250,11 +642,67 @@ def tune_threshold(config, model, hp):
     print("load_f1 =", f1)
     print("real_f1 =", real_f1)
 
+    if hp.quantize is not None:
+        # the accuracy lost by quantization, each model at its own threshold
+        _, fp32_model = load_model(task, hp.checkpoint_path, hp.lm, False,
+                                   fp16=False, attn=hp.attn)
+        fp32_f1, fp32_th = evaluate(fp32_model, valid_iter, threshold=None,
+                                    min_precision=hp.min_precision,
+                                    min_recall=hp.min_recall)
+        print("fp32_f1 =", fp32_f1)
+        print("%s_f1 - fp32_f1 = %f" % (hp.quantize, f1 - fp32_f1))
+        del fp32_model
+
     return th
 
 
 
-def load_model(task, path, lm, use_gpu, fp16=True):
+def tune_cascade(config, hp, session):
+    """Tune the thresholds and the uncertainty band of a CascadeSession.
+
+    Both models score the whole validset; the threshold of each model
+    maximizes its F1, then the band sending the fewest pairs to the large
+    model with an F1 within hp.cascade_tolerance of the large model's is
+    searched (see threshold.cascade_band).
+
+    Returns:
+        float: the lower end of the band
+        float: the upper end of the band
+    """
+    rows, labels = [], []
+    with open(config['validset']) as fin:
+        for line in fin:
+            left, right, label = line.strip('\n').split('\t')
+            rows.append((left, right))
+            labels.append(int(label))
+    labels = np.array(labels)
+
+    set_seed(123)
+    small_probs = session.probs('small', rows)
+    large_probs = session.probs('large', rows)
+    small_f1, session.small.threshold = best_threshold(small_probs, labels,
+                                                       min_precision=hp.min_precision,
+                                                       min_recall=hp.min_recall)
+    large_f1, session.large.threshold = best_threshold(large_probs, labels,
+                                                       min_precision=hp.min_precision,
+                                                       min_recall=hp.min_recall)
+    session.low, session.high, f1, passed = cascade_band(small_probs, large_probs, labels,
+                                                         session.large.threshold,
+                                                         max_f1_loss=hp.cascade_tolerance)
+    rates = session.throughput()
+    print("small_f1 =", small_f1)
+    print("large_f1 =", large_f1)
+    print("cascade_f1 =", f1)
+    print("band = [%f, %f], large_share = %f" % (session.low, session.high, passed))
+    print("small pairs/s = %.1f, large pairs/s = %.1f, cascade pairs/s = %.1f (estimated)"
+          % (rates['small'], rates['large'],
+             1.0 / (1.0 / max(rates['small'], 1e-9) + passed / max(rates['large'], 1e-9))))
+    session.stats = {'small': [0, 0.0], 'large': [0, 0.0]}
+    return session.low, session.high
+
+
+def load_model(task, path, lm, use_gpu, fp16=False, precision='fp32', attn='eager',
+               quantize=None, engine='torch', threads=None):
     """Load a model for a specific task.
 
     Args:
@@ -262,7 +710,17 @@ def load_model(task, path, lm, use_gpu, fp16=True):
         path (str): the path of the checkpoint directory
         lm (str): the language model
         use_gpu (boolean): whether to use gpu
-        fp16 (boolean, optional): whether to use fp16
+        fp16 (boolean, optional): whether to use fp16 on the GPU (same as
+            precision='fp16'); ignored with a warning on the CPU
+        precision (str, optional): the autocast precision of the model,
+            'fp32', 'bf16' (e.g., on CPU) or 'fp16'
+        attn (str, optional): the attention implementation, 'eager' or 'sdpa'
+        quantize (str, optional): if 'int8', load the dynamically quantized
+            model on the CPU (see ditto_light/quantize.py)
+        engine (str, optional): 'torch', or 'onnxruntime' to run the
+            exported graph (see export_onnx.py) on the CPU
+        threads (int, optional): the intra-op threads of onnxruntime
+            (tuned if not set)
 
     Returns:
         Dictionary: the task config
@@ -278,20 +736,47 @@ def load_model(task, path, lm, use_gpu, fp16=True):
     config = configs[task]
     config_list = [config]
 
-    if use_gpu:
+    if engine == 'onnxruntime':
+        # the graph is exported on first use, and again if model.pt is newer
+        graph = onnx_path(checkpoint)
+        if not os.path.exists(graph) or \
+           os.path.getmtime(graph) < os.path.getmtime(checkpoint):
+            saved_state = torch.load(checkpoint, map_location=lambda storage, loc: storage)
+            model = DittoModel(device='cpu', lm=lm,
+                               exit_layers=checkpoint_exit_layers(saved_state['model']),
+                               num_layers=checkpoint_num_layers(saved_state['model']),
+                               bi_encoder=checkpoint_bi_encoder(saved_state['model']))
+            model.load_state_dict(saved_state['model'])
+            export_onnx(model, graph)
+        return config, OnnxModel(graph, threads=threads)
+
+    if use_gpu and quantize is None:
         device = 'cuda' if torch.cuda.is_available() else 'cpu'
     else:
         device = 'cpu'
 
-    model = DittoModel(device=device, lm=lm)
+    if fp16:
+        if 'cuda' in device:
+            precision = 'fp16'
+        else:
+            warnings.warn('fp16 needs a GPU, the model runs in %s on the CPU' % precision)
 
     saved_state = torch.load(checkpoint, map_location=lambda storage, loc: storage)
+    # the early-exit heads, the (distilled) depth and the bi-encoder head of the checkpoint
+    model = DittoModel(device=device, lm=lm,
+                       precision=precision,
+                       attn=attn,
+                       exit_layers=checkpoint_exit_layers(saved_state['model']),
+                       num_layers=checkpoint_num_layers(saved_state['model']),
+                       bi_encoder=checkpoint_bi_encoder(saved_state['model']))
+
+    if quantize is not None:
+        # quantized once, then reloaded from model.<quantize>.pt
+        return config, load_quantized(model, checkpoint, quantize)
+
     model.load_state_dict(saved_state['model'])
     model = model.to(device)
 
-    if fp16 and 'cuda' in device:
-        model = amp.initialize(model, opt_level='O2')
-
     return config, model
 
 
@@ -303,34 +788,104 @@ if __name__ == "__main__":
     parser.add_argument("--lm", type=str, default='distilbert')
     parser.add_argument("--use_gpu", dest="use_gpu", action="store_true")
     parser.add_argument("--fp16", dest="fp16", action="store_true")
+    parser.add_argument("--precision", type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument("--attn", type=str, default='eager', choices=['eager', 'sdpa'])
+    parser.add_argument("--quantize", type=str, default=None, choices=['int8'])
+    parser.add_argument("--engine", type=str, default='torch', choices=['torch', 'onnxruntime'])
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--early_exit", dest="early_exit", action="store_true")
+    parser.add_argument("--exit_tolerance", type=float, default=0.01)
+    parser.add_argument("--prefilter", dest="prefilter", action="store_true")
+    parser.add_argument("--prefilter_recall_loss", type=float, default=0.01)
+    parser.add_argument("--prefilter_precision", type=float, default=None)
+    parser.add_argument("--bi_encoder", dest="bi_encoder", action="store_true")
+    parser.add_argument("--bi_tolerance", type=float, default=0.005)
+    parser.add_argument("--bi_cache_size", type=int, default=100000)
+    parser.add_argument("--cascade", dest="cascade", action="store_true")
+    parser.add_argument("--small_lm", type=str, default='distilbert')
+    parser.add_argument("--small_checkpoint_path", type=str, default=None)
+    parser.add_argument("--cascade_tolerance", type=float, default=0.005)
+    parser.add_argument("--min_precision", type=float, default=None)
+    parser.add_argument("--min_recall", type=float, default=None)
     parser.add_argument("--checkpoint_path", type=str, default='checkpoints/')
     parser.add_argument("--dk", type=str, default=None)
     parser.add_argument("--summarize", dest="summarize", action="store_true")
     parser.add_argument("--max_len", type=int, default=256)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--num_workers", type=int, default=0)
+    parser.add_argument("--pack", dest="pack", action="store_true")
+    parser.add_argument("--bucket", dest="bucket", action="store_true")
     hp = parser.parse_args()
-
-    # load the models
-    set_seed(123)
-    config, model = load_model(hp.task, hp.checkpoint_path,
-                       hp.lm, hp.use_gpu, hp.fp16)
-
-    summarizer = dk_injector = None
-    if hp.summarize:
-        summarizer = Summarizer(config, hp.lm)
-
-    if hp.dk is not None:
-        if 'product' in hp.dk:
-            dk_injector = ProductDKInjector(config, hp.dk)
-        else:
-            dk_injector = GeneralDKInjector(config, hp.dk)
-
-    # tune threshold
-    threshold = tune_threshold(config, model, hp)
-
-    # run prediction
-    predict(hp.input_path, hp.output_path, config, model,
-            summarizer=summarizer,
-            max_len=hp.max_len,
-            lm=hp.lm,
-            dk_injector=dk_injector,
-            threshold=threshold)
+    if hp.engine == 'onnxruntime' and (hp.quantize is not None or hp.pack):
+        parser.error('--engine onnxruntime runs the fp32 graph of plain batches '
+                     '(no --quantize or --pack)')
+    if hp.early_exit and (hp.engine == 'onnxruntime' or hp.pack):
+        parser.error('--early_exit needs the torch engine and plain batches (no --pack)')
+    if hp.early_exit and hp.lm != 'roberta':
+        parser.error('--early_exit needs --lm roberta (the exit heads run its encoder layers)')
+    if hp.cascade and (hp.small_checkpoint_path is None or hp.early_exit or hp.prefilter):
+        parser.error('--cascade needs --small_checkpoint_path (and no --early_exit or --prefilter)')
+    if hp.bi_encoder and (hp.engine == 'onnxruntime' or hp.cascade):
+        parser.error('--bi_encoder needs the torch engine (and no --cascade)')
+    if hp.pack and (hp.lm != 'roberta' or (hp.cascade and hp.small_lm != 'roberta')):
+        parser.error('--pack needs roberta (RobertaWithVM) models; with --cascade, '
+                     'use --small_lm roberta (e.g., a distilled checkpoint)')
+
+    if hp.cascade:
+        # the small model scores every pair, the large one (--lm) the uncertain ones
+        set_seed(123)
+        session = CascadeSession.load(hp.task, hp.small_checkpoint_path, hp.checkpoint_path,
+                                      small_lm=hp.small_lm,
+                                      large_lm=hp.lm,
+                                      use_gpu=hp.use_gpu,
+                                      fp16=hp.fp16,
+                                      precision=hp.precision,
+                                      attn=hp.attn,
+                                      quantize=hp.quantize,
+                                      engine=hp.engine,
+                                      threads=hp.threads,
+                                      summarize=hp.summarize,
+                                      dk=hp.dk,
+                                      max_len=hp.max_len,
+                                      batch_size=hp.batch_size,
+                                      num_workers=hp.num_workers,
+                                      pack=hp.pack,
+                                      bucket=hp.bucket)
+        tune_cascade(session.config, hp, session)
+        predict(hp.input_path, hp.output_path, session.config, None,
+                session=session)
+        rates = session.throughput()
+        print("small pairs/s = %.1f, large pairs/s = %.1f, cascade pairs/s = %.1f, large_share = %f"
+              % (rates['small'], rates['large'], rates['cascade'], rates['large_share']))
+    else:
+        # load the model, the summarizer and the injector once
+        set_seed(123)
+        session = MatchSession.load(hp.task, hp.checkpoint_path,
+                                    lm=hp.lm,
+                                    use_gpu=hp.use_gpu,
+                                    fp16=hp.fp16,
+                                    precision=hp.precision,
+                                    attn=hp.attn,
+                                    quantize=hp.quantize,
+                                    engine=hp.engine,
+                                    threads=hp.threads,
+                                    summarize=hp.summarize,
+                                    dk=hp.dk,
+                                    max_len=hp.max_len,
+                                    batch_size=hp.batch_size,
+                                    num_workers=hp.num_workers,
+                                    pack=hp.pack,
+                                    bucket=hp.bucket,
+                                    prefilter=hp.prefilter,
+                                    bi_encoder=hp.bi_encoder,
+                                    bi_cache_size=hp.bi_cache_size)
+        if hp.early_exit and len(session.model.exit_layers) == 0:
+            parser.error('--early_exit needs a checkpoint with exit heads '
+                         '(trained with --exit_layers)')
+
+        # tune threshold
+        tune_threshold(session.config, session.model, hp, session=session)
+
+        # run prediction
+        predict(hp.input_path, hp.output_path, session.config, session.model,
+                session=session)
@@ -0,0 +1,154 @@
+import os
+import argparse
+import json
+import multiprocessing
+import random
+import time
+import traceback
+import numpy as np
+import torch
+
+from train_ditto import check_args, load_datasets, make_parser, prepare_inputs
+from ditto_light.ditto import train
+from ditto_light.sweep import SuccessiveHalving, core_slots, expand_grid, rung_epochs, \
+    run_name, take_slot, write_summary
+
+# the arguments deciding the prepared files of a run (see prepare_inputs)
+input_args = ['task', 'summarize', 'dk', 'prompt', 'unlabeled']
+# and its datasets (see load_datasets)
+data_args = input_args + ['lm', 'max_len', 'size', 'da', 'kbert', 'pack', 'stream',
+                          'shuffle_buffer', 'cache_dir', 'da_store', 'da_k', 'teacher_path',
+                          'teacher_lm', 'temperature']
+
+# the datasets of the last run of a worker, reused by the next one
+_datasets = {}
+
+
+def init_worker(free_slots, slots):
+    """Pin a worker process to its own cores (see take_slot)."""
+    # the pool numbers its workers from 1, the replaced ones included
+    index = multiprocessing.current_process()._identity[0] - 1
+    cores = take_slot(free_slots, slots, index)
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+
+def run(task):
+    """Train one configuration of a sweep in a worker.
+
+    Args:
+        task (tuple): the params of the run, its arguments (Namespace), the
+            paths of its prepared files and the SuccessiveHalving of the sweep
+
+    Returns:
+        Dictionary: the params, the status ('done', 'stopped' or 'failed'),
+            the number of epochs run, the best dev F1 with the test F1 of its
+            evaluation, and the run time in seconds
+    """
+    params, hp, paths, halving = task
+    random.seed(hp.run_id)
+    np.random.seed(hp.run_id)
+    torch.manual_seed(hp.run_id)
+
+    result = {'params': params, 'status': 'done', 'epochs': 0,
+              'dev_f1': 0.0, 'test_f1': None, 'seconds': 0.0}
+
+    def callback(name, epoch, dev_f1, test_f1):
+        result['epochs'] = epoch
+        if dev_f1 > result['dev_f1']:
+            result['dev_f1'], result['test_f1'] = dev_f1, test_f1
+        if halving.report(epoch, result['dev_f1']):
+            result['status'] = 'stopped'
+            return True
+        return False
+
+    start = time.time()
+    try:
+        key = repr([getattr(hp, arg) for arg in data_args])
+        if key not in _datasets:
+            _datasets.clear()
+            _datasets[key] = load_datasets(hp, *paths)
+        train(*_datasets[key], run_name(params), hp, callback=callback)
+    except Exception:
+        traceback.print_exc()
+        result['status'] = 'failed'
+    result['seconds'] = time.time() - start
+    return result
+
+
+def main(args):
+    with open(args.config) as fin:
+        sweep = json.load(fin)
+    grid = sweep['grid']
+    train_parser = make_parser()
+
+    # the arguments of every run: the defaults of train_ditto.py, the fixed
+    # arguments of the sweep, then the values of the configuration
+    runs = []
+    for params in expand_grid(grid):
+        hp = train_parser.parse_args([])
+        for key, value in list(sweep.get('args', {}).items()) + list(params.items()):
+            if not hasattr(hp, key):
+                raise ValueError('unknown argument of train_ditto.py: %s' % key)
+            setattr(hp, key, value)
+        check_args(train_parser, hp)
+        if hp.eval_steps is not None or hp.nprocs > 1 or hp.nnodes > 1:
+            raise ValueError('a sweep evaluates after every epoch, in one process per run')
+        hp.logdir = os.path.join(args.logdir, run_name(params))
+        if hp.cache_dir is None:
+            hp.cache_dir = args.cache_dir
+        runs.append((params, hp))
+
+    # summarize and inject the knowledge once per task, before the runs
+    configs = json.load(open('configs.json'))
+    configs = {conf['name'] : conf for conf in configs}
+    paths = {}
+    for params, hp in runs:
+        key = repr([getattr(hp, arg) for arg in input_args])
+        if key not in paths:
+            paths[key] = prepare_inputs(hp, configs[hp.task])
+
+    slots = core_slots(args.cores_per_run, args.nprocs)
+    n_epochs = max(hp.n_epochs for _, hp in runs)
+    rungs = rung_epochs(args.min_epochs, args.eta, n_epochs)
+    print(f"{len(runs)} runs, {len(slots)} in parallel on cores {slots}, rungs at epochs {rungs}")
+
+    # spawned workers: each one imports the libraries once for all its runs
+    context = multiprocessing.get_context('spawn')
+    with context.Manager() as manager:
+        queue = manager.Queue()
+        for slot in slots:
+            queue.put(slot)
+        halving = SuccessiveHalving(rungs, eta=args.eta,
+                                    scores=manager.dict(),
+                                    lock=manager.Lock())
+        tasks = [(params, hp, paths[repr([getattr(hp, arg) for arg in input_args])], halving)
+                 for params, hp in runs]
+
+        results = []
+        with context.Pool(len(slots), initializer=init_worker,
+                          initargs=(queue, slots)) as pool:
+            for result in pool.imap_unordered(run, tasks):
+                results.append(result)
+                print(f"[{len(results)}/{len(runs)}] {run_name(result['params'])}: "
+                      f"{result['status']} after {result['epochs']} epochs, "
+                      f"dev_f1={result['dev_f1']}, test_f1={result['test_f1']}")
+                # the table is rewritten as the runs finish
+                write_summary(args.output, results, list(grid))
+
+    print('\n'.join(write_summary(args.output, results, list(grid))))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, required=True)
+    parser.add_argument("--output", type=str, default='sweep.tsv')
+    parser.add_argument("--logdir", type=str, default='checkpoints/sweep/')
+    parser.add_argument("--cache_dir", type=str, default='cache/')
+    parser.add_argument("--cores_per_run", type=int, default=1)
+    parser.add_argument("--nprocs", type=int, default=None)
+    parser.add_argument("--eta", type=int, default=3)
+    parser.add_argument("--min_epochs", type=int, default=1)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,54 @@
+import os
+import sys
+import pytest
+
+# the tests import ditto_light as the scripts do, from the dittoPlus directory
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+PAIRS = [('COL title VAL sony bravia tv 40 inch COL price VAL 499',
+          'COL title VAL sony bravia 40in lcd television COL price VAL 479.99', 1),
+         ('COL title VAL apple ipod nano 8gb',
+          'COL title VAL samsung galaxy tab COL brand VAL samsung', 0),
+         ('COL name VAL the beatles COL album VAL abbey road',
+          'COL name VAL beatles COL album VAL abbey road remastered', 1),
+         ('COL name VAL miles davis', 'COL name VAL john coltrane COL year VAL 1959', 0)]
+
+
+@pytest.fixture(scope='session')
+def tiny_roberta(tmp_path_factory):
+    """A randomly initialized 2-layer RoBERTa with a small BPE vocabulary,
+    saved in a temporary directory (the tests run offline)."""
+    from tokenizers import ByteLevelBPETokenizer
+    from transformers import RobertaConfig, RobertaModel, RobertaTokenizerFast
+
+    path = str(tmp_path_factory.mktemp('roberta'))
+    texts = [text for left, right, _ in PAIRS for text in (left, right)]
+    bpe = ByteLevelBPETokenizer()
+    bpe.train_from_iterator(texts * 10, vocab_size=300,
+                            special_tokens=['<s>', '<pad>', '</s>', '<unk>', '<mask>'])
+    bpe.save_model(path)
+    tokenizer = RobertaTokenizerFast(vocab_file=os.path.join(path, 'vocab.json'),
+                                     merges_file=os.path.join(path, 'merges.txt'))
+    tokenizer.save_pretrained(path)
+    # room for the knowledge tokens added by get_ditto_tokenizer
+    config = RobertaConfig(vocab_size=len(tokenizer) + 8, hidden_size=32,
+                           num_hidden_layers=2, num_attention_heads=2,
+                           intermediate_size=64, max_position_embeddings=520)
+    RobertaModel(config).save_pretrained(path)
+    return path
+
+
+@pytest.fixture
+def roberta_lm(tiny_roberta, monkeypatch):
+    """Load the tiny RoBERTa as the 'roberta' LM of the datasets and models."""
+    import ditto_light.dataset
+    import ditto_light.ditto
+    monkeypatch.setitem(ditto_light.dataset.lm_mp, 'roberta', tiny_roberta)
+    monkeypatch.setitem(ditto_light.ditto.lm_mp, 'roberta', tiny_roberta)
+    return 'roberta'
+
+
+@pytest.fixture
+def pair_lines():
+    """The test pairs as lines of a task file (left \\t right \\t label)."""
+    return ['%s\t%s\t%d' % pair for pair in PAIRS]
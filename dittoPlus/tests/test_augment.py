@@ -0,0 +1,152 @@
+import random
+
+import numpy as np
+import pytest
+
+from conftest import PAIRS
+from ditto_light.augment import Augmenter, TokenAugmenter
+from ditto_light.dataset import DittoDataset, get_ditto_tokenizer
+
+OPS = ['del', 'swap', 'drop_col', 'append_col', 'drop_token', 'ins', 'all']
+
+
+@pytest.fixture
+def tokenizer(roberta_lm):
+    return get_ditto_tokenizer(roberta_lm)
+
+
+def encode(tokenizer, pairs):
+    return [tokenizer.encode(text=left, text_pair=right, max_length=128, truncation=True)
+            for left, right, _ in pairs]
+
+
+def entries(tokenizer, ids):
+    """Decode the entries between the boundary tokens of a sequence."""
+    boundary = {tokenizer.bos_token_id, tokenizer.eos_token_id}
+    runs, current = [], []
+    for token in ids + [tokenizer.eos_token_id]:
+        if token in boundary:
+            if len(current) > 0:
+                runs.append(' '.join(tokenizer.decode(
+                    current, clean_up_tokenization_spaces=False).split()))
+            current = []
+        else:
+            current.append(token)
+    return runs
+
+
+def string_outputs(left, right, op, samples):
+    """The outputs of Augmenter on a pair, as (left, right) entries."""
+    augmenter = Augmenter()
+    outputs = set()
+    for seed in range(samples):
+        random.seed(seed)
+        combined = augmenter.augment_sent(left + ' [SEP] ' + right, op)
+        # an entry dropped as a whole leaves an empty side
+        entries = [' '.join(entry.split()) for entry in combined.split('[SEP]')]
+        outputs.add(tuple(entry for entry in entries if entry != ''))
+    return outputs
+
+
+def kept_words(output, sources):
+    """Check that the entries are the sources with some plain words dropped."""
+    for entry, source in zip(output, sources):
+        words = iter(source.split())
+        if not all(word in words for word in entry.split()):
+            return False
+        if [w for w in entry.split() if w in ['COL', 'VAL']] != \
+                [w for w in source.split() if w in ['COL', 'VAL']]:
+            return False
+    return len(output) == len(sources)
+
+
+def check_structure(tokenizer, original, augmented):
+    """The boundaries are kept and every attribute still reads COL .. VAL .."""
+    boundary = [tokenizer.bos_token_id, tokenizer.eos_token_id]
+    assert augmented[0] == tokenizer.bos_token_id
+    assert augmented[-1] == tokenizer.eos_token_id
+    assert [t for t in augmented if t in boundary] == [t for t in original if t in boundary]
+    for entry in entries(tokenizer, augmented):
+        headers = [word for word in entry.split() if word in ['COL', 'VAL']]
+        assert entry.split()[0] == 'COL'
+        assert headers == ['COL', 'VAL'] * (len(headers) // 2)
+
+
+@pytest.mark.parametrize('op', OPS)
+def test_token_ops_keep_the_structure(tokenizer, op):
+    augmenter = TokenAugmenter(tokenizer, max_len=128)
+    original = encode(tokenizer, PAIRS) * 5
+    random.seed(0)
+    for _ in range(20):
+        augmented = augmenter.augment_batch(original, op)
+        assert len(augmented) == len(original)
+        for x, x_aug in zip(original, augmented):
+            assert all(isinstance(t, int) and 0 <= t < len(tokenizer) for t in x_aug)
+            check_structure(tokenizer, x, x_aug)
+
+
+@pytest.mark.parametrize('op', ['del', 'swap', 'drop_col', 'append_col', 'ins'])
+def test_token_ops_match_augmenter(tokenizer, op):
+    augmenter = TokenAugmenter(tokenizer, max_len=128)
+    original = encode(tokenizer, PAIRS)
+    supports = [string_outputs(left, right, op, 3000) for left, right, _ in PAIRS]
+    random.seed(1)
+    seen = [set() for _ in PAIRS]
+    for _ in range(50):
+        for i, x_aug in enumerate(augmenter.augment_batch(original, op)):
+            output = tuple(entries(tokenizer, x_aug))
+            assert output in supports[i]
+            seen[i].add(output)
+    # the ops do change the pairs, in several ways
+    assert all(len(outputs) > 2 for outputs in seen)
+
+
+def test_drop_token_and_all_match_augmenter(tokenizer):
+    augmenter = TokenAugmenter(tokenizer, max_len=128)
+    original = encode(tokenizer, PAIRS)
+    random.seed(2)
+    for _ in range(50):
+        for x, x_aug, (left, right, _) in zip(original, augmenter.augment_batch(original, 'drop_token'),
+                                              PAIRS):
+            # the words kept are in order and the headers are all kept
+            output = entries(tokenizer, x_aug)
+            assert kept_words(output, [left, right]) or kept_words(output, [right, left])
+
+    # all applies three of del, swap, drop_col and append_col
+    for (left, right, _), x in zip(PAIRS, original):
+        outputs = set()
+        for _ in range(50):
+            output = entries(tokenizer, augmenter.augment_batch([x], 'all')[0])
+            words = sorted(' '.join(output).split())
+            assert set(words) <= set((left + ' ' + right).split())
+            outputs.add(tuple(output))
+        assert len(outputs) > 10
+
+
+def test_token_ops_are_seeded_by_random(tokenizer):
+    augmenter = TokenAugmenter(tokenizer, max_len=128)
+    original = encode(tokenizer, PAIRS)
+    random.seed(3)
+    first = [augmenter.augment_batch(original, op) for op in OPS]
+    random.seed(3)
+    assert [augmenter.augment_batch(original, op) for op in OPS] == first
+
+
+def test_ins_truncates_to_max_len(tokenizer):
+    lengths = [len(x) for x in encode(tokenizer, PAIRS)]
+    augmenter = TokenAugmenter(tokenizer, max_len=max(lengths))
+    original = encode(tokenizer, PAIRS)
+    random.seed(4)
+    for _ in range(20):
+        for x, x_aug in zip(original, augmenter.augment_batch(original, 'ins')):
+            assert len(x_aug) <= max(lengths)
+            check_structure(tokenizer, x, x_aug)
+
+
+def test_dataset_pads_token_augmented_batches(roberta_lm, pair_lines):
+    dataset = DittoDataset(pair_lines, lm=roberta_lm, max_len=128, da='del')
+    assert dataset.token_augmenter is not None
+    random.seed(5)
+    x1, x2, y = dataset.pad([dataset[i] for i in range(len(dataset))])
+    assert x1.shape == x2.shape
+    assert not np.array_equal(x1.numpy(), x2.numpy())
@@ -0,0 +1,75 @@
+import json
+import random
+
+from ditto_light.augstore import AugmentStore, generate_augment_store, pair_key
+from ditto_light.dataset import get_ditto_tokenizer
+
+
+def write_split(path, lines):
+    with open(path, 'w', encoding='utf-8') as fout:
+        fout.write('\n'.join(lines) + '\n')
+    return str(path)
+
+
+def test_store_does_not_depend_on_the_processes(pair_lines, tmp_path):
+    path = write_split(tmp_path / 'train.txt', pair_lines * 3)
+    outputs = []
+    for processes, chunk_size in [(1, 256), (2, 1), (2, 5)]:
+        output = str(tmp_path / ('store.%d.%d.jsonl' % (processes, chunk_size)))
+        assert generate_augment_store(path, output, da='swap', k=4,
+                                      processes=processes, seed=7,
+                                      chunk_size=chunk_size) == len(pair_lines) * 3
+        with open(output, encoding='utf-8') as fin:
+            outputs.append(fin.read())
+    assert outputs[0] == outputs[1] == outputs[2]
+
+    records = [json.loads(line) for line in outputs[0].splitlines()]
+    assert [record['sid'] for record in records] == list(range(len(records)))
+    for record, line in zip(records, pair_lines * 3):
+        left, right, label = line.split('\t')
+        assert record['original'] == left + '\t' + right
+        assert record['label'] == label
+        assert len(record['augment']) == 4
+        assert all(len(variant.split('\t')) == 2 for variant in record['augment'])
+    assert any(variant != record['original']
+               for record in records for variant in record['augment'])
+
+    # another seed, other variants; size stops early
+    output = str(tmp_path / 'other.jsonl')
+    assert generate_augment_store(path, output, da='swap', k=4, processes=1,
+                                  seed=8, size=5) == 5
+    with open(output, encoding='utf-8') as fin:
+        assert fin.read() != ''.join(outputs[0].splitlines(True)[:5])
+
+
+def test_align_ignores_whitespace(roberta_lm, pair_lines, tmp_path):
+    tokenizer = get_ditto_tokenizer(roberta_lm)
+    path = write_split(tmp_path / 'train.txt', pair_lines)
+    output = str(tmp_path / 'store.jsonl')
+    generate_augment_store(path, output, da='del', k=3, processes=1)
+    cache_dir = str(tmp_path / 'cache')
+    store = AugmentStore.load(output, tokenizer, max_len=64, cache_dir=cache_dir,
+                              batch_size=2)
+    assert len(store) == len(pair_lines)
+
+    pairs = [tuple(line.split('\t')[:2]) for line in pair_lines]
+    spaced = [('  ' + left.replace(' ', '   ') + ' ', right.replace(' ', '\t') + '  ')
+              for left, right in pairs]
+    assert pair_key(*spaced[0]) == pair_key(*pairs[0])
+    unknown = ('COL title VAL unknown', 'COL title VAL pair')
+    index = store.align(list(reversed(spaced)) + [unknown])
+    assert index.tolist() == list(reversed(range(len(pairs)))) + [-1]
+
+    # the sampled variants are the tokenized variants of the record
+    with open(output, encoding='utf-8') as fin:
+        record = json.loads(fin.readline())
+    variants = [tokenizer.encode(*variant.split('\t'), max_length=64, truncation=True)
+                for variant in record['augment']]
+    random.seed(0)
+    assert all(store.sample(0) in variants for _ in range(10))
+
+    # the cached store is reopened as is
+    cached = AugmentStore.load(output, tokenizer, max_len=64, cache_dir=cache_dir)
+    assert cached.keys == store.keys
+    assert cached.ids.tolist() == store.ids.tolist()
+    assert cached.align(spaced).tolist() == list(range(len(pairs)))
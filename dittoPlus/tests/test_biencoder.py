@@ -0,0 +1,85 @@
+import torch
+
+from ditto_light.biencoder import BiEncoder, EntityCache, split_pairs
+from ditto_light.dataset import get_ditto_tokenizer
+from ditto_light.ditto import DittoModel
+from conftest import PAIRS
+
+
+def test_split_pairs_single_sep():
+    # BERT: CLS left SEP right SEP, padded with 0's
+    x = torch.LongTensor([[101, 5, 6, 102, 7, 8, 9, 102, 0, 0],
+                          [101, 5, 102, 7, 102, 0, 0, 0, 0, 0]])
+    left_x, left_mask, right_x, right_mask = split_pairs(x)
+    assert left_x.tolist() == [[101, 5, 6, 102], [101, 5, 102, 0]]
+    assert left_mask.tolist() == [[1, 1, 1, 1], [1, 1, 1, 0]]
+    assert right_x.tolist() == [[101, 7, 8, 9, 102], [101, 7, 102, 0, 0]]
+    assert right_mask.tolist() == [[1, 1, 1, 1, 1], [1, 1, 1, 0, 0]]
+
+
+def test_split_pairs_double_sep():
+    # RoBERTa: <s> left </s></s> right </s>, padded with 0's like the dataset
+    x = torch.LongTensor([[0, 5, 6, 2, 2, 7, 8, 2, 0],
+                          [0, 5, 2, 2, 7, 2, 0, 0, 0]])
+    left_x, left_mask, right_x, right_mask = split_pairs(x)
+    assert left_x.tolist() == [[0, 5, 6, 2], [0, 5, 2, 0]]
+    assert left_mask.tolist() == [[1, 1, 1, 1], [1, 1, 1, 0]]
+    assert right_x.tolist() == [[0, 7, 8, 2], [0, 7, 2, 0]]
+    assert right_mask.tolist() == [[1, 1, 1, 1], [1, 1, 1, 0]]
+
+
+def test_split_pairs_matches_the_tokenizer(roberta_lm):
+    tokenizer = get_ditto_tokenizer(roberta_lm)
+    pairs = [tokenizer.encode(left, right) for left, right, _ in PAIRS]
+    maxlen = max(len(ids) for ids in pairs)
+    x = torch.LongTensor([ids + [0]*(maxlen - len(ids)) for ids in pairs])
+    left_x, left_mask, right_x, right_mask = split_pairs(x)
+    for (left, right, _), lx, lm, rx, rm in zip(PAIRS, left_x, left_mask, right_x, right_mask):
+        assert lx[lm.bool()].tolist() == tokenizer.encode(left)
+        assert rx[rm.bool()].tolist() == tokenizer.encode(right)
+
+
+def test_entity_cache_evicts_the_least_recently_used():
+    cache = EntityCache(max_size=2)
+    cache.put('a', torch.zeros(1))
+    cache.put('b', torch.ones(1))
+    assert cache.get('a') is not None
+    # b is the least recently used one now
+    cache.put('c', torch.full((1,), 2.0))
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert cache.get('a').item() == 0.0
+    assert cache.get('c').item() == 2.0
+    assert (cache.hits, cache.misses) == (3, 1)
+
+    # putting a cached key again refreshes it
+    cache.put('a', torch.full((1,), 3.0))
+    cache.put('d', torch.zeros(1))
+    assert cache.get('c') is None
+    assert cache.get('a').item() == 3.0
+
+
+def test_entity_cache_unbounded():
+    cache = EntityCache()
+    for i in range(100):
+        cache.put(i, torch.zeros(1))
+    assert len(cache) == 100
+    assert cache.get(0) is not None
+
+
+def test_bounded_cache_keeps_the_embeddings(roberta_lm):
+    torch.manual_seed(0)
+    model = DittoModel(device='cpu', lm=roberta_lm, bi_encoder=True)
+    model.eval()
+    tokenizer = get_ditto_tokenizer(roberta_lm)
+    entities = [entry for left, right, _ in PAIRS for entry in (left, right)]
+    unbounded = BiEncoder(model, tokenizer, batch_size=1)
+    bounded = BiEncoder(model, tokenizer, batch_size=1, cache_size=2)
+
+    expected = unbounded.embed(entities)
+    for _ in range(2):
+        assert torch.allclose(bounded.embed(entities), expected, atol=1e-6)
+        assert len(bounded.cache) == 2
+    assert len(unbounded.cache) == len(entities)
+    # only the last two encoded entries were still cached on the second pass
+    assert bounded.cache.hits == 2
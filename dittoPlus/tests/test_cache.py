@@ -0,0 +1,67 @@
+import os
+
+from ditto_light.cache import TokenCache
+from ditto_light.dataset import DittoDataset, get_ditto_tokenizer
+
+
+def write_split(path, lines):
+    with open(path, 'w', encoding='utf-8') as fout:
+        fout.write('\n'.join(lines) + '\n')
+    return str(path)
+
+
+def test_cache_key_invalidation(roberta_lm, pair_lines, tmp_path):
+    tokenizer = get_ditto_tokenizer(roberta_lm)
+    path = write_split(tmp_path / 'train.txt', pair_lines)
+    key = TokenCache.cache_key(path, tokenizer, 128)
+
+    assert TokenCache.cache_key(path, tokenizer, 128) == key
+    assert TokenCache.cache_key(path, tokenizer, 64) != key
+    assert TokenCache.cache_key(path, tokenizer, 128, kbert=True) != key
+
+    # the vocabulary size covers the added tokens
+    tokenizer.add_tokens(['<extra>'])
+    assert TokenCache.cache_key(path, tokenizer, 128) != key
+    tokenizer = get_ditto_tokenizer(roberta_lm)
+
+    # the content of the file, not its name or modification time
+    write_split(path, pair_lines[:-1])
+    assert TokenCache.cache_key(path, tokenizer, 128) != key
+    write_split(path, pair_lines)
+    assert TokenCache.cache_key(path, tokenizer, 128) == key
+
+    cache_dir = str(tmp_path / 'cache')
+    first = TokenCache.load(path, tokenizer, cache_dir, max_len=128)
+    assert TokenCache.load(path, tokenizer, cache_dir, max_len=128).directory == first.directory
+    write_split(path, pair_lines[:2])
+    rebuilt = TokenCache.load(path, tokenizer, cache_dir, max_len=128)
+    assert rebuilt.directory != first.directory
+    assert len(rebuilt) == 2
+    assert sorted(os.listdir(cache_dir)) == sorted([os.path.basename(first.directory),
+                                                    os.path.basename(rebuilt.directory)])
+
+
+def test_cache_items_match_the_tokenizer(roberta_lm, pair_lines, tmp_path):
+    tokenizer = get_ditto_tokenizer(roberta_lm)
+    path = write_split(tmp_path / 'train.txt', pair_lines)
+    cache_dir = str(tmp_path / 'cache')
+    # tokenized in several batches
+    cache = TokenCache.load(path, tokenizer, cache_dir, max_len=16, batch_size=3)
+    kbert = TokenCache.load(path, tokenizer, cache_dir, max_len=16, kbert=True)
+
+    assert len(cache) == len(pair_lines)
+    for idx, line in enumerate(pair_lines):
+        left, right, label = line.split('\t')
+        expected = tokenizer.encode(text=left, text_pair=right, max_length=16,
+                                    truncation=True)
+        assert cache[idx].tolist() == expected
+        assert cache.lengths()[idx] == len(expected)
+        assert cache.labels[idx] == int(label)
+        assert kbert[idx].tolist() == [tokenizer.bos_token_id] + \
+            tokenizer.encode(left, add_special_tokens=False) + \
+            tokenizer.encode(right, add_special_tokens=False) + [tokenizer.eos_token_id]
+
+    plain = DittoDataset(path, lm=roberta_lm, max_len=16)
+    cached = DittoDataset(path, lm=roberta_lm, max_len=16, cache_dir=cache_dir)
+    assert [cached[i] for i in range(len(cached))] == [plain[i] for i in range(len(plain))]
+    assert cached.lengths().tolist() == plain.lengths().tolist()
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+from ditto_light.dataset import label_tensor
+from ditto_light.distill import distillation_labels, distillation_loss
+
+
+def test_distillation_loss_is_the_standard_one():
+    torch.manual_seed(0)
+    logits = torch.randn(6, 2)
+    teacher_logits = torch.randn(6, 2)
+    labels = np.array([1, 0, 1, -1, 0, -1])
+    T, alpha = 2.0, 0.3
+    probs = (teacher_logits / T).softmax(dim=1)[:, 1].numpy()
+    target = label_tensor(list(distillation_labels(probs, labels)))
+    assert target.shape == (6, 2) and target.is_floating_point()
+
+    # alpha * T^2 * CE(teacher_T, student_T) + (1 - alpha) * CE(y, student_1)
+    teacher_T = (teacher_logits / T).softmax(dim=1)
+    soft = -(teacher_T * F.log_softmax(logits / T, dim=1)).sum(dim=1).mean() * T ** 2
+    labeled = torch.from_numpy(labels >= 0)
+    hard = F.cross_entropy(logits[labeled], torch.from_numpy(labels)[labeled])
+    expected = alpha * soft + (1 - alpha) * hard
+    assert distillation_loss(logits, target, T, alpha).item() == pytest.approx(expected.item(), rel=1e-5)
+
+
+def test_unlabeled_batches_only_have_the_soft_term():
+    logits = torch.randn(3, 2)
+    target = torch.tensor([[0.9, -1.0], [0.2, -1.0], [0.5, -1.0]])
+    only_soft = distillation_loss(logits, target, 2.0, alpha=1.0)
+    assert distillation_loss(logits, target, 2.0, alpha=0.5).item() == \
+        pytest.approx(0.5 * only_soft.item())
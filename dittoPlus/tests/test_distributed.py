@@ -0,0 +1,49 @@
+import os
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+import ditto_light.dataset
+import ditto_light.ditto
+from ditto_light.distill import teacher_probs
+from ditto_light.distributed import cleanup_distributed, gather_shards, get_rank, \
+    get_world_size, init_distributed
+from ditto_light.ditto import DittoModel
+
+
+def score_shard(rank, world_size, lm_path, lines, output):
+    """Score the shard of a rank with the teacher and gather the shards."""
+    torch.set_num_threads(1)
+    ditto_light.dataset.lm_mp['roberta'] = lm_path
+    ditto_light.ditto.lm_mp['roberta'] = lm_path
+    init_distributed(rank, world_size, output + '.rendezvous')
+    try:
+        torch.manual_seed(0)
+        teacher = DittoModel(device='cpu', lm='roberta')
+        probs = teacher_probs(teacher, lines[get_rank()::get_world_size()], 'roberta',
+                              max_len=64, batch_size=1, temperature=2.0)
+        probs = gather_shards(probs)
+        if rank == 0:
+            np.save(output, probs)
+    finally:
+        cleanup_distributed()
+
+
+def test_gather_shards_without_a_process_group():
+    array = np.arange(10).reshape(5, 2)
+    assert np.array_equal(gather_shards(array), array)
+
+
+def test_sharded_teacher_scores(tiny_roberta, roberta_lm, pair_lines, tmp_path):
+    # 7 pairs: the shards have different sizes
+    lines = (pair_lines * 2)[:7]
+    output = str(tmp_path / 'probs.npy')
+    mp.spawn(score_shard, args=(2, tiny_roberta, lines, output), nprocs=2)
+
+    torch.manual_seed(0)
+    teacher = DittoModel(device='cpu', lm=roberta_lm)
+    # one pair per batch: the scores do not depend on the padding
+    expected = teacher_probs(teacher, lines, roberta_lm, max_len=64, batch_size=1,
+                             temperature=2.0)
+    assert np.allclose(np.load(output), expected, atol=1e-6)
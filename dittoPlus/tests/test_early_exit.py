@@ -0,0 +1,69 @@
+import os
+
+import pytest
+import torch
+
+from ditto_light.dataset import DittoDataset
+from ditto_light.ditto import DittoModel
+from ditto_light.early_exit import calibrate_exits, load_exit_thresholds, save_exit_thresholds
+from ditto_light.loader import make_loader
+from test_train import KBERT_LINES
+
+
+@pytest.mark.parametrize('kbert', [False, True])
+def test_early_exit_matches_forward_without_exits(roberta_lm, pair_lines, kbert):
+    torch.manual_seed(0)
+    model = DittoModel(device='cpu', lm=roberta_lm, exit_layers=[1])
+    model.eval()
+    lines = KBERT_LINES if kbert else pair_lines
+    dataset = DittoDataset(lines, lm=roberta_lm, max_len=64, kbert=kbert)
+    iterator = make_loader(dataset, batch_size=4, collate_fn=dataset.pad)
+
+    for batch in iterator:
+        if kbert:
+            x, position_ids, groups, _ = batch
+            inputs = dict(vm=groups, position_ids=position_ids)
+        else:
+            x, _ = batch
+            inputs = {}
+        with torch.no_grad():
+            expected = model(x, **inputs)
+            # no head is ever confident enough, every pair runs all the layers
+            model.exit_thresholds = {1: 1.1}
+            actual = model(x, **inputs)
+            model.exit_thresholds = None
+        assert torch.allclose(actual, expected, atol=1e-5)
+        assert (model.exit_layer == model.bert.config.num_hidden_layers).all()
+
+
+def test_exit_thresholds_are_saved_with_the_checkpoint(roberta_lm, pair_lines, tmp_path):
+    torch.manual_seed(0)
+    model = DittoModel(device='cpu', lm=roberta_lm, exit_layers=[1])
+    model.eval()
+    dataset = DittoDataset(pair_lines, lm=roberta_lm, max_len=64)
+    iterator = make_loader(dataset, batch_size=4, collate_fn=dataset.pad)
+    checkpoint = str(tmp_path / 'model.pt')
+    torch.save({'model': model.state_dict()}, checkpoint)
+
+    calibrate_exits(model, iterator, threshold=0.5, max_disagreement=0.1)
+    thresholds = model.exit_thresholds
+    save_exit_thresholds(model, checkpoint, 0.5, 0.1)
+
+    model.exit_thresholds = None
+    assert load_exit_thresholds(model, checkpoint, 0.5, 0.1)
+    assert model.exit_thresholds == thresholds
+    # another threshold or tolerance needs another calibration
+    assert not load_exit_thresholds(model, checkpoint, 0.4, 0.1)
+    assert not load_exit_thresholds(model, checkpoint, 0.5, 0.05)
+    # and so does a newer checkpoint
+    mtime = os.path.getmtime(checkpoint)
+    os.utime(checkpoint, (mtime + 10, mtime + 10))
+    assert not load_exit_thresholds(model, checkpoint, 0.5, 0.1)
+
+
+def test_calibrate_exits_needs_exit_heads(roberta_lm, pair_lines):
+    model = DittoModel(device='cpu', lm=roberta_lm)
+    dataset = DittoDataset(pair_lines, lm=roberta_lm, max_len=64)
+    iterator = make_loader(dataset, batch_size=4, collate_fn=dataset.pad)
+    with pytest.raises(ValueError):
+        calibrate_exits(model, iterator, threshold=0.5)
@@ -0,0 +1,33 @@
+import pytest
+import torch
+
+pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+
+from ditto_light.dataset import DittoDataset
+from ditto_light.ditto import DittoModel
+from ditto_light.export import OnnxModel, check_parity, export_onnx, onnx_path
+from ditto_light.loader import make_loader
+from test_train import KBERT_LINES
+
+
+@pytest.mark.parametrize('kbert', [False, True])
+def test_onnx_graph_parity(roberta_lm, pair_lines, tmp_path, kbert):
+    torch.manual_seed(0)
+    model = DittoModel(device='cpu', lm=roberta_lm)
+    path = onnx_path(str(tmp_path / 'model.pt'), vm=kbert)
+    export_onnx(model, path, vm=kbert)
+    onnx_model = OnnxModel(path, threads=1)
+
+    lines = KBERT_LINES * 3 if kbert else pair_lines * 3
+    dataset = DittoDataset(lines, lm=roberta_lm, max_len=64, kbert=kbert)
+    # batches of other shapes than the ones of the export
+    iterator = make_loader(dataset, batch_size=5, collate_fn=dataset.pad)
+    max_diff, torch_f1, onnx_f1 = check_parity(model, onnx_model, iterator)
+    assert max_diff < 1e-5
+    assert torch_f1 == onnx_f1
+
+    if not kbert:
+        x, _ = next(iter(iterator))
+        with pytest.raises(ValueError):
+            onnx_model(x, x)
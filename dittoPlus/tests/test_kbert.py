@@ -0,0 +1,133 @@
+import random
+import numpy as np
+import pytest
+import torch
+
+from ditto_light.kbert import build_knowledge_trees, visible_matrix, visibility_groups
+from ditto_light.models import expand_visible_matrix
+
+MARKERS = ['<head>', '</head>', '<tail>', '</tail>']
+PAD = '<pad>'
+
+
+def add_knowledge_with_vm(sent_batch, max_length=128):
+    """The per-sentence sentence tree of DittoDataset before kbert.py (the
+    reference of build_knowledge_trees)."""
+    sent_tree = []
+    pos_idx_tree = []
+    abs_idx_tree = []
+    pos_idx = -1
+    abs_idx = -1
+    abs_idx_src = []
+    head_left_id, head_right_id = -1, -1
+    tail_left_id, tail_right_id = -1, -1
+    for i, token in enumerate(sent_batch):
+        if token == '<head>':
+            head_left_id = i
+            head_right_id = sent_batch[i:].index('</head>') + i
+            tail_left_id = sent_batch[i:].index('<tail>') + 1 + i
+            tail_right_id = sent_batch[i:].index('</tail>') + i
+            entities = []
+        elif head_left_id < i < head_right_id:
+            entities = sent_batch[tail_left_id:tail_right_id]
+        elif tail_left_id <= i <= tail_right_id:
+            continue
+        else:
+            entities = []
+
+        if token not in MARKERS:
+            sent_tree.append((token, entities))
+            token_pos_idx = [pos_idx + 1]
+            token_abs_idx = [abs_idx + 1]
+            abs_idx = token_abs_idx[-1]
+
+        entities_pos_idx = []
+        entities_abs_idx = []
+        for ent in entities:
+            if ent not in ['<tail>', '</tail>']:
+                entities_pos_idx.append([token_pos_idx[-1] + 1])
+                abs_idx += 1
+                entities_abs_idx.append([abs_idx])
+        if token not in MARKERS:
+            pos_idx_tree.append((token_pos_idx, entities_pos_idx))
+            abs_idx_tree.append((token_abs_idx, entities_abs_idx))
+            pos_idx = token_pos_idx[-1]
+            abs_idx_src += token_abs_idx
+
+    know_sent, pos, seg = [], [], []
+    for i in range(len(sent_tree)):
+        know_sent.append(sent_tree[i][0])
+        seg.append(0)
+        pos += pos_idx_tree[i][0]
+        for j in range(len(sent_tree[i][1])):
+            know_sent.append(sent_tree[i][1][j])
+            seg.append(1)
+            pos += pos_idx_tree[i][1][j]
+
+    token_num = len(know_sent)
+    vm = np.zeros((token_num, token_num))
+    for src_ids, ents in abs_idx_tree:
+        for idx in src_ids:
+            vm[idx, abs_idx_src + [i for ent in ents for i in ent]] = 1
+        for ent in ents:
+            for idx in ent:
+                vm[idx, ent + src_ids] = 1
+
+    if token_num < max_length:
+        pad_num = max_length - token_num
+        know_sent += [PAD] * pad_num
+        seg += [0] * pad_num
+        pos += [max_length - 1] * pad_num
+        vm = np.pad(vm, ((0, pad_num), (0, pad_num)), 'constant')
+    else:
+        know_sent = know_sent[:max_length]
+        seg = seg[:max_length]
+        pos = pos[:max_length]
+        vm = vm[:max_length, :max_length]
+    return know_sent, pos, vm, seg
+
+
+def random_sentence(rng):
+    """A prompt_type 0 serialization with random attributes and knowledge."""
+    words = lambda k: ['w%d' % rng.randrange(20) for _ in range(k)]
+    tokens = []
+    for _ in range(rng.randrange(1, 5)):
+        tokens += ['COL']
+        if rng.random() < 0.7:
+            tokens += ['<head>'] + words(rng.randrange(1, 4)) + ['</head>']
+            tokens += ['<tail>'] + words(rng.randrange(0, 4)) + ['</tail>']
+        else:
+            tokens += words(rng.randrange(1, 3))
+        tokens += ['VAL'] + words(rng.randrange(0, 5))
+    return tokens
+
+
+@pytest.mark.parametrize('max_length', [16, 32, 128])
+def test_trees_match_the_reference(max_length):
+    rng = random.Random(max_length)
+    vocab = {token: i for i, token in enumerate(MARKERS + [PAD, 'COL', 'VAL'] +
+                                                ['w%d' % i for i in range(20)])}
+    sentences = [random_sentence(rng) for _ in range(50)]
+    know, pos, seg, owners = build_knowledge_trees(
+        [[vocab[token] for token in sent] for sent in sentences],
+        tuple(vocab[marker] for marker in MARKERS), vocab[PAD], max_length=max_length)
+    vm = visible_matrix(owners, seg)
+
+    for i, sent in enumerate(sentences):
+        ref_sent, ref_pos, ref_vm, ref_seg = add_knowledge_with_vm(sent, max_length)
+        assert know[i].tolist() == [vocab[token] for token in ref_sent]
+        assert pos[i].tolist() == ref_pos
+        assert seg[i].tolist() == ref_seg
+        assert (vm[i] == ref_vm.astype(bool)).all()
+
+
+def test_visibility_groups_expand_to_the_visible_matrices():
+    rng = random.Random(0)
+    vocab = {token: i for i, token in enumerate(MARKERS + [PAD, 'COL', 'VAL'] +
+                                                ['w%d' % i for i in range(20)])}
+    sentences = [[vocab[token] for token in random_sentence(rng)] for _ in range(20)]
+    know, pos, seg, owners = build_knowledge_trees(
+        sentences, tuple(vocab[marker] for marker in MARKERS), vocab[PAD], max_length=64)
+    groups = visibility_groups(owners, seg)
+    expanded = expand_visible_matrix(torch.from_numpy(groups).long(), torch.from_numpy(pos))
+    assert (expanded.numpy() == visible_matrix(owners, seg)).all()
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+import torch
+
+# matcher imports the summarizer and the knowledge injectors
+pytest.importorskip('nltk')
+pytest.importorskip('spacy')
+pytest.importorskip('sherlock')
+
+import matcher
+from ditto_light.ditto import DittoModel
+
+
+def test_classify_reuses_the_session(roberta_lm, pair_lines, monkeypatch):
+    monkeypatch.setattr(matcher, '_sessions', {})
+    torch.manual_seed(0)
+    model = DittoModel(device='cpu', lm=roberta_lm)
+    model.eval()
+    pred, logits = matcher.classify(pair_lines, model, lm=roberta_lm, max_len=128)
+    session = matcher._sessions[(roberta_lm, 128)]
+    pred2, logits2 = matcher.classify(pair_lines[:2], model, lm=roberta_lm, max_len=128,
+                                      threshold=1.0)
+    assert matcher._sessions == {(roberta_lm, 128): session}
+    assert pred2 == [0, 0]
+    assert np.allclose(logits2, logits[:2], atol=1e-5)
+
+    expected = matcher.MatchSession(None, model, lm=roberta_lm, max_len=128)
+    expected_pred, expected_logits = expected.classify(pair_lines)
+    assert pred == expected_pred
+    assert np.allclose(logits, expected_logits, atol=1e-5)
@@ -0,0 +1,47 @@
+import pytest
+import torch
+
+from transformers import DistilBertConfig, DistilBertModel
+
+import ditto_light.ditto
+from ditto_light.dataset import DittoDataset
+from ditto_light.ditto import DittoModel
+
+
+def test_packed_logits_match_the_separate_pairs(roberta_lm, pair_lines):
+    torch.manual_seed(0)
+    model = DittoModel(device='cpu', lm=roberta_lm)
+    model.eval()
+
+    lines = pair_lines * 3
+    plain = DittoDataset(lines, lm=roberta_lm, max_len=128)
+    packed = DittoDataset(lines, lm=roberta_lm, max_len=128, pack=True)
+    batch = packed.pad([packed[i] for i in range(len(packed))])
+    assert len(batch) == 5
+    x, positions, segments, cls_index, y = batch
+    # several pairs share a row
+    assert x.size(0) < len(lines)
+
+    with torch.no_grad():
+        logits = model(x, position_ids=positions, segments=segments, cls_index=cls_index)
+        # every pair alone, without padding
+        expected = torch.cat([model(plain.pad([plain[i]])[0]) for i in range(len(plain))])
+    assert torch.equal(y, torch.LongTensor(plain.labels[:len(lines)]))
+    assert torch.allclose(logits, expected, atol=1e-5)
+
+
+def test_packed_pairs_need_roberta(tmp_path, monkeypatch):
+    config = DistilBertConfig(vocab_size=100, dim=32, n_layers=1, n_heads=2, hidden_dim=64)
+    DistilBertModel(config).save_pretrained(str(tmp_path))
+    monkeypatch.setitem(ditto_light.ditto.lm_mp, 'distilbert', str(tmp_path))
+    model = DittoModel(device='cpu', lm='distilbert')
+
+    x = torch.randint(3, 100, (2, 8))
+    segments = torch.LongTensor([[0] * 4 + [1] * 4, [2] * 6 + [-1] * 2])
+    positions = torch.LongTensor([list(range(4)) * 2, list(range(6)) + [0, 0]])
+    cls_index = torch.LongTensor([[0, 0], [0, 4], [1, 0]])
+    with pytest.raises(ValueError):
+        model(x, position_ids=positions, segments=segments, cls_index=cls_index)
+    with pytest.raises(ValueError):
+        model(x, vm=torch.zeros(2, 8, dtype=torch.int8), position_ids=positions)
+    assert model(x).shape == (2, 2)
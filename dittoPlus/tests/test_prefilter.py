@@ -0,0 +1,101 @@
+import os
+import random
+
+import numpy as np
+import pytest
+
+from ditto_light.prefilter import PreFilter, load_prefilter, read_pairs
+
+WORDS = ['sony', 'apple', 'samsung', 'bravia', 'ipod', 'galaxy', 'nano', 'lcd', 'tv',
+         'tab', 'black', 'white', 'pro', 'mini', 'max', 'case', 'cable', 'charger']
+
+
+def entity(rng):
+    title = ' '.join(rng.sample(WORDS, 4))
+    return 'COL title VAL %s COL model VAL x%d COL price VAL %d' % (
+        title, rng.randrange(1000), rng.randrange(10, 999))
+
+
+def noisy(entry, rng):
+    """The same entity with a dropped word, a price change or both."""
+    tokens = entry.split(' ')
+    if rng.random() < 0.5:
+        del tokens[rng.randrange(3, 7)]
+    if rng.random() < 0.5:
+        tokens[-1] = str(int(tokens[-1]) + rng.randrange(-20, 20))
+    return ' '.join(tokens)
+
+
+def labeled_pairs(size, seed):
+    rng = random.Random(seed)
+    pairs, labels = [], []
+    for _ in range(size):
+        left = entity(rng)
+        label = int(rng.random() < 0.3)
+        # the noisy copies make some of the matches hard to tell apart
+        right = noisy(left, rng) if label else (noisy(left, rng) if rng.random() < 0.1 else entity(rng))
+        pairs.append('%s\t%s\t%d' % (left, right, label))
+        labels.append(label)
+    return pairs, labels
+
+
+@pytest.fixture(scope='module')
+def prefilter():
+    return PreFilter().fit(*labeled_pairs(300, seed=0))
+
+
+@pytest.mark.parametrize('max_recall_loss', [0.0, 0.05, 0.2])
+def test_calibrate_bounds_the_recall_loss(prefilter, max_recall_loss):
+    pairs, labels = labeled_pairs(200, seed=1)
+    report = prefilter.calibrate(pairs, labels, max_recall_loss=max_recall_loss)
+
+    probs = prefilter.predict_proba(pairs)
+    positives = probs[np.asarray(labels) == 1]
+    lost = (positives < prefilter.low).sum()
+    assert lost <= max_recall_loss * len(positives)
+    assert report['recall_loss'] == pytest.approx(lost / len(positives))
+    # the highest such threshold: one more match lost would be too many
+    assert (positives <= prefilter.low).sum() > max_recall_loss * len(positives)
+    # without min_precision, no pair is accepted
+    assert report['accepted'] == 0
+
+
+@pytest.mark.parametrize('min_precision', [0.8, 0.95, 1.0])
+def test_calibrate_bounds_the_accept_precision(prefilter, min_precision):
+    pairs, labels = labeled_pairs(200, seed=1)
+    report = prefilter.calibrate(pairs, labels, max_recall_loss=0.05,
+                                 min_precision=min_precision)
+
+    probs = prefilter.predict_proba(pairs)
+    accepted = probs >= prefilter.high
+    labels = np.asarray(labels)
+    assert prefilter.high >= prefilter.low
+    if accepted.any():
+        assert labels[accepted].mean() >= min_precision
+        assert report['accept_precision'] == pytest.approx(labels[accepted].mean())
+    assert report['accepted'] == pytest.approx(accepted.mean())
+
+    decisions, _ = prefilter.decide(pairs)
+    assert ((decisions == 1) == accepted).all()
+    assert ((decisions == 0) == (probs < prefilter.low)).all()
+
+
+def test_load_prefilter_reuses_the_saved_filter(tmp_path):
+    pairs, _ = labeled_pairs(100, seed=2)
+    trainset = tmp_path / 'train.txt'
+    trainset.write_text(''.join(pair + '\n' for pair in pairs))
+    path = str(tmp_path / 'prefilter.pkl')
+
+    fitted = load_prefilter(str(trainset), path)
+    assert os.path.exists(path)
+    loaded = load_prefilter(str(trainset), path)
+    assert loaded.attributes == fitted.attributes
+    assert np.allclose(loaded.predict_proba(pairs), fitted.predict_proba(pairs))
+
+    # a newer trainset trains the filter again
+    os.utime(path, (0, 0))
+    mtime = os.path.getmtime(path)
+    refitted = load_prefilter(str(trainset), path)
+    assert os.path.getmtime(path) > mtime
+    assert np.allclose(refitted.predict_proba(pairs), fitted.predict_proba(pairs))
+    assert read_pairs(str(trainset))[0] == pairs
@@ -0,0 +1,50 @@
+import os
+
+import torch
+
+from ditto_light.dataset import DittoDataset
+from ditto_light.ditto import DittoModel
+from ditto_light.quantize import load_quantized, quantized_path
+
+
+def save_model(model, path, mtime):
+    torch.save({'model': model.state_dict()}, path)
+    os.utime(path, (mtime, mtime))
+
+
+def logits(model, x):
+    with torch.no_grad():
+        return model(x)
+
+
+def test_quantized_artifact_follows_the_checkpoint(roberta_lm, pair_lines, tmp_path):
+    dataset = DittoDataset(pair_lines, lm=roberta_lm, max_len=64)
+    x, _ = dataset.pad([dataset[0]])
+    checkpoint = str(tmp_path / 'model.pt')
+    artifact = quantized_path(checkpoint)
+    assert artifact == str(tmp_path / 'model.int8.pt')
+
+    torch.manual_seed(0)
+    trained = DittoModel(device='cpu', lm=roberta_lm).eval()
+    save_model(trained, checkpoint, 1000)
+    quantized = load_quantized(DittoModel(device='cpu', lm=roberta_lm), checkpoint)
+    assert os.path.exists(artifact)
+    expected = logits(quantized, x)
+    # int8 weights, close to the fp32 model
+    assert torch.allclose(expected, logits(trained, x), atol=0.05)
+
+    # a newer artifact is reused as is, whatever the weights of the new model
+    os.utime(artifact, (2000, 2000))
+    torch.manual_seed(1)
+    reused = load_quantized(DittoModel(device='cpu', lm=roberta_lm), checkpoint)
+    assert os.path.getmtime(artifact) == 2000
+    assert torch.equal(logits(reused, x), expected)
+
+    # a newer checkpoint (e.g., trained again) refreshes it
+    torch.manual_seed(2)
+    retrained = DittoModel(device='cpu', lm=roberta_lm).eval()
+    save_model(retrained, checkpoint, 3000)
+    refreshed = load_quantized(DittoModel(device='cpu', lm=roberta_lm), checkpoint)
+    assert os.path.getmtime(artifact) > 3000
+    assert not torch.equal(logits(refreshed, x), expected)
+    assert torch.allclose(logits(refreshed, x), logits(retrained, x), atol=0.05)
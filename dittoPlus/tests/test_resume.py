@@ -0,0 +1,84 @@
+import argparse
+import os
+import random
+import time
+
+import numpy as np
+import pytest
+import torch
+
+from ditto_light.checkpoint import CheckpointWriter
+from ditto_light.dataset import DittoDataset
+from ditto_light.ditto import train
+
+
+class Killed(Exception):
+    pass
+
+
+def make_hp(lm, logdir, **kwargs):
+    hp = dict(task='resume', lm=lm, logdir=logdir, device='cpu', run_id=0,
+              batch_size=2, lr=1e-3, n_epochs=2, alpha_aug=0.8,
+              fp16=False, precision='fp32', attn='eager', attn_dropout=None,
+              exit_layers=None, exit_weight=1.0, num_layers=None,
+              bi_encoder=False, bi_weight=1.0, temperature=2.0, distill_alpha=0.5,
+              bucket=False, max_tokens=None, num_workers=0,
+              min_precision=None, min_recall=None,
+              eval_steps=2, patience=None, min_delta=0.0, test_on_improve=False,
+              save_model=False, resume=False, keep_ckpts=1)
+    hp.update(kwargs)
+    return argparse.Namespace(**hp)
+
+
+def run(hp, pair_lines, callback=None):
+    """Train from the same seeds and return the weights and the RNG draws."""
+    random.seed(0)
+    np.random.seed(0)
+    torch.manual_seed(0)
+    # augmented in pad, from the python RNG
+    trainset = DittoDataset(pair_lines * 2, lm=hp.lm, max_len=64, da='del')
+    validset = DittoDataset(pair_lines, lm=hp.lm, max_len=64)
+    model = train(trainset, validset, validset, 'resume', hp, callback=callback)
+    return model.state_dict(), (random.random(), np.random.rand(), torch.rand(1).item())
+
+
+def test_resume_within_an_epoch(roberta_lm, pair_lines, tmp_path):
+    # 4 batches per epoch, evaluated and checkpointed every 2 steps
+    expected, expected_rng = run(make_hp(roberta_lm, str(tmp_path / 'full')), pair_lines)
+
+    # killed at step 8: the checkpoint of step 6 (in epoch 2) is the last one
+    logdir = str(tmp_path / 'killed')
+    def kill(name, step, dev_f1, test_f1):
+        if step == 8:
+            raise Killed()
+    with pytest.raises(Killed):
+        run(make_hp(roberta_lm, logdir), pair_lines, callback=kill)
+    directory = os.path.join(logdir, 'resume')
+    for _ in range(100):
+        # the last checkpoint is written in the background
+        if CheckpointWriter.latest(directory) is not None:
+            break
+        time.sleep(0.1)
+    assert [os.path.basename(p) for p in CheckpointWriter.checkpoints(directory)] == ['ckpt-6.pt']
+
+    weights, rng = run(make_hp(roberta_lm, logdir, resume=True), pair_lines)
+    assert rng == expected_rng
+    assert weights.keys() == expected.keys()
+    for key in expected:
+        assert torch.equal(weights[key], expected[key]), key
+    assert [os.path.basename(p) for p in CheckpointWriter.checkpoints(directory)] == ['ckpt-8.pt']
+
+
+def test_resume_after_an_epoch(roberta_lm, pair_lines, tmp_path):
+    hp = make_hp(roberta_lm, str(tmp_path / 'full'), eval_steps=None, n_epochs=3)
+    expected, expected_rng = run(hp, pair_lines)
+
+    logdir = str(tmp_path / 'stopped')
+    run(make_hp(roberta_lm, logdir, eval_steps=None, n_epochs=3),
+        pair_lines, callback=lambda name, epoch, *scores: epoch == 2)
+    directory = os.path.join(logdir, 'resume')
+    weights, rng = run(make_hp(roberta_lm, logdir, eval_steps=None, n_epochs=3, resume=True),
+                       pair_lines)
+    assert rng == expected_rng
+    for key in expected:
+        assert torch.equal(weights[key], expected[key]), key
@@ -0,0 +1,27 @@
+import numpy as np
+
+from ditto_light.sampler import BucketBatchSampler, restore_order
+
+
+def test_restore_order_inverts_the_batching_order():
+    rng = np.random.RandomState(0)
+    lengths = rng.randint(5, 100, size=57)
+    sampler = BucketBatchSampler(lengths, batch_size=8, shuffle=False)
+    # the outputs of the batches, in the order they are scored
+    outputs = [int(lengths[idx]) * 10 + idx for batch in sampler for idx in batch]
+    assert restore_order(outputs, sampler.order()) == \
+        [int(length) * 10 + idx for idx, length in enumerate(lengths)]
+
+
+def test_unshuffled_batches_are_sorted_by_length():
+    lengths = [3, 9, 1, 9, 4, 7]
+    sampler = BucketBatchSampler(lengths, batch_size=4, shuffle=False)
+    batches = list(sampler)
+    assert [idx for batch in batches for idx in batch] == sampler.order().tolist()
+    assert [lengths[idx] for idx in sampler.order()] == sorted(lengths, reverse=True)
+    assert [len(batch) for batch in batches] == [4, 2]
+
+
+def test_restore_order_of_arrays():
+    order = np.array([2, 0, 1])
+    assert restore_order(np.array([0.2, 0.0, 0.1]), order) == [0.0, 0.1, 0.2]
@@ -0,0 +1,54 @@
+import pickle
+
+import pytest
+
+from ditto_light.storage import PairStore, RowView
+
+LINES = ['COL name VAL café crème\tCOL name VAL cafe creme\t1',
+         'COL title VAL 東京タワー\tCOL title VAL tokyo tower\t1',
+         'COL title VAL naïve bayes 🙂\tCOL title VAL svm\t0',
+         'COL a VAL x\tCOL a VAL y\t0',
+         'COL name VAL Ærøskøbing\tCOL name VAL Ærøskøbing port\t1']
+
+
+def test_pair_store_round_trip(pair_lines):
+    lines = pair_lines + LINES
+    store = PairStore.from_lines(line + '\n' for line in lines)
+
+    assert len(store) == len(lines)
+    for idx, line in enumerate(lines):
+        left, right, label = line.split('\t')
+        assert store[idx] == (left, right)
+        assert store.label(idx) == int(label)
+        assert store.row(idx) == line + '\n'
+    assert list(store) == [tuple(line.split('\t')[:2]) for line in lines]
+    assert store[-1] == store[len(lines) - 1]
+    with pytest.raises(IndexError):
+        store[len(lines)]
+
+    # the store can be sent to spawned worker processes
+    assert list(pickle.loads(pickle.dumps(store))) == list(store)
+    assert store.nbytes() == store.buffer.nbytes + store.offsets.nbytes + store.labels.nbytes
+
+
+def test_pair_store_slices_and_rows(pair_lines):
+    lines = pair_lines + LINES
+    store = PairStore.from_lines(lines)
+
+    view = store[3:7]
+    assert view.buffer is store.buffer
+    assert list(view) == list(store)[3:7]
+    assert [view.label(i) for i in range(len(view))] == [store.label(i) for i in range(3, 7)]
+    assert list(view[1:3]) == list(store)[4:6]
+    assert list(view[-2:]) == list(store)[5:7]
+    assert len(store[5:2]) == 0 and list(store[5:2]) == []
+    with pytest.raises(ValueError):
+        store[::2]
+
+    rows = store.rows
+    assert isinstance(rows, RowView)
+    assert len(rows) == len(lines)
+    assert list(rows) == [line + '\n' for line in lines]
+    assert rows[6] == lines[6] + '\n'
+    assert list(rows[2:5]) == [line + '\n' for line in lines[2:5]]
+    assert PairStore.from_lines(rows).row(7) == store.row(7)
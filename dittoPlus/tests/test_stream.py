@@ -0,0 +1,56 @@
+import random
+
+from ditto_light.dataset import DittoDataset, DittoStreamDataset
+from ditto_light.loader import make_loader
+
+
+def write_stream(path, lines):
+    """Write the pairs with blank lines in between and no final newline."""
+    with open(path, 'w', encoding='utf-8') as fout:
+        fout.write('\n\n'.join(lines) + '\n  \n' + lines[0])
+    return str(path)
+
+
+def test_stream_count_and_size(roberta_lm, pair_lines, tmp_path):
+    lines = pair_lines * 5
+    path = write_stream(tmp_path / 'train.txt', lines)
+    items = DittoDataset(lines + lines[:1], lm=roberta_lm, max_len=64)
+    expected = [items[i] for i in range(len(items))]
+
+    stream = DittoStreamDataset(path, lm=roberta_lm, max_len=64, chunk_size=64)
+    assert stream.count() == len(expected)
+    assert list(stream) == expected
+
+    # size stops the reading early, the blank lines do not count
+    for size in [1, 7, len(expected), len(expected) + 3]:
+        stream = DittoStreamDataset(path, lm=roberta_lm, max_len=64, size=size)
+        assert stream.count() == min(size, len(expected))
+        assert list(stream) == expected[:size]
+
+
+def test_stream_workers_and_shuffle(roberta_lm, pair_lines, tmp_path):
+    lines = ['%s\t%d' % (line.rsplit('\t', 1)[0], i % 2)
+             for i, line in enumerate(pair_lines * 6)]
+    path = write_stream(tmp_path / 'train.txt', lines)
+    items = DittoDataset(lines + lines[:1], lm=roberta_lm, max_len=64)
+    expected = [items[i] for i in range(len(items))]
+
+    # every worker reads its share of the pairs once
+    stream = DittoStreamDataset(path, lm=roberta_lm, max_len=64, size=20)
+    loader = make_loader(stream, num_workers=2, batch_size=None, seed=1)
+    loaded = [(x, label) for x, label in loader]
+    assert len(loaded) == 20
+    assert sorted(loaded) == sorted(expected[:20])
+
+    # the shuffle buffer permutes the pairs
+    random.seed(0)
+    stream = DittoStreamDataset(path, lm=roberta_lm, max_len=64, shuffle_buffer=4)
+    shuffled = list(stream)
+    assert shuffled != expected
+    assert sorted(shuffled) == sorted(expected)
+
+    # within a bounded distance: a row leaves the buffer of 4 at the latest
+    # when the 4 next rows have come in
+    order = list(stream.shuffled(iter(range(30))))
+    assert sorted(order) == list(range(30))
+    assert all(row <= position + 4 for position, row in enumerate(order))
@@ -0,0 +1,62 @@
+import queue
+import threading
+
+import pytest
+
+from ditto_light.sweep import SuccessiveHalving, rung_epochs, take_slot
+
+
+@pytest.mark.parametrize('min_epochs, eta, n_epochs, rungs', [
+    (1, 3, 27, [1, 3, 9]),
+    (1, 3, 28, [1, 3, 9, 27]),
+    (2, 2, 10, [2, 4, 8]),
+    (1, 2, 1, []),
+    (5, 3, 5, []),
+])
+def test_rung_epochs(min_epochs, eta, n_epochs, rungs):
+    assert rung_epochs(min_epochs, eta, n_epochs) == rungs
+
+
+def test_report_off_the_rungs():
+    halving = SuccessiveHalving([1, 3], eta=3)
+    assert not halving.report(2, 0.0)
+    assert halving.scores == {}
+
+
+def test_report_lets_the_first_runs_go_on():
+    halving = SuccessiveHalving([1, 3], eta=3)
+    assert not any(halving.report(1, f1) for f1 in [0.9, 0.1, 0.0])
+    assert halving.scores == {1: [0.9, 0.1, 0.0]}
+
+
+def test_report_stops_the_runs_below_the_top_third():
+    halving = SuccessiveHalving([1, 3], eta=3, lock=threading.Lock())
+    for f1 in [0.1, 0.5, 0.9]:
+        halving.report(1, f1)
+    # the 2/3 quantile of (0.1, 0.5, 0.9) is 0.633
+    assert halving.report(1, 0.6)
+    assert not halving.report(1, 0.7)
+    # the stopped runs count for the next ones
+    assert halving.scores[1] == [0.1, 0.5, 0.9, 0.6, 0.7]
+    # the rungs are compared separately
+    assert not halving.report(3, 0.0)
+
+
+def test_report_with_eta_2():
+    halving = SuccessiveHalving([2], eta=2)
+    assert not halving.report(2, 0.2)
+    assert not halving.report(2, 0.8)
+    # the median of (0.2, 0.8)
+    assert halving.report(2, 0.4)
+    assert not halving.report(2, 0.5)
+
+
+def test_take_slot():
+    slots = [[0, 1], [2, 3]]
+    free_slots = queue.Queue()
+    for slot in slots:
+        free_slots.put(slot)
+    assert take_slot(free_slots, slots, 0) == [0, 1]
+    assert take_slot(free_slots, slots, 1) == [2, 3]
+    # a replaced worker gets the set of its index instead of blocking
+    assert take_slot(free_slots, slots, 3, timeout=0.01) == [2, 3]
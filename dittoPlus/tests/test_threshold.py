@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from ditto_light.threshold import best_threshold, f1_at
+
+
+def scan(probs, labels, min_precision=None, min_recall=None):
+    """The best F1 of a brute-force scan of every cut (None if no cut meets
+    the constraints)."""
+    cuts = np.append(np.unique(probs), -1.0)
+    best = None
+    for cut in cuts:
+        pred = probs >= cut
+        tp = np.sum(pred & (labels == 1))
+        if min_precision is not None and (pred.sum() == 0 or tp / pred.sum() < min_precision):
+            continue
+        if min_recall is not None and tp / labels.sum() < min_recall:
+            continue
+        f1 = 2 * tp / (pred.sum() + labels.sum())
+        best = f1 if best is None else max(best, f1)
+    return best
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_best_threshold_matches_a_scan(seed):
+    rng = np.random.RandomState(seed)
+    n = rng.randint(1, 200)
+    labels = rng.randint(0, 2, size=n)
+    # rounded probabilities, so that there are ties
+    probs = np.round(np.clip(0.3 * labels + rng.rand(n) * 0.7, 0, 1), 2)
+    if labels.sum() == 0:
+        labels[0] = 1
+
+    f1, threshold = best_threshold(probs, labels)
+    assert f1 == pytest.approx(scan(probs, labels))
+    assert f1_at(probs, labels, threshold) == pytest.approx(f1)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_constrained_threshold_matches_a_scan(seed):
+    rng = np.random.RandomState(seed)
+    labels = rng.randint(0, 2, size=150)
+    probs = np.round(np.clip(0.3 * labels + rng.rand(150) * 0.7, 0, 1), 2)
+
+    f1, threshold = best_threshold(probs, labels, min_precision=0.8)
+    expected = scan(probs, labels, min_precision=0.8)
+    assert f1 == pytest.approx(expected if expected is not None else scan(probs, labels))
+    assert f1_at(probs, labels, threshold) == pytest.approx(f1)
+
+    f1, threshold = best_threshold(probs, labels, min_recall=0.95)
+    assert f1 == pytest.approx(scan(probs, labels, min_recall=0.95))
+    assert f1_at(probs, labels, threshold) == pytest.approx(f1)
+
+
+def test_no_positive_labels():
+    assert best_threshold(np.array([0.2, 0.7]), np.array([0, 0])) == (0.0, 0.5)
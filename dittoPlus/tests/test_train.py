@@ -0,0 +1,39 @@
+import argparse
+import torch
+
+from unittest import mock
+from transformers import get_linear_schedule_with_warmup
+
+from ditto_light.dataset import DittoDataset
+from ditto_light.ditto import DittoModel, evaluate, train_step
+from ditto_light.loader import make_loader
+
+KBERT_LINES = ['COL <head> title </head> <tail> name </tail> VAL sony bravia tv\t'
+               'COL <head> title </head> <tail> name </tail> VAL sony bravia television\t1',
+               'COL <head> name </head> <tail> artist </tail> VAL miles davis\t'
+               'COL <head> name </head> <tail> artist </tail> VAL john coltrane\t0']
+
+
+def test_kbert_training_feeds_the_trees(roberta_lm):
+    torch.manual_seed(0)
+    model = DittoModel(device='cpu', lm=roberta_lm)
+    dataset = DittoDataset(KBERT_LINES * 2, lm=roberta_lm, kbert=True)
+    iterator = make_loader(dataset, batch_size=2, collate_fn=dataset.pad)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+    scheduler = get_linear_schedule_with_warmup(optimizer, 0, len(iterator))
+    hp = argparse.Namespace(temperature=1.0, exit_weight=1.0, bi_weight=1.0)
+
+    with mock.patch.object(model, 'forward', wraps=model.forward) as forward:
+        train_step(iterator, model, optimizer, scheduler, hp)
+        assert forward.call_count == len(iterator)
+        for call in forward.call_args_list:
+            assert call.kwargs['vm'] is not None
+            assert call.kwargs['position_ids'] is not None
+
+    # training and evaluation see the same inputs
+    x, position_ids, vm, _ = next(iter(iterator))
+    model.eval()
+    with torch.no_grad():
+        assert not torch.allclose(model(x, vm=vm, position_ids=position_ids), model(x))
+    f1, threshold = evaluate(model, iterator, threshold=None)
+    assert 0.0 <= f1 <= 1.0
@@ -1,10 +1,12 @@
 import gc
+import itertools
 import time
 
 import os
 import argparse
 import json
 import sys
+import tempfile
 import torch
 import numpy as np
 import random
@@ -23,16 +25,28 @@ for gpu in gpus:
 
 sys.path.insert(0, "Snippext_public")
 
-from ditto_light.dataset import DittoDataset
+from ditto_light.dataset import DittoDataset, DittoStreamDataset, get_ditto_tokenizer
+from ditto_light.augstore import AugmentStore, generate_augment_store
 from ditto_light.summarize import Summarizer
 from ditto_light.knowledge import *
-from ditto_light.ditto import train
+from ditto_light.ditto import evaluate, train
+from ditto_light.early_exit import calibrate_exits, evaluate_exits, format_exit_report, \
+    save_exit_thresholds
+from ditto_light.distill import distillation_labels, teacher_probs, unlabeled_lines
+from ditto_light.biencoder import BiEncoder
+from ditto_light.threshold import best_threshold, f1_at
+from ditto_light.loader import make_loader
+from ditto_light.distributed import cleanup_distributed, gather_shards, get_rank, \
+    get_world_size, init_distributed, is_main_process, main_process_first
+from matcher import load_model
 
 
 def classify(sentence_pairs, model, save,
              lm='distilbert',
              max_len=512,
-             threshold=None):
+             threshold=None,
+             num_workers=0,
+             pack=False):
     """Apply the MRPC model.
 
     Args:
@@ -40,6 +54,8 @@ def classify(sentence_pairs, model, save,
         model (MultiTaskNet): the model in pytorch
         max_len (int, optional): the max sequence length
         threshold (float, optional): the threshold of the 0's class
+        num_workers (int, optional): the number of data loading processes
+        pack (boolean, optional): pack several pairs per sequence
 
     Returns:
         list of float: the scores of the pairs
@@ -49,17 +65,18 @@ def classify(sentence_pairs, model, save,
    
     dataset = DittoDataset(inputs,
                            max_len=max_len,
-                           lm=lm)
+                           lm=lm,
+                           pack=pack)
     padder = dataset.pad
     # print(dataset[0])
-    iterator = data.DataLoader(dataset=dataset,
-                            #    batch_size=len(dataset),
-                               batch_size=32,
-                               shuffle=False,
-                               num_workers=0,
-                               collate_fn=padder
-                               )
-                            #    collate_fn=DittoDataset.pad)
+    iterator = make_loader(dataset,
+                           num_workers=num_workers,
+                        #    batch_size=len(dataset),
+                           batch_size=32,
+                           shuffle=False,
+                           collate_fn=padder
+                           )
+                        #    collate_fn=DittoDataset.pad)
     
     enc = []
     # prediction
@@ -77,6 +94,10 @@ def classify(sentence_pairs, model, save,
                 # visible_matrix_batch, position_batch = visible_matrix_batch.to(model.device), position_batch.to(model.device)
                 logits = model(x, vm=visible_matrix_batch, position_ids=position_batch, save=save)
                 del position_batch, visible_matrix_batch
+            elif len(batch) == 5:
+                x, positions, segments, cls_index, y = batch
+                logits = model(x, position_ids=positions, segments=segments,
+                               cls_index=cls_index, save=save)
             enc.append(model.enc)
             probs = logits.softmax(dim=1)[:, 1]
             all_probs += probs.cpu().numpy().tolist()
@@ -91,55 +112,73 @@ def classify(sentence_pairs, model, save,
     return pred, all_logits, enc
 
 
-if __name__=="__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--task", type=str, default="Structured/DBLP-ACM")
-    parser.add_argument("--run_id", type=int, default=0)
-    parser.add_argument("--batch_size", type=int, default=32)
-    parser.add_argument("--max_len", type=int, default=512)
-    parser.add_argument("--lr", type=float, default=3e-5)
-    parser.add_argument("--n_epochs", type=int, default=20)
-    parser.add_argument("--finetuning", dest="finetuning", action="store_true")
-    parser.add_argument("--save_model", dest="save_model", action="store_true")
-    parser.add_argument("--logdir", type=str, default="checkpoints/")
-    parser.add_argument("--lm", type=str, default='roberta')
-    parser.add_argument("--fp16", dest="fp16", action="store_true")
-    parser.add_argument("--da", type=str, default=None)
-    parser.add_argument("--alpha_aug", type=float, default=0.8)
-    parser.add_argument("--dk", type=str, default=None)
-    parser.add_argument("--prompt", type=int, default=1)
-    parser.add_argument("--summarize", dest="summarize", action="store_true")
-    parser.add_argument("--size", type=int, default=None)
-    parser.add_argument("--device", type=str, default='cuda', help='cpu or cuda')
-    parser.add_argument("--kbert",type=bool, default=False)
-    parser.add_argument("--overwrite",type=bool, default=False)
+def make_injector(config, dk):
+    """Return the DK injector of a knowledge type."""
+    if dk == 'product':
+        return ProductDKInjector(config, dk)
+    elif dk == 'entityLinking':
+        return EntityLinkingDKInjector(config, dk)
+    elif dk == 'sherlock':
+        return SherlockDKInjector(config, dk)
+    return GeneralDKInjector(config, dk)
 
-    hp = parser.parse_args()
 
-    # set seeds
-    seed = hp.run_id
-    random.seed(seed)
-    np.random.seed(seed)
-    torch.manual_seed(seed)
-    if torch.cuda.is_available():
-        torch.cuda.manual_seed_all(seed)
+def distill_trainset(trainset, unlabeled, hp):
+    """Label the training pairs and the unlabeled pairs with the teacher.
 
-    # only a single task for baseline
-    task = hp.task
+    The teacher (a checkpoint of matcher.load_model) scores the pairs once,
+    with its own tokenizer; its match probabilities, softened by
+    hp.temperature, are kept with the labels (see distill.distillation_loss).
+    In the distributed mode, every rank scores a shard of the pairs and the
+    probabilities are gathered, so it must be called by all the ranks.
 
-    # create the tag of the run
-    run_tag = '%s_lm=%s_da=%s_dk=%s_su=%s_size=%s_id=%d' % (task, hp.lm, hp.da,
-            hp.dk, hp.summarize, str(hp.size), hp.run_id)
-    run_tag = run_tag.replace('/', '_')
+    Args:
+        trainset (str): the training set (with the injected knowledge)
+        unlabeled (str): the unlabeled candidate pairs in the same format (or None)
+        hp (Namespace): the arguments (teacher_path, teacher_lm, ...)
 
-    # load task configuration
-    configs = json.load(open('configs.json'))
-    configs = {conf['name'] : conf for conf in configs}
-    config = configs[task]
+    Returns:
+        list of str: the pairs (left \\t right \\t label, -1 if unlabeled)
+        np.ndarray: the teacher's probability and the label of every pair
+    """
+    with open(trainset, encoding='utf-8') as fin:
+        lines = [line.rstrip('\n') for line in itertools.islice(fin, hp.size)]
+    if unlabeled is not None:
+        lines += unlabeled_lines(unlabeled)
+
+    _, teacher = load_model(hp.task, hp.teacher_path, hp.teacher_lm,
+                            use_gpu=hp.device == 'cuda', fp16=False)
+    # the shard of this rank, see DatasetShard
+    probs = teacher_probs(teacher, lines[get_rank()::get_world_size()], hp.teacher_lm,
+                          max_len=hp.max_len,
+                          batch_size=hp.batch_size*16,
+                          temperature=hp.temperature,
+                          kbert=hp.kbert)
+    del teacher
+    probs = gather_shards(probs)
+    labels = np.array([int(line.split('\t')[-1]) for line in lines])
+    if is_main_process():
+        print(f"Distilling {hp.teacher_path} on {len(lines)} pairs ({(labels < 0).sum()} unlabeled)")
+    return lines, distillation_labels(probs, labels)
 
+
+def prepare_inputs(hp, config):
+    """Summarize the files of a task and inject their domain knowledge.
+
+    The outputs are written next to the inputs and reused if they exist.
+
+    Args:
+        hp (Namespace): the arguments (summarize, dk, prompt, ...)
+        config (Dictionary): the task configuration
+
+    Returns:
+        str: the paths of the training, validation and test sets, and of
+            the unlabeled pairs (None if not set)
+    """
     trainset_input = config['trainset']
     validset_input = config['validset']
     testset_input = config['testset']
+    unlabeled_input = hp.unlabeled
 
     # summarize the sequences up to the max sequence length
     if hp.summarize:
@@ -147,7 +186,9 @@ if __name__=="__main__":
         trainset_input = summarizer.transform_file(trainset_input, max_len=hp.max_len, overwrite=True)
         validset_input = summarizer.transform_file(validset_input, max_len=hp.max_len, overwrite=True)
         testset_input = summarizer.transform_file(testset_input, max_len=hp.max_len, overwrite=True)
-    
+        if unlabeled_input is not None:
+            unlabeled_input = summarizer.transform_file(unlabeled_input, max_len=hp.max_len, overwrite=True)
+
     # out_fn = input_fn + f'.prompt_type{prompt_type}.sherlock.dk'
     if hp.dk == 'sherlock':
         trainset = trainset_input + f'.prompt_type{hp.prompt}.sherlock.dk'
@@ -167,37 +208,12 @@ if __name__=="__main__":
         validset = validset_input + f'.refined'
     # TODO: what's the extension for EL- file?
 
-    
-    logging_info = {
-    'dataset-path': testset,
-    'hyperparams': {
-        'prompt': hp.prompt,
-        'batch_size': hp.batch_size,
-        'max_len': hp.max_len,
-        'lr': hp.lr,
-        'kbert': hp.kbert
-
-    },
-    'rows':[
-    ],
-    # 'ground_truth':,
-    # 'pred_result':,
-    # 'matching_conf':,
-    }
-    # row: {'left': ..., 'right':..., 'ground_truth':0, 'pred_result':0, 'matching_conf':...}
     if os.path.exists(trainset):
         print(f"The file '{trainset}' exists already.")
     else:
         print(f"The file '{trainset}' does not exist.")
         print(f"Using DK Injector: {hp.dk}")
-        if hp.dk == 'product':
-            injector = ProductDKInjector(config, hp.dk)
-        elif hp.dk == 'entityLinking':
-            injector = EntityLinkingDKInjector(config, hp.dk)
-        elif hp.dk == 'sherlock':
-            injector = SherlockDKInjector(config, hp.dk)
-        else:
-            injector = GeneralDKInjector(config, hp.dk)
+        injector = make_injector(config, hp.dk)
 
         print(f"param overwrite: {hp.overwrite}")
         print(f"trainset_input: {trainset_input}")
@@ -205,37 +221,202 @@ if __name__=="__main__":
         trainset= injector.transform_file(trainset_input, trainset, overwrite=hp.overwrite,prompt_type=hp.prompt)
         validset= injector.transform_file(validset_input, validset, overwrite=hp.overwrite,prompt_type=hp.prompt)
         testset= injector.transform_file(testset_input, testset, overwrite=hp.overwrite,prompt_type=hp.prompt)
-    
-    #load train/dev/test sets
+
+    # the unlabeled pairs get the same knowledge as the trainset
+    unlabeled = unlabeled_input
+    if unlabeled_input is not None:
+        unlabeled = unlabeled_input + trainset[len(trainset_input):]
+        if not os.path.exists(unlabeled):
+            unlabeled = make_injector(config, hp.dk).transform_file(
+                unlabeled_input, unlabeled, overwrite=hp.overwrite, prompt_type=hp.prompt)
+    return trainset, validset, testset, unlabeled
+
+
+def load_datasets(hp, trainset, validset, testset, unlabeled=None, distilled=None):
+    """Load the datasets of a run from the prepared files (see prepare_inputs).
+
+    With a teacher_path, the training pairs are labeled by distill_trainset,
+    unless its output is given in distilled.
+
+    Returns:
+        DittoDataset: the training (or DittoStreamDataset), validation and
+            test sets
+    """
     print(f"Reading training data from: {trainset}")
-    train_dataset = DittoDataset(trainset,
+    if hp.stream:
+        # read the training set lazily instead of holding it in memory
+        train_dataset = DittoStreamDataset(trainset,
                                    lm=hp.lm,
                                    max_len=hp.max_len,
                                    size=hp.size,
                                    da=hp.da,
-                                   kbert=hp.kbert)
+                                   kbert=hp.kbert,
+                                   shuffle_buffer=hp.shuffle_buffer,
+                                   pack=hp.pack)
+    else:
+        augment_store = None
+        tokenizer = get_ditto_tokenizer(hp.lm)
+        if hp.da is not None and hp.da_store is not None:
+            # augment every pair da_k times once, off the training loop
+            if not os.path.exists(hp.da_store):
+                print(f"Generating {hp.da_k} augmented variants per pair: {hp.da_store}")
+                generate_augment_store(trainset, hp.da_store,
+                                       da=hp.da,
+                                       k=hp.da_k,
+                                       size=hp.size,
+                                       seed=hp.run_id)
+            augment_store = AugmentStore.load(hp.da_store, tokenizer,
+                                              max_len=hp.max_len,
+                                              cache_dir=hp.cache_dir)
+        soft_labels = None
+        train_input = trainset
+        if hp.teacher_path is not None:
+            # the student learns the soft labels of the teacher
+            if distilled is None:
+                distilled = distill_trainset(trainset, unlabeled, hp)
+            train_input, soft_labels = distilled
+        train_dataset = DittoDataset(train_input,
+                                   lm=hp.lm,
+                                   max_len=hp.max_len,
+                                   # the distilled pairs are already cut to size
+                                   size=hp.size if soft_labels is None else None,
+                                   da=hp.da,
+                                   kbert=hp.kbert,
+                                   tokenizer=tokenizer,
+                                   cache_dir=hp.cache_dir,
+                                   augment_store=augment_store,
+                                   pack=hp.pack,
+                                   soft_labels=soft_labels)
+    # the evaluation sets are not augmented (evaluate takes no MixDA batches)
     valid_dataset = DittoDataset(validset, lm=hp.lm, max_len=hp.max_len,
                                    size=hp.size,
-                                   da=hp.da,
-                                   kbert=hp.kbert)
+                                   kbert=hp.kbert,
+                                   cache_dir=hp.cache_dir,
+                                   pack=hp.pack)
     test_dataset = DittoDataset(testset, lm=hp.lm, max_len=hp.max_len,
                                    size=hp.size,
-                                   da=hp.da,
-                                   kbert=hp.kbert)
+                                   kbert=hp.kbert,
+                                   cache_dir=hp.cache_dir,
+                                   pack=hp.pack)
+    return train_dataset, valid_dataset, test_dataset
+
+
+def main(hp, callback=None):
+    """Train a model on a task and label its test set.
+
+    In the distributed mode, every process runs main; the input files are
+    prepared by rank 0 first and only rank 0 labels the test set.
+
+    Args:
+        hp (Namespace): the arguments
+        callback (function, optional): called after every evaluation (see
+            ditto.train)
+    """
+    # set seeds
+    seed = hp.run_id
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    if torch.cuda.is_available():
+        torch.cuda.manual_seed_all(seed)
+
+    # only a single task for baseline
+    task = hp.task
+
+    # create the tag of the run
+    run_tag = '%s_lm=%s_da=%s_dk=%s_su=%s_size=%s_id=%d' % (task, hp.lm, hp.da,
+            hp.dk, hp.summarize, str(hp.size), hp.run_id)
+    run_tag = run_tag.replace('/', '_')
+
+    # load task configuration
+    configs = json.load(open('configs.json'))
+    configs = {conf['name'] : conf for conf in configs}
+    config = configs[task]
+
+    # rank 0 writes the input files (and caches) before the other ranks read them
+    with main_process_first():
+        trainset, validset, testset, unlabeled = prepare_inputs(hp, config)
+
+        logging_info = {
+        'dataset-path': testset,
+        'hyperparams': {
+            'prompt': hp.prompt,
+            'batch_size': hp.batch_size,
+            'max_len': hp.max_len,
+            'lr': hp.lr,
+            'kbert': hp.kbert
+
+        },
+        'rows':[
+        ],
+        # 'ground_truth':,
+        # 'pred_result':,
+        # 'matching_conf':,
+        }
+        # row: {'left': ..., 'right':..., 'ground_truth':0, 'pred_result':0, 'matching_conf':...}
+
+    # the teacher scores the pairs on all the ranks at once, each its shard
+    distilled = None
+    if hp.teacher_path is not None:
+        distilled = distill_trainset(trainset, unlabeled, hp)
+
+    with main_process_first():
+        #load train/dev/test sets
+        train_dataset, valid_dataset, test_dataset = load_datasets(hp, trainset, validset,
+                                                                   testset, unlabeled,
+                                                                   distilled=distilled)
 
     # train and evaluate the model
     model = train(train_dataset,
           valid_dataset,
           test_dataset,
-          run_tag, hp)
-    
+          run_tag, hp, callback=callback)
+    if not is_main_process():
+        return
+
+    if hp.exit_layers is not None:
+        # calibrate the exits on the validset, report them on the testset
+        valid_iter, test_iter = [make_loader(dataset,
+                                             batch_size=hp.batch_size*16,
+                                             shuffle=False,
+                                             collate_fn=dataset.pad)
+                                 for dataset in (valid_dataset, test_dataset)]
+        model.eval()
+        _, th = evaluate(model, valid_iter)
+        num_layers = model.bert.config.num_hidden_layers
+        report = calibrate_exits(model, valid_iter, threshold=th,
+                                 max_disagreement=hp.exit_tolerance)
+        print("exit thresholds:", model.exit_thresholds)
+        print("valid:", format_exit_report(report, num_layers))
+        if hp.save_model:
+            # reused by matcher.py --early_exit at the same threshold
+            save_exit_thresholds(model, os.path.join(hp.logdir, hp.task, 'model.pt'),
+                                 th, hp.exit_tolerance)
+        report = evaluate_exits(model, test_iter, threshold=th)
+        print("test:", format_exit_report(report, num_layers))
+        # the test set is labeled (and its vectors saved) by the full model
+        model.exit_thresholds = None
+
+    if hp.bi_encoder:
+        # the bi-encoder alone, at its best threshold on the validset
+        bi_encoder = BiEncoder(model, get_ditto_tokenizer(hp.lm),
+                               max_len=hp.max_len,
+                               batch_size=hp.batch_size*16)
+        _, th = best_threshold(bi_encoder.predict_proba(list(valid_dataset.rows)), valid_dataset.labels)
+        num_entities = len(bi_encoder.cache)
+        probs = bi_encoder.predict_proba(list(test_dataset.rows))
+        print("bi-encoder: test f1=%f, %d pairs, %d entities encoded"
+              % (f1_at(probs, test_dataset.labels, th), len(probs),
+                 len(bi_encoder.cache) - num_entities))
 
     # predict the model
     # batch processing
     def process_batch(rows, pairs, save , writer, logs):
         predictions, logits, vectors = classify(rows, model, save=save, lm=hp.lm,
                                         max_len=hp.max_len,
-                                        threshold=0.5)
+                                        threshold=0.5,
+                                        num_workers=hp.num_workers,
+                                        pack=hp.pack)
         assert len(rows) == len(vectors)
         scores = softmax(logits, axis=1)
         for idx, (pair, pred, score) in enumerate(zip(pairs, predictions, scores)):
@@ -258,13 +439,8 @@ if __name__=="__main__":
     os.makedirs(f'./output/{hp.task}', exist_ok=True)
     save = True
     with jsonlines.open(f"./output/{hp.task}/result.jsonl", mode='w') as writer:
-        pairs = test_dataset.pairs # (e1, e2)
-        rows = test_dataset.rows # (e1, e2, \t, label)
-        if len(pairs) == hp.batch_size:
-            process_batch(rows, pairs, save, writer, logging_info['rows'])
-            pairs.clear()
-            rows.clear()
-
+        pairs = test_dataset.pairs # (e1, e2), views of the compact store
+        rows = test_dataset.rows # (e1, e2, \t, label), rebuilt from the store
         if len(pairs) > 0:
             process_batch(rows, pairs, save, writer, logging_info['rows'])
 
@@ -286,4 +462,113 @@ if __name__=="__main__":
         f.write(json_object)
     # with jsonlines.open(f"./output/{hp.task}/{hp.dk}/prompt={p_name}/result.jsonl", mode='w') as tkaer:
     #     tkaer.write(logging_info)
-    
\ No newline at end of file
+    
+
+def main_worker(local_rank, hp):
+    """Run main in a process of the distributed (--nprocs) mode.
+
+    Args:
+        local_rank (int): the rank of the process on its node
+        hp (Namespace): the arguments, with the rendezvous file in dist_file
+    """
+    rank = hp.node_rank * hp.nprocs + local_rank
+    # the processes of a node share its cores
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // hp.nprocs))
+    init_distributed(rank, hp.nprocs * hp.nnodes, hp.dist_file)
+    try:
+        main(hp)
+    finally:
+        cleanup_distributed()
+
+
+def make_parser():
+    """Return the argument parser of train_ditto.py (also used by sweep.py)."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--task", type=str, default="Structured/DBLP-ACM")
+    parser.add_argument("--run_id", type=int, default=0)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--max_len", type=int, default=512)
+    parser.add_argument("--lr", type=float, default=3e-5)
+    parser.add_argument("--n_epochs", type=int, default=20)
+    parser.add_argument("--finetuning", dest="finetuning", action="store_true")
+    parser.add_argument("--save_model", dest="save_model", action="store_true")
+    parser.add_argument("--logdir", type=str, default="checkpoints/")
+    parser.add_argument("--lm", type=str, default='roberta')
+    parser.add_argument("--fp16", dest="fp16", action="store_true")
+    parser.add_argument("--precision", type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'])
+    parser.add_argument("--attn", type=str, default='eager', choices=['eager', 'sdpa'])
+    parser.add_argument("--attn_dropout", type=float, default=None)
+    parser.add_argument("--exit_layers", type=int, nargs='+', default=None)
+    parser.add_argument("--exit_weight", type=float, default=1.0)
+    parser.add_argument("--exit_tolerance", type=float, default=0.01)
+    parser.add_argument("--num_layers", type=int, default=None)
+    parser.add_argument("--teacher_path", type=str, default=None)
+    parser.add_argument("--teacher_lm", type=str, default='roberta')
+    parser.add_argument("--unlabeled", type=str, default=None)
+    parser.add_argument("--distill_alpha", type=float, default=0.5)
+    parser.add_argument("--temperature", type=float, default=2.0)
+    parser.add_argument("--bi_encoder", dest="bi_encoder", action="store_true")
+    parser.add_argument("--bi_weight", type=float, default=1.0)
+    parser.add_argument("--min_precision", type=float, default=None)
+    parser.add_argument("--min_recall", type=float, default=None)
+    parser.add_argument("--eval_steps", type=int, default=None)
+    parser.add_argument("--patience", type=int, default=None)
+    parser.add_argument("--min_delta", type=float, default=0.0)
+    parser.add_argument("--test_on_improve", dest="test_on_improve", action="store_true")
+    parser.add_argument("--resume", dest="resume", action="store_true")
+    parser.add_argument("--keep_ckpts", type=int, default=None)
+    parser.add_argument("--da", type=str, default=None)
+    parser.add_argument("--alpha_aug", type=float, default=0.8)
+    parser.add_argument("--dk", type=str, default=None)
+    parser.add_argument("--prompt", type=int, default=1)
+    parser.add_argument("--summarize", dest="summarize", action="store_true")
+    parser.add_argument("--size", type=int, default=None)
+    parser.add_argument("--device", type=str, default='cuda', help='cpu or cuda')
+    parser.add_argument("--kbert",type=bool, default=False)
+    parser.add_argument("--overwrite",type=bool, default=False)
+    parser.add_argument("--cache_dir", type=str, default=None)
+    parser.add_argument("--bucket", dest="bucket", action="store_true")
+    parser.add_argument("--max_tokens", type=int, default=None)
+    parser.add_argument("--pack", dest="pack", action="store_true")
+    parser.add_argument("--num_workers", type=int, default=0)
+    parser.add_argument("--stream", dest="stream", action="store_true")
+    parser.add_argument("--shuffle_buffer", type=int, default=10000)
+    parser.add_argument("--da_store", type=str, default=None)
+    parser.add_argument("--da_k", type=int, default=10)
+    parser.add_argument("--nprocs", type=int, default=1)
+    parser.add_argument("--nnodes", type=int, default=1)
+    parser.add_argument("--node_rank", type=int, default=0)
+    parser.add_argument("--dist_file", type=str, default=None)
+    return parser
+
+
+def check_args(parser, hp):
+    """Reject the unsupported combinations of arguments and fill in the
+    defaults that depend on other arguments."""
+    if hp.teacher_path is not None and hp.stream:
+        parser.error('--teacher_path does not support --stream')
+    if hp.unlabeled is not None and hp.teacher_path is None:
+        parser.error('--unlabeled needs a --teacher_path')
+    if hp.bi_encoder and (hp.kbert or hp.pack):
+        parser.error('--bi_encoder needs plain pairs (no --kbert or --pack)')
+    if hp.lm != 'roberta' and (hp.kbert or hp.pack):
+        parser.error('--kbert and --pack need --lm roberta (RobertaWithVM)')
+    if hp.keep_ckpts is None:
+        # a run saving its model can be resumed
+        hp.keep_ckpts = 1 if hp.save_model else 0
+
+
+if __name__=="__main__":
+    parser = make_parser()
+    hp = parser.parse_args()
+    check_args(parser, hp)
+
+    if hp.nprocs > 1 or hp.nnodes > 1:
+        # DistributedDataParallel on gloo: nprocs processes on each of nnodes nodes
+        if hp.dist_file is None:
+            if hp.nnodes > 1:
+                parser.error('--dist_file (on a shared file system) is required with --nnodes > 1')
+            hp.dist_file = os.path.join(tempfile.mkdtemp(), 'rendezvous')
+        torch.multiprocessing.spawn(main_worker, args=(hp,), nprocs=hp.nprocs)
+    else:
+        main(hp)